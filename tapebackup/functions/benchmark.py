@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from tabulate import tabulate
+from tapebackup.lib import diff
+from tapebackup.lib import hashing
+
+logger = logging.getLogger()
+
+
+class Benchmark:
+    def __init__(self, config, engine, tapelibrary, tools):
+        self.config = config
+        self.engine = engine
+        self.tapelibrary = tapelibrary
+        self.tools = tools
+        self.interrupted = False
+
+    def set_interrupted(self):
+        self.interrupted = True
+
+    @staticmethod
+    def run_measured(target, *args):
+        """
+        Run a function in a forked child process, so every run starts with the same memory footprint
+        :return: tuple (result, seconds, peak rss in bytes, rss in bytes at start)
+        """
+        ctx = multiprocessing.get_context('fork')
+        parent_conn, child_conn = ctx.Pipe()
+
+        def runner():
+            rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            time_started = time.time()
+            result = target(*args)
+            child_conn.send((result, time.time() - time_started,
+                             resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, rss_start))
+
+        process = ctx.Process(target=runner)
+        process.start()
+        result = parent_conn.recv()
+        process.join()
+        return result
+
+    # Synthetic file lists: the catalog knows 'count' files, the source has 5% new and 5% deleted files.
+    # The source is not ordered (like find output), the catalog is ordered by path (like the database index).
+    @staticmethod
+    def synthetic_relpath(i):
+        return f"datasets/d{i // 1000:06d}/file-{i:09d}.bin"
+
+    @classmethod
+    def synthetic_source(cls, count, base_dir):
+        step = 7919 if count % 7919 else 7927
+        for n in range(count):
+            i = (n * step) % count + count // 20
+            yield f"{base_dir}/{cls.synthetic_relpath(i)}", 1048576, 1600000000
+
+    @classmethod
+    def synthetic_catalog(cls, count):
+        for i in range(count):
+            yield cls.synthetic_relpath(i), 1048576, None
+
+    @classmethod
+    def diff_set_based(cls, count, base_dir):
+        # Former implementation: lists of full paths and set differences
+        file_list = [path for path, size, mtime in cls.synthetic_source(count, base_dir)]
+        db_file_list = [f"{base_dir}/{path}" for path, size, mtime in cls.synthetic_catalog(count)]
+        new_files = list(set(file_list) - set(db_file_list))
+        deleted_files = list(set(db_file_list) - set(file_list))
+        return len(new_files), len(deleted_files)
+
+    @classmethod
+    def diff_events(cls, count, base_dir, mode, run_size):
+        source = ((path[len(base_dir) + 1:], path, size, mtime) for path, size, mtime in cls.synthetic_source(count, base_dir))
+        if mode == 'memory':
+            events = diff.set_diff(source, cls.synthetic_catalog(count))
+        else:
+            events = diff.sorted_merge_diff(source, cls.synthetic_catalog(count), run_size)
+        new_count = 0
+        deleted_count = 0
+        for event in events:
+            if event[0] == diff.NEW:
+                new_count += 1
+            elif event[0] == diff.DELETED:
+                deleted_count += 1
+        return new_count, deleted_count
+
+    def diff(self, count):
+        """
+        Compare time and peak memory (RSS) of the catalog diff implementations
+        :param count: number of files in the synthetic catalog
+        """
+        base_dir = "/mnt/buttervolume/volumes/bigDataStorage"
+        run_size = self.config.get('catalog-diff-run-size', 1000000)
+        runs = [
+            ("set (former)", self.diff_set_based, (count, base_dir)),
+            ("memory", self.diff_events, (count, base_dir, 'memory', run_size)),
+            (f"merge (run size {run_size})", self.diff_events, (count, base_dir, 'merge', run_size)),
+        ]
+
+        table = []
+        for name, target, args in runs:
+            logger.info(f"Running diff benchmark '{name}' with {count} catalog entries")
+            (new_count, deleted_count), seconds, rss_peak, rss_start = self.run_measured(target, *args)
+            table.append([name, new_count, deleted_count, f"{seconds:.2f}",
+                          self.tools.convert_size(rss_peak), self.tools.convert_size(rss_peak - rss_start)])
+            if self.interrupted:
+                break
+
+        print(tabulate(table, headers=['Approach', 'New', 'Deleted', 'Seconds', 'Peak RSS', 'Peak RSS Increase'],
+                       tablefmt='grid'))
+
+    @staticmethod
+    def md5sum_small_reads(filename):
+        # Former implementation: 4 KiB reads
+        d = hashlib.md5()
+        with open(filename, mode='rb') as f:
+            for buf in iter(lambda: f.read(4096), b''):
+                d.update(buf)
+        return d.hexdigest()
+
+    def hash(self, size, directory=None):
+        """
+        Measure the hashing throughput per algorithm with a test file
+        The test file is in the page cache after writing it, use a size larger than the RAM to measure the disk
+        :param size: size of the test file in bytes
+        :param directory: directory of the test file, Default: local-data-dir
+        """
+        directory = directory or self.config['local-data-dir']
+        fd, filename = tempfile.mkstemp(prefix='tapebackup-hash-benchmark-', dir=directory)
+        try:
+            logger.info(f"Writing test file {filename} ({self.tools.convert_size(size)})")
+            with os.fdopen(fd, 'wb') as f:
+                chunk = os.urandom(hashing.BUFFER_SIZE)
+                for offset in range(0, size, len(chunk)):
+                    f.write(chunk[:size - offset])
+
+            runs = [("md5 (former, 4 KiB reads)", lambda: self.md5sum_small_reads(filename))]
+            for algorithm in hashing.ALGORITHMS:
+                runs.append((f"{algorithm} (readinto)", lambda a=algorithm: hashing.hash_file(filename, a)))
+                runs.append((f"{algorithm} (mmap)", lambda a=algorithm: hashing.hash_file(filename, a, use_mmap=True)))
+
+            table = []
+            for name, target in runs:
+                if self.interrupted:
+                    break
+                try:
+                    time_started = time.time()
+                    target()
+                    seconds = time.time() - time_started
+                except ImportError as e:
+                    table.append([name, f"not available: {e}", ""])
+                    continue
+                logger.info(f"Hash benchmark '{name}': {seconds:.2f} seconds")
+                table.append([name, f"{seconds:.2f}", f"{size / seconds / 1000 ** 3:.2f}"])
+
+            print(tabulate(table, headers=['Algorithm', 'Seconds', 'GB/s'], tablefmt='grid'))
+        finally:
+            os.remove(filename)
@@ -2,15 +2,17 @@ import datetime
 import logging
 import os
 import time
-import shutil
+from tabulate import tabulate
 from tapebackup.lib import database
 from tapebackup.lib import Migrate
+from tapebackup.lib import File, Tape
 logger = logging.getLogger()
 
 
 class Db:
     def __init__(self, config, engine, tapelibrary, tools, local=False):
         self.config = config
+        self.engine = engine
         self.session = database.create_session(engine)
         self.tapelibrary = tapelibrary
         self.tools = tools
@@ -23,12 +25,18 @@ class Db:
     def repair(self):
         broken_d = database.get_broken_db_download_entry(self.session)
         for file in broken_d:
+            # Interrupted 'get --encrypt'
+            if file.filename_encrypted is not None \
+                    and os.path.isfile(f"{self.config['local-enc-dir']}/{file.filename_encrypted}"):
+                self.tools.storage.release(os.path.getsize(f"{self.config['local-enc-dir']}/{file.filename_encrypted}"))
+                os.remove(f"{self.config['local-enc-dir']}/{file.filename_encrypted}")
             logger.info("Fixing Database ID: {}".format(file.id))
             database.delete_broken_file(self.session, file)
 
         broken_p = database.get_broken_db_encrypt_entry(self.session)
         for file in broken_p:
             if os.path.isfile(f"{self.config['local-enc-dir']}/{file.filename_encrypted}"):
+                self.tools.storage.release(os.path.getsize(f"{self.config['local-enc-dir']}/{file.filename_encrypted}"))
                 os.remove(f"{self.config['local-enc-dir']}/{file.filename_encrypted}")
 
             logger.info(f"Fixing Database ID: {file.id}")
@@ -253,10 +261,58 @@ class Db:
         logger.info(f"Restore job maps count: Old DB: {migrate.count_old_restore_job_maps()} | New DB: {migrate.count_new_restore_job_maps()}")
 
         old = f"old-{int(time.time())}-{self.config['database']}"
-        shutil.copy2(self.config['database'], old)
-        shutil.copy2(f"migrate-new-{self.config['database']}", self.config['database'])
+        database.copy_database(self.config['database'], old)
+        database.copy_database(f"migrate-new-{self.config['database']}", self.config['database'])
         logger.info(f"New database '{self.config['database']}' build successful, backup of old database: {old}.")
 
+    def hot_queries(self):
+        """
+        Queries which run for (nearly) every file, used to compare timings before and after an upgrade
+        Only columns of the first database version are selected, the timings before the upgrade run on the old schema.
+        :return: list of tuples (name, function)
+        """
+        def files():
+            return self.session.query(File.id, File.path)
+        return [
+            ("md5sum lookup (get)", lambda: files().filter(File.md5sum_file == '-').first()),
+            ("duplicates of file", lambda: files().filter(File.duplicate_id.isnot(None)).all()),
+            ("files on tape", lambda: files().join(Tape, File.tape_id == Tape.id).filter(Tape.label == '').all()),
+            ("files to be encrypted", lambda: files().filter(File.downloaded.is_(True),
+                                                             File.encrypted.is_(False)).all()),
+            ("files to be written", lambda: files().filter(File.downloaded.is_(True), File.encrypted.is_(True),
+                                                           File.written.is_(False)).order_by(File.path).all()),
+            ("not deleted files (first chunk)", lambda: next(database.iter_not_deleted_files(self.session), None)),
+        ]
+
+    def time_hot_queries(self):
+        timings = []
+        for name, query in self.hot_queries():
+            time_started = time.time()
+            query()
+            timings.append(time.time() - time_started)
+            self.session.expunge_all()
+        return timings
+
+    def upgrade(self, db_version):
+        """
+        Upgrade the database schema to the current model version, prints timings of the hot queries before and after
+        :param db_version: model version of the program
+        :return:
+        """
+        logger.info("Starting upgrade of database")
+        old = f"old-{int(time.time())}-{self.config['database']}"
+        database.copy_database(self.config['database'], old)
+        logger.info(f"Backup of database: {old}")
+
+        before = self.time_hot_queries()
+        if not database.upgrade(self.engine, db_version):
+            return
+        after = self.time_hot_queries()
+
+        table = [[name, f"{b:.4f}", f"{a:.4f}"] for (name, query), b, a in zip(self.hot_queries(), before, after)]
+        print(tabulate(table, headers=['Query', 'Before (s)', 'After (s)'], tablefmt='grid'))
+        logger.info(f"Database upgraded to version {db_version}")
+
     def backup(self):
         print("NOT IMPLEMENTED YET!")
         # TODO: Need Rework
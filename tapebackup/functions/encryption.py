@@ -1,16 +1,35 @@
 import logging
 import datetime
+import multiprocessing
 import subprocess
 import os
 import sys
-import time
 import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from tapebackup.lib import crypto
 from tapebackup.lib import database
+from tapebackup.lib import Scheduler, CatalogWriter
 from pathlib import Path
 
 logger = logging.getLogger()
 
 
+class CountingReader:
+    """
+    Binary stream wrapper which counts the bytes read
+    """
+    def __init__(self, reader):
+        self.reader = reader
+        self.count = 0
+
+    def readinto(self, buffer):
+        n = self.reader.readinto(buffer)
+        self.count += n or 0
+        return n
+
+
 class Encryption:
     def __init__(self, config, engine, tapelibrary, tools, local=False):
         self.config = config
@@ -20,53 +39,159 @@ class Encryption:
         self.tools = tools
         self.local_files = local
         self.interrupted = False
-        self.active_threads = []
+        self.catalog = CatalogWriter(engine, config.get('catalog-commit-rows', 1000),
+                                     config.get('catalog-commit-ms', 500) / 1000)
+        self.backend = config.get('encryption-backend', 'native')
+        self.format = int(config.get('encryption-format', 1))
+        if self.format == 2 and self.backend == 'openssl':
+            logger.warning("encryption-format 2 is not supported by openssl, using encryption-backend 'native'")
+            self.backend = 'native'
+        self.master_keys = crypto.MasterKeys(config['enc-key'])
+        self.master_salt = None
+        # Files from this size on are encrypted in the chunked format (v3) by a process pool
+        self.chunked_threshold = None
+        if config.get('encryption-chunked-threshold') not in ('', None):
+            self.chunked_threshold = tools.back_convert_size(str(config['encryption-chunked-threshold']))
+        self.processes = int(config.get('encryption-processes') or 0) or os.cpu_count()
+        # Format v1 files from this size on are decrypted by the process pool
+        self.decrypt_parallel_threshold = None
+        if config.get('decrypt-parallel-threshold') not in ('', None):
+            self.decrypt_parallel_threshold = tools.back_convert_size(str(config['decrypt-parallel-threshold']))
+        self.pool = None
+        self.pool_lock = threading.Lock()
 
     def set_interrupted(self):
         self.interrupted = True
 
-    def encrypt_single_file_thread(self, threadnr, id, filepath, filename_enc):
-        thread_session = database.create_session(self.engine)
-        file = database.update_filename_enc(thread_session, id, filename_enc)
+    def get_pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                logger.debug(f"Starting {self.processes} encryption processes")
+                # The pool is started while other threads run (workers, catalog writer), forked children could
+                # inherit locks held by them
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self.pool = ProcessPoolExecutor(max_workers=self.processes,
+                                                mp_context=multiprocessing.get_context(method))
+            return self.pool
+
+    def shutdown_pool(self):
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def use_chunked(self, filesize):
+        return self.chunked_threshold is not None and filesize is not None and filesize >= self.chunked_threshold
+
+    def encrypt_openssl(self, src, dst, algorithm):
+        """
+        Encrypt with the openssl binary, the encrypted file is read again for the digest
+        :return: tuple (digest of encrypted file, size of encrypted file) or None if failed
+        """
+        command = ['openssl', 'enc', '-aes-256-cbc', '-pbkdf2', '-iter', '100000', '-in', src, '-out', dst, '-k',
+                   self.config['enc-key']]
+        openssl = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
+        if openssl.returncode != 0:
+            logger.warning(f"encrypt file failed, file: {src} error: {openssl.stderr}")
+            return None
 
         time_started = time.time()
-
+        md5 = self.tools.hash_file(dst, algorithm)
+        logger.debug(f"Execution Time: md5sum encrypted file: {time.time() - time_started} seconds")
+        return md5, os.path.getsize(dst)
+
+    def encrypt_native(self, src, dst, algorithm, md5sum_file=None, hash_algorithm_file=None, version=1):
+        """
+        Encrypt in process, plaintext and encrypted file are hashed while encrypting
+        :param version: file format (1: same as openssl, 2: per file subkeys, 3: chunked in the process pool)
+        :return: tuple (digest of encrypted file, size of encrypted file) or None if failed
+        """
+        plain_algorithm = (hash_algorithm_file or 'md5') if md5sum_file else None
+        try:
+            if version == 3:
+                plain_md5, md5, filesize = crypto.encrypt_file_chunked(src, dst, self.master_keys, self.master_salt,
+                                                                       plain_algorithm, algorithm, self.get_pool())
+            elif version == 2:
+                plain_md5, md5, filesize = crypto.encrypt_file_v2(src, dst, self.master_keys, self.master_salt,
+                                                                  plain_algorithm, algorithm)
+            else:
+                plain_md5, md5, filesize = crypto.encrypt_file(src, dst, self.config['enc-key'], plain_algorithm,
+                                                               algorithm)
+        except (OSError, ValueError, BrokenProcessPool) as e:
+            logger.warning(f"encrypt file failed, file: {src} error: {e}")
+            return None
+        if md5sum_file is not None and plain_md5 != md5sum_file:
+            logger.warning(f"File changed since it was downloaded (md5sum differs): {src}")
+        return md5, filesize
+
+    def encrypt_single_file_thread(self, id, filepath, filename_enc, filesize_file=None, md5sum_file=None,
+                                   hash_algorithm_file=None):
+        time_started = time.time()
         if not self.local_files:
-            command = ['openssl', 'enc', '-aes-256-cbc', '-pbkdf2', '-iter', '100000', '-in',
-                       os.path.abspath(f"{self.config['local-data-dir']}/{filepath}"), '-out',
-                       os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}"), '-k',
-                       self.config['enc-key']]
+            src = os.path.abspath(f"{self.config['local-data-dir']}/{filepath}")
         else:
-            command = ['openssl', 'enc', '-aes-256-cbc', '-pbkdf2', '-iter', '100000', '-in',
-                       os.path.abspath(f"{self.config['local-base-dir']}/{filepath}"), '-out',
-                       os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}"), '-k',
-                       self.config['enc-key']]
-        openssl = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
-
-        if openssl.returncode == 0:
-            logger.debug(f"Execution Time: Encrypt file with openssl: {time.time() - time_started} seconds")
+            src = os.path.abspath(f"{self.config['local-base-dir']}/{filepath}")
+        dst = os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}")
+        algorithm = self.tools.hash_algorithm()
+        version = 3 if self.use_chunked(filesize_file) else self.format
 
-            time_started = time.time()
-            md5 = self.tools.md5sum(os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}"))
-            logger.debug(f"Execution Time: md5sum encrypted file: {time.time() - time_started} seconds")
+        if version == 1 and self.backend == 'openssl':
+            result = self.encrypt_openssl(src, dst, algorithm)
+        else:
+            result = self.encrypt_native(src, dst, algorithm, md5sum_file, hash_algorithm_file, version)
+        logger.debug(f"Execution Time: Encrypt file (format {version}, {self.backend}): {time.time() - time_started} "
+                     f"seconds")
 
-            filesize = os.path.getsize(os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}"))
+        if result is not None:
+            md5, filesize = result
             encrypted_date = datetime.datetime.now()
-            database.update_file_after_encrypt(thread_session, file, filesize, encrypted_date, md5)
+            self.catalog.post(id, filesize_encrypted=filesize, encrypted_date=encrypted_date, md5sum_encrypted=md5,
+                              hash_algorithm_encrypted=algorithm, encryption_format=version, encrypted=True)
+            self.tools.storage.add(filesize)
 
             if not self.local_files:
                 time_started = time.time()
                 os.remove(os.path.abspath(f"{self.config['local-data-dir']}/{filepath}"))
+                self.tools.storage.release(filesize_file)
                 logger.debug(f"Execution Time: Remove file after encryption: {time.time() - time_started} seconds")
-        else:
-            logger.warning(f"encrypt file failed, file: {id} error: {openssl.stderr}")
-            logger.debug(f"Execution Time: Encrypt file with openssl: {time.time() - time_started} seconds")
 
-        self.active_threads.remove(threadnr)
-        thread_session.close()
-
-    def encrypt(self):
+    def prepare_keys(self):
+        if self.format == 2 or self.chunked_threshold is not None:
+            # The master key is derived once per run, the salt is created once per database
+            self.master_salt = bytes.fromhex(database.get_or_create_config_value(
+                self.session, 'encryption-salt', lambda: os.urandom(crypto.V2_SALT_SIZE).hex()))
+            self.master_keys.get(self.master_salt)
+        logger.info(f"Using encryption format {self.format} ({self.backend})")
+        if self.chunked_threshold is not None:
+            logger.info(f"Files from {self.tools.convert_size(self.chunked_threshold)} on are encrypted in chunks "
+                        f"by {self.processes} processes")
+
+    def encrypt_stream(self, reader, dst, plain_algorithm, algorithm):
+        """
+        Encrypt a stream (format 1 or 2, the chunked format needs a file), prepare_keys() must be called before
+        :param reader: binary file object, read until its end
+        :param dst: encrypted file or binary file object
+        :return: tuple (plaintext digest, plaintext size, digest of encrypted file, size of encrypted file)
+        :raise OSError, ValueError: encryption failed
+        """
+        counting = CountingReader(reader)
+        if self.format == 2:
+            plain_md5, md5, filesize = crypto.encrypt_file_v2(counting, dst, self.master_keys, self.master_salt,
+                                                              plain_algorithm, algorithm)
+        else:
+            plain_md5, md5, filesize = crypto.encrypt_file(counting, dst, self.config['enc-key'], plain_algorithm,
+                                                           algorithm)
+        return plain_md5, counting.count, md5, filesize
+
+    def encrypt(self, once=False):
+        """
+        Encrypt all files which are downloaded but not encrypted yet, until none is left
+        :param once: Only one pass, files which failed are not tried again (staging of 'write --direct')
+        """
         logger.info("Starting encrypt files job")
+        scheduler = Scheduler('encrypt', self.config['threads']['encrypt'])
+        self.catalog.start()
+        self.prepare_keys()
 
         while True:
             files = database.get_files_to_be_encrypted(self.session)
@@ -77,46 +202,50 @@ class Encryption:
             file_count_total = len(files)
             file_count_current = 0
 
-            for file in files:
-                file_count_current += 1
-                for i in range(0, self.config['threads']['encrypt']):
-                    if i not in self.active_threads:
-                        next_thread = i
+            for start in range(0, file_count_total, self.catalog.max_rows):
+                # Read before the commit below expires the file objects
+                jobs = [(file.id, file.filename, file.path, file.filesize, file.md5sum_file, file.hash_algorithm_file)
+                        for file in files[start:start + self.catalog.max_rows]]
+                # Committed in one transaction before the encrypted files are created, so 'db repair' finds them
+                # after a crash
+                names = database.assign_filenames_encrypted(self.session, [job[0] for job in jobs],
+                                                            self.tools.create_filename_encrypted)
+
+                for id, filename, path, filesize, md5sum_file, hash_algorithm_file in jobs:
+                    file_count_current += 1
+                    logger.info(f"Queueing ({file_count_current}/{file_count_total}, queue depth: "
+                                f"{scheduler.queue_depth()}): id: {id}, filename: {filename}")
+
+                    scheduler.submit(self.encrypt_single_file_thread, id, path, names[id], filesize, md5sum_file,
+                                     hash_algorithm_file)
+
+                    if self.interrupted:
+                        scheduler.cancel_pending()
                         break
 
-                logger.info(f"Starting Thread #{next_thread}, processing ({file_count_current}/{file_count_total}): "
-                            f"id: {file.id}, filename: {file.filename}")
-
-                filename_enc = self.tools.create_filename_encrypted()
-                while database.filename_encrypted_already_used(self.session, filename_enc):
-                    logger.warning(f"Filename ({filename_enc}) encrypted already exists, creating new one!")
-                    filename_enc = self.tools.create_filename_encrypted()
-
-                self.active_threads.append(next_thread)
-                x = threading.Thread(target=self.encrypt_single_file_thread,
-                                     args=(next_thread, file.id, file.path, filename_enc,),
-                                     daemon=True)
-                x.start()
-
-                while threading.active_count() > self.config['threads']['encrypt']:
-                    time.sleep(0.2)
-
                 if self.interrupted:
-                    while threading.active_count() > 1:
-                        time.sleep(1)
                     break
 
-            if self.interrupted:
-                while threading.active_count() > 1:
-                    time.sleep(1)
+            ## Multithreading fix: Wait for all jobs to finish, otherwise one file get encrypted twice!
+            scheduler.join()
+            # Encrypted files must be committed before the next query
+            self.catalog.flush()
+            scheduler.log_stats(logging.DEBUG)
+
+            if self.interrupted or once:
                 break
 
-            ## Multithreading fix: Wait for all threads to finish, otherwise one file get encrypted twice!
-            while threading.active_count() > 1:
-                time.sleep(1)
+        scheduler.shutdown()
+        self.catalog.close()
+        self.shutdown_pool()
 
     # src relative to tape, dst relative to restore-dir
     def decrypt_relative(self, src, dst, mkdir=False):
+        src_path, dst_path = self.resolve_relative(src, dst, mkdir)
+        return self.decrypt(src_path, dst_path)
+
+    # src relative to tape, dst relative to restore-dir, returns absolute paths
+    def resolve_relative(self, src, dst, mkdir=False):
         if 'restore-dir' not in self.config:
             logging.error('"restore-dir" not configured')
             sys.exit(1)
@@ -132,7 +261,31 @@ class Encryption:
         if mkdir:
             dst_path.parent.mkdir(parents=True, exist_ok=True)
 
-        return self.decrypt(src_path.resolve(), dst_path.resolve())
+        return src_path.resolve(), dst_path.resolve()
+
+    def decrypt_range(self, src, dst, offset, length):
+        """
+        Decrypt only a byte range of the plaintext, just the needed blocks are read from src
+        :return: number of bytes written or None if failed
+        """
+        if not isinstance(dst, Path):
+            dst = Path(dst)
+        if dst.is_file():
+            logger.error(f'File {dst} already exists, skipping decrypt')
+            return None
+
+        time_started = time.time()
+        try:
+            with open(dst, 'wb') as writer:
+                written = crypto.decrypt_range(str(src), writer, offset, length, self.config['enc-key'],
+                                               self.master_keys)
+        except (OSError, ValueError) as e:
+            logging.error(f'Decryption failed: {e}')
+            if dst.is_file():
+                dst.unlink()
+            return None
+        logger.debug(f"Execution Time: Decrypt range: {time.time() - time_started} seconds")
+        return written
 
     def decrypt(self, src, dst):
         if not isinstance(dst, Path):
@@ -141,6 +294,38 @@ class Encryption:
             logger.error(f'File {dst} already exists, skipping decrypt')
             return True
 
+        try:
+            version = crypto.file_format(src)
+            size = os.path.getsize(src)
+        except (OSError, ValueError):
+            # Reported by the decryption below
+            version, size = 1, 0
+
+        if version == 1 and self.decrypt_parallel_threshold is not None and size >= self.decrypt_parallel_threshold:
+            time_started = time.time()
+            try:
+                crypto.decrypt_file_parallel(str(src), str(dst), self.config['enc-key'], executor=self.get_pool(),
+                                             max_pending=2 * self.processes)
+                logger.debug(f"Execution Time: Decrypt file in parallel ({self.processes} processes): "
+                             f"{time.time() - time_started} seconds")
+                return True
+            except (OSError, ValueError, BrokenProcessPool) as e:
+                logging.error(f'Decryption failed: {e}')
+                if dst.is_file():
+                    dst.unlink()
+                return False
+
+        if self.backend != 'openssl' or version != 1:
+            try:
+                crypto.decrypt_any(str(src), str(dst), self.config['enc-key'], self.master_keys,
+                                   executor=self.get_pool() if version == 3 else None)
+                return True
+            except (OSError, ValueError, BrokenProcessPool) as e:
+                logging.error(f'Decryption failed: {e}')
+                if dst.is_file():
+                    dst.unlink()
+                return False
+
         openssl = [
             'openssl', 'enc', '-d', '-aes-256-cbc', '-pbkdf2', '-iter', '100000',
             '-in', str(src), '-out', str(dst), '-k', self.config['enc-key']
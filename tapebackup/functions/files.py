@@ -2,13 +2,16 @@ import datetime
 import logging
 import time
 import os
-import sys
+import shlex
 import subprocess
+import tempfile
 import threading
 from tabulate import tabulate
 from tapebackup.lib import database
-from tapebackup.lib import Tools
+from tapebackup.lib import diff
+from tapebackup.lib import Tools, Scheduler, SshTransport, Lister, CatalogWriter
 from tapebackup.lib import File, Tape, RestoreJob, RestoreJobFileMap
+from functions.encryption import Encryption
 
 logger = logging.getLogger()
 
@@ -26,60 +29,248 @@ class Files:
         self.skipped_count = 0
         self.failed_count = 0
         self.deleted_count = 0
-        self.active_threads = []
+        self.changed_count = 0
+        self.queued_bytes = 0
+        self.downloaded_bytes = 0
+        self.batch = False
+        self.batch_max_files = 1000
+        self.batch_max_size = 0
+        self.current_batch = []
+        self.current_batch_size = 0
+        self.transport = None if local else SshTransport(config)
+        self.catalog = CatalogWriter(engine, config.get('catalog-commit-rows', 1000),
+                                     config.get('catalog-commit-ms', 500) / 1000)
+        # Digests (algorithm, digest) downloaded in this run, updates are not committed immediately (see CatalogWriter)
+        self.md5_index = {}
+        self.md5_lock = threading.Lock()
+        # Set by 'get --encrypt': files are encrypted while they are downloaded
+        self.encryption = None
 
     def set_interrupted(self):
         self.interrupted = True
 
-    def get_remote_filelist(self):
-        return_list = []
-        count = 0
+    def get_filelist(self, lister, given_file=None, newer_than=None):
+        """
+        Choose the file list source
+        :param lister: Lister object
+        :param given_file: Filename to read list of files from, otherwise it will be retrieved via find
+        :param newer_than: unix timestamp, only list files changed after it (incremental scan)
+        :return: tuple of generator of RemoteFile, data directory and base directory
+        """
+        if given_file is not None:
+            logger.info(f"Taking filelist from given file {given_file}")
+            return lister.from_file(given_file), self.config['remote-data-dir'], self.config['remote-base-dir']
+        elif self.local_files:
+            logger.info(f"Retrieving file list from server LOCAL directory "
+                        f"{os.path.abspath(self.config['local-data-dir'])}")
+            return lister.local(os.path.abspath(self.config['local-data-dir']), newer_than), \
+                self.config['local-data-dir'], self.config['local-base-dir']
+        else:
+            return lister.remote(self.config['remote-data-dir'], newer_than), self.config['remote-data-dir'], \
+                self.config['remote-base-dir']
+
+    def scan_source(self):
+        """
+        :return: name of the scanned source, used as key for the scan watermark in the config table
+        """
+        if self.local_files:
+            return f"local:{os.path.abspath(self.config['local-data-dir'])}"
+        return f"{self.config['remote-server']}:{self.config['remote-data-dir']}"
+
+    def choose_scan(self, full=False):
+        """
+        Decide between a full and an incremental scan
+        A full scan is done if forced, no watermark exists or the last full scan is older than 'full-scan-interval'
+        days. 'full-scan-interval: 0' or a missing option disables incremental scans (config.yml ships 7 days).
+        :param full: Force full scan
+        :return: unix timestamp of the watermark for an incremental scan, None for a full scan
+        """
+        source = self.scan_source()
+        interval = float(self.config.get('full-scan-interval') or 0) * 86400
+        watermark = database.get_config_value(self.session, f"scan-watermark:{source}")
+        last_full_scan = database.get_config_value(self.session, f"scan-full:{source}")
+
+        if full:
+            logger.info("Full scan forced")
+        elif interval <= 0:
+            logger.debug("Incremental scans disabled ('full-scan-interval' is 0)")
+        elif watermark is None or last_full_scan is None:
+            logger.info(f"No scan watermark found for {source}, doing a full scan")
+        elif time.time() - float(last_full_scan) >= interval:
+            logger.info(f"Last full scan of {source} is older than {interval / 86400} days, doing a full scan "
+                        f"to detect deleted files")
+        else:
+            logger.info(f"Incremental scan of {source}: files changed after "
+                        f"{datetime.datetime.fromtimestamp(float(watermark))}")
+            return float(watermark)
+        return None
+
+    def scan_time(self, lister):
+        """
+        :return: current unix time of the scanned source, files are compared with its clock
+        """
+        if self.local_files:
+            return time.time()
+        return lister.remote_time()
+
+    def log_progress(self, scheduler, listed_count, new_count, time_started):
+        elapsed = max(time.time() - time_started, 0.000001)
+        rate = self.downloaded_bytes / elapsed
+        remaining = max(self.queued_bytes - self.downloaded_bytes, 0)
+        eta = f"{int(remaining / rate)} seconds" if rate > 0 else "unknown"
+        logger.info(f"Listed: {listed_count}, new: {new_count}, queued: {self.tools.convert_size(self.queued_bytes)}, "
+                    f"downloaded: {self.tools.convert_size(self.downloaded_bytes)} "
+                    f"({self.tools.convert_size(rate)}/s), ETA of queued files: {eta}")
+        scheduler.log_stats(logging.DEBUG)
+
+    def find_duplicate(self, session, file_id, md5, algorithm):
+        """
+        :return: id of a file with the same digest (in database or downloaded in this run), None if it is unique
+        """
+        file_dup = database.get_file_by_md5(session, md5, algorithm)
+        if file_dup is not None:
+            return file_dup.id
+        with self.md5_lock:
+            dup_id = self.md5_index.setdefault((algorithm, md5), file_id)
+        return None if dup_id == file_id else dup_id
+
+    def process_downloaded_file(self, session, file, reserved=0):
+        """
+        Build md5sum and mtime of a downloaded (or local) file and store it into database
+        :param session: orm session
+        :param file: file object
+        :param reserved: bytes reserved in the storage budget for the download
+        :return:
+        """
         time_started = time.time()
+        if self.local_files:
+            local_path = os.path.abspath(f"{self.config['local-base-dir']}/{file.path}")
+        else:
+            local_path = os.path.abspath(f"{self.config['local-data-dir']}/{file.path}")
+        mtime = datetime.datetime.fromtimestamp(int(os.path.getmtime(local_path)))
+        algorithm = self.tools.hash_algorithm()
+        md5 = self.tools.hash_file(local_path, algorithm)
+        filesize = os.path.getsize(local_path)
 
-        logger.info(f"Retrieving file list from server {self.config['remote-server']} directory {self.config['remote-data-dir']}")
-        commands = ['ssh', f'-p {self.config["remote-port"]}', self.config['remote-server'], f"find \"{self.config['remote-data-dir']}\" -type f"]
-        process = subprocess.Popen(commands, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        while True:
-            output = process.stdout.readline().strip().decode("UTF-8")
-            if output == '' and process.poll() is not None:
-                break
-            if output:
-                count += 1
-                return_list.append(output)
-                if count % 10000 == 0:
-                    logger.info(f"Entries found until now: {count}")
-        rc = process.poll()
-
-        if rc != 0:
-            logger.error(f"Failed to retrieve filelist from remote server, error: {process.stderr}")
-            logger.debug(f"Execution Time: Building filelist: {time.time() - time_started} seconds")
-            sys.exit(1)
+        logger.debug(f"Execution Time: Building md5sum and mtime: {time.time() - time_started} seconds")
+
+        self.downloaded_bytes += filesize
+        if not self.local_files:
+            self.tools.storage.add(filesize - reserved)
+        downloaded_date = datetime.datetime.now()
+        dup_id = self.find_duplicate(session, file.id, md5, algorithm)
+        if dup_id is None:
+            self.catalog.post(file.id, filesize=filesize, mtime=mtime, downloaded_date=downloaded_date,
+                              md5sum_file=md5, hash_algorithm_file=algorithm, downloaded=True)
+            self.downloaded_count += 1
+            logger.debug("Download finished: {}".format(file.path))
         else:
-            logger.info(f"Got file list from server {self.config['remote-server']} directory '{self.config['remote-data-dir']}'")
-            logger.info(f"Entries found: {count}")
-            logger.debug(f"Execution Time: Building filelist: {time.time() - time_started} seconds")
-            return return_list
+            logger.info(f"File downloaded with another name. Storing filename in Database: {file.filename}")
+            self.catalog.post(file.id, duplicate_id=dup_id, mtime=mtime, downloaded_date=downloaded_date)
+            if not self.local_files:
+                time_started = time.time()
+                os.remove(local_path)
+                self.tools.storage.release(filesize)
+                logger.debug(f"Execution Time: Remove duplicate file: {time.time() - time_started} seconds")
+            self.skipped_count += 1
+
+    @staticmethod
+    def file_changed(source_entry, catalog_entry):
+        """
+        Compare size and mtime of the listed file with the catalog, unknown values count as unchanged
+        :param source_entry: tuple (relative path, full path, size, mtime as unix timestamp)
+        :param catalog_entry: tuple (path, filesize, mtime as datetime)
+        :return: True if the file was modified since it was downloaded
+        """
+        relpath, fullpath, size, mtime = source_entry
+        path, filesize, db_mtime = catalog_entry
+        # Duplicates have no filesize, only the mtime is stored for them
+        if size is not None and filesize is not None and size != filesize:
+            return True
+        if mtime is not None and db_mtime is not None and int(mtime) != int(db_mtime.timestamp()):
+            return True
+        return False
+
+    @staticmethod
+    def file_pending(catalog_entry):
+        """
+        Entries are inserted before their download is queued, an interrupted run leaves them without size and mtime
+        (downloaded entries and duplicates always have a mtime)
+        :param catalog_entry: tuple (path, filesize, mtime as datetime)
+        :return: True if the file was never downloaded
+        """
+        path, filesize, db_mtime = catalog_entry
+        return filesize is None and db_mtime is None
 
-    def get_remote_filelist_fom_file(self, file):
-        with open(file) as f:
-            lines = f.read().splitlines()
-        return lines
+    def version_changed_file(self, relpath):
+        """
+        Free the path of a modified file for the new version
+        Entries which are encrypted, duplicates or referenced by other entries are kept as old version
+        ('path.~N~', see database.version_file), everything else only exists in the local staging area and will be
+        overwritten by the download, so it gets removed
+        :param relpath: relative file path
+        :return: Nothing
+        """
+        file = database.file_exists_by_path(self.session, relpath)
+        if file is None:
+            return
+        if not file.encrypted and file.duplicate_id is None and not database.file_is_referenced(self.session, file):
+            logger.info(f"File changed, removing not yet encrypted entry: ID: {file.id}, filepath: {relpath}")
+            database.delete_broken_file(self.session, file)
+            staged_path = os.path.abspath(f"{self.config['local-data-dir']}/{relpath}")
+            if not self.local_files and os.path.isfile(staged_path):
+                # Overwritten by the download
+                self.tools.storage.release(os.path.getsize(staged_path))
+            return
+
+        staged_path = os.path.abspath(f"{self.config['local-data-dir']}/{relpath}")
+        # Content of the old version is still needed for encryption: move it out of the way of the download
+        keep_downloaded = file.encrypted or file.duplicate_id is not None
+        if not keep_downloaded and not self.local_files and os.path.isfile(staged_path):
+            keep_downloaded = True
+        version_path = database.version_file(self.session, file, keep_downloaded)
+        if not file.encrypted and file.duplicate_id is None:
+            if keep_downloaded:
+                os.rename(staged_path, os.path.abspath(f"{self.config['local-data-dir']}/{version_path}"))
+            else:
+                logger.warning(f"Content of old version not available anymore, it won't be encrypted: ID: {file.id}, "
+                               f"filepath: {version_path}")
+        logger.info(f"File changed, keeping old version: ID: {file.id}, filepath: {version_path}")
 
-    def get_thread(self, threadnr, relpath, fullpath):
+    def move_versions(self, relpaths):
         """
-        Thread which will download and insert file into database
-        :param threadnr: thread number
+        Rename old versions ('path.~N~') which use the path of a new file to the next free version
+        :param relpaths: relative paths which are used by deleted entries
+        :return: count of moved versions
+        """
+        moved = 0
+        for relpath in relpaths:
+            file, original_path = database.get_version_by_path(self.session, relpath)
+            if file is None:
+                continue
+            version_path = database.next_version_path(self.session, original_path, taken=set(relpaths))
+            staged_path = os.path.abspath(f"{self.config['local-data-dir']}/{relpath}")
+            if not self.local_files and not file.encrypted and os.path.isfile(staged_path):
+                # Still waiting for encryption, the download of the new file would overwrite it
+                os.rename(staged_path, os.path.abspath(f"{self.config['local-data-dir']}/{version_path}"))
+            database.rename_file(self.session, file, version_path)
+            logger.info(f"Old version uses the path of a new file, renamed: ID: {file.id}, filepath: {version_path}")
+            moved += 1
+        return moved
+
+    def get_thread(self, file_id, relpath, fullpath, reserved=0):
+        """
+        Job which will download a file and update it in database, runs in a worker of the 'get' scheduler
+        :param file_id: id of the file entry, inserted by insert_new_files
         :param relpath: relative file path
         :param fullpath: absolut filepath on the remote server (Or local absolut filepath)
+        :param reserved: bytes reserved in the storage budget for the download
         :return:
         """
         downloaded = False
-        filename = self.tools.strip_path(fullpath)
         directory = self.tools.strip_filename(relpath)
         thread_session = database.create_session(self.engine)
-
-        file = database.insert_file(thread_session, filename, relpath)
-        logger.debug("Inserting file into database. Fileid: {}".format(file.id))
+        file = database.get_file_by_id(thread_session, file_id)
 
         if not self.local_files:
             try:
@@ -87,135 +278,409 @@ class Files:
             except OSError as e:
                 logger.error(f"Failed to create local folder ({self.config['local-data-dir']}/{directory}), exiting: {e.errno}: {e.strerror}")
                 self.interrupted = True
+                self.tools.storage.release(reserved)
                 return False
 
             time_started = time.time()
-            command = ['rsync', '--protect-args', '-ae', 'ssh', f'-p {self.config["remote-port"]}', f"{self.config['remote-server']}:{fullpath}",
-                       f"{self.config['local-data-dir']}/{directory}"]
+            self.transport.ensure()
+            command = ['rsync', '--protect-args', '-a', '-e', self.transport.rsync_shell(),
+                       self.transport.remote_path(fullpath), f"{self.config['local-data-dir']}/{directory}"]
             rsync = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
             if rsync.returncode == 0:
                 downloaded = True
             else:
                 logger.warning("Download failed, file: {} error: {}".format(file.path, rsync.stderr))
                 self.failed_count += 1
+                self.tools.storage.release(reserved)
+                if rsync.returncode == 255:
+                    # ssh failed, check the master connection before the next transfer
+                    self.transport.ensure(force=True)
             logger.debug(f"Execution Time: Downloading file: {time.time() - time_started} seconds")
 
         if self.local_files or downloaded:
-            time_started = time.time()
-            if self.local_files:
-                mtime = datetime.datetime.fromtimestamp(int(os.path.getmtime(os.path.abspath(f"{self.config['local-base-dir']}/{file.path}"))))
-                md5 = self.tools.md5sum(os.path.abspath(f"{self.config['local-base-dir']}/{file.path}"))
-                filesize = os.path.getsize(os.path.abspath(f"{self.config['local-base-dir']}/{file.path}"))
-            else:
-                mtime = datetime.datetime.fromtimestamp(int(os.path.getmtime(os.path.abspath(f"{self.config['local-data-dir']}/{file.path}"))))
-                md5 = self.tools.md5sum(os.path.abspath(f"{self.config['local-data-dir']}/{file.path}"))
-                filesize = os.path.getsize(os.path.abspath(f"{self.config['local-data-dir']}/{file.path}"))
+            self.process_downloaded_file(thread_session, file, reserved)
+
+        thread_session.close()
 
-            logger.debug(f"Execution Time: Building md5sum and mtime: {time.time() - time_started} seconds")
+    def open_stream(self, relpath, fullpath):
+        """
+        Open the source file for streaming, remote files are read with 'cat' over the ssh transport
+        :return: tuple (binary reader, mtime as unix timestamp, size, process or None)
+        """
+        if self.local_files:
+            reader = open(os.path.abspath(f"{self.config['local-base-dir']}/{relpath}"), 'rb', buffering=0)
+            stat = os.fstat(reader.fileno())
+            return reader, int(stat.st_mtime), stat.st_size, None
+
+        self.transport.ensure()
+        # One round trip: first line is mtime and size, followed by the content
+        path = shlex.quote(fullpath)
+        command = self.transport.command(f"stat -c '%Y %s' -- {path} && exec cat -- {path}")
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
+        try:
+            mtime, size = process.stdout.readline().split()
+            return process.stdout, int(mtime), int(size), process
+        except ValueError:
+            process.kill()
+            process.wait()
+            raise OSError(f"reading remote file failed: {process.stderr.read().decode('utf-8', 'replace').strip()}")
+
+    def get_encrypt_thread(self, file_id, relpath, fullpath, filename_enc, reserved=0):
+        """
+        Job which will stream a file through hashing and encryption into 'local-enc-dir' (get --encrypt), the
+        plaintext is never written to local disk. Runs in a worker of the 'get' scheduler
+        :param file_id: id of the file entry, inserted by insert_new_files
+        :param relpath: relative file path
+        :param fullpath: absolut filepath on the remote server (Or local absolut filepath)
+        :param filename_enc: encrypted filename, already committed by insert_new_files
+        :param reserved: bytes reserved in the storage budget for the download
+        :return:
+        """
+        thread_session = database.create_session(self.engine)
+        file = database.get_file_by_id(thread_session, file_id)
+        dst = os.path.abspath(f"{self.config['local-enc-dir']}/{filename_enc}")
+        algorithm = self.tools.hash_algorithm()
 
-            downloaded_date = datetime.datetime.now()
-            file_dup = database.get_file_by_md5(thread_session, md5)
-            if file_dup is None:
-                database.update_file_after_download(thread_session, file, filesize, mtime, downloaded_date, md5)
+        time_started = time.time()
+        process = None
+        result = None
+        try:
+            reader, mtime, size, process = self.open_stream(relpath, fullpath)
+            with reader:
+                plain_md5, filesize, md5, filesize_encrypted = self.encryption.encrypt_stream(reader, dst, algorithm,
+                                                                                              algorithm)
+            if process is not None and process.wait() != 0:
+                raise OSError(f"reading remote file failed: {process.stderr.read().decode('utf-8', 'replace').strip()}")
+            if filesize != size:
+                raise OSError(f"file changed while reading ({size} bytes expected, {filesize} read)")
+            result = plain_md5, filesize, md5, filesize_encrypted, mtime
+        except (OSError, ValueError) as e:
+            logger.warning(f"Download and encrypt failed, file: {file.path} error: {e}")
+            if process is not None:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                if process.returncode == 255:
+                    # ssh failed, check the master connection before the next transfer
+                    self.transport.ensure(force=True)
+            if os.path.isfile(dst):
+                os.remove(dst)
+            self.failed_count += 1
+            self.tools.storage.release(reserved)
+        logger.debug(f"Execution Time: Download and encrypt file: {time.time() - time_started} seconds")
+
+        if result is not None:
+            plain_md5, filesize, md5, filesize_encrypted, mtime = result
+            now = datetime.datetime.now()
+            mtime = datetime.datetime.fromtimestamp(mtime)
+            self.downloaded_bytes += filesize
+            dup_id = self.find_duplicate(thread_session, file.id, plain_md5, algorithm)
+            if dup_id is None:
+                self.catalog.post(file.id, filesize=filesize, mtime=mtime, downloaded_date=now, md5sum_file=plain_md5,
+                                  hash_algorithm_file=algorithm, downloaded=True, filename_encrypted=filename_enc,
+                                  filesize_encrypted=filesize_encrypted, encrypted_date=now, md5sum_encrypted=md5,
+                                  hash_algorithm_encrypted=algorithm, encryption_format=self.encryption.format,
+                                  encrypted=True)
+                self.tools.storage.add(filesize_encrypted - reserved)
                 self.downloaded_count += 1
-                logger.debug("Download finished: {}".format(file.path))
+                logger.debug(f"Download and encryption finished: {file.path}")
             else:
                 logger.info(f"File downloaded with another name. Storing filename in Database: {file.filename}")
-                database.update_duplicate_file_after_download(thread_session, file, file_dup, mtime, downloaded_date)
-                if not self.local_files:
-                    time_started = time.time()
-                    os.remove(os.path.abspath("{}/{}".format(self.config['local-data-dir'], file.path)))
-                    logger.debug(f"Execution Time: Remove duplicate file: {time.time() - time_started} seconds")
+                # The encrypted file is removed, the duplicate keeps no reference to it
+                self.catalog.post(file.id, duplicate_id=dup_id, mtime=mtime, downloaded_date=now,
+                                  filename_encrypted=None)
+                os.remove(dst)
+                self.tools.storage.release(reserved)
                 self.skipped_count += 1
 
-        self.active_threads.remove(threadnr)
         thread_session.close()
 
-    def get(self, given_file=None):
+    def get_batch_thread(self, batch, base_dir):
         """
-        Get files from remote server or add local files into database
-        :param given_file: Filename to read list of files from, otherwise it will be retrieved via find
-        :return: Nothing
+        Job which will download a batch of files with one rsync call (--files-from) and update them in database,
+        runs in a worker of the 'get' scheduler
+        :param batch: list of tuples (file id, relative file path, bytes reserved in the storage budget)
+        :param base_dir: remote directory the relative paths are relative to
+        :return:
         """
-        if given_file is not None:
-            logger.info(f"Taking filelist from given file {given_file}")
-            file_list = self.get_remote_filelist_fom_file(given_file)
-            data_dir = self.config['remote-data-dir']
-            base_dir = self.config['remote-base-dir']
-        else:
-            if self.local_files:
-                logger.info(f"Retrieving file list from server LOCAL directory "
-                            f"{os.path.abspath(self.config['local-data-dir'])}")
-                file_list = self.tools.ls_recursive(os.path.abspath(self.config['local-data-dir']))
-                data_dir = self.config['local-data-dir']
-                base_dir = self.config['local-base-dir']
+        thread_session = database.create_session(self.engine)
+
+        files = [(database.get_file_by_id(thread_session, file_id), reserved) for file_id, relpath, reserved in batch]
+
+        try:
+            os.makedirs(self.config['local-data-dir'], exist_ok=True)
+        except OSError as e:
+            logger.error(f"Failed to create local folder ({self.config['local-data-dir']}), exiting: {e.errno}: {e.strerror}")
+            self.interrupted = True
+            self.tools.storage.release(sum(reserved for file, reserved in files))
+            thread_session.close()
+            return False
+
+        time_started = time.time()
+        self.transport.ensure()
+        with tempfile.NamedTemporaryFile(prefix='tapebackup-files-from-', suffix='.lst') as files_from:
+            # NUL separated, so any filename is possible
+            files_from.write(b''.join(f"{file.path}\0".encode('utf-8') for file, reserved in files))
+            files_from.flush()
+
+            command = ['rsync', '--protect-args', '-a', '--from0', f'--files-from={files_from.name}',
+                       '-e', self.transport.rsync_shell(),
+                       self.transport.remote_path(f"{base_dir}/"), f"{self.config['local-data-dir']}/"]
+            rsync = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
+        logger.debug(f"Execution Time: Downloading batch of {len(files)} files: {time.time() - time_started} seconds")
+
+        if rsync.returncode != 0:
+            # Partial transfers are possible (e.g. rc 23/24), check every file of the batch
+            logger.warning(f"Download of batch with {len(files)} files failed partially, rc: {rsync.returncode}, "
+                           f"error: {rsync.stderr}")
+            if rsync.returncode == 255:
+                self.transport.ensure(force=True)
+
+        for file, reserved in files:
+            if os.path.isfile(os.path.abspath(f"{self.config['local-data-dir']}/{file.path}")):
+                self.process_downloaded_file(thread_session, file, reserved)
             else:
-                file_list = self.get_remote_filelist()
-                data_dir = self.config['remote-data-dir']
-                base_dir = self.config['remote-base-dir']
-
-        db_file_list = database.get_not_deleted_files(self.session, base_dir)
-        new_files = list(set(file_list)-set(db_file_list))
-        deleted_files = list(set(db_file_list) - set(file_list))
-        self.skipped_count += len(file_list) - len(new_files)
-
-        logger.info(f"Found {len(file_list)} files. New: {len(new_files)}. Deleted: {len(deleted_files)}. Start to process...")
-
-        file_count_current = 0
-        for fpath in new_files:
-            # Check if max-storage-size from config file is reached
-            file_count_current += 1
-            if self.tools.calculate_over_max_storage_usage(-1):
-                while threading.active_count() > 1:
-                    time.sleep(1)
-                logger.warning("max-storage-size reached, exiting!")
-                break
-
-            if fpath.strip() == "":
-                continue
-            fullpath = fpath.strip()
-            relpath = self.tools.strip_base_path(fullpath, base_dir)
-            logger.debug(f"Processing {fullpath}")
-
-            if database.file_exists_by_path(self.session, relpath) is None:
-                # Get next thread id
-                for i in range(0, self.config['threads']['get']):
-                    if i not in self.active_threads:
-                        next_thread = i
-                        break
-                logger.info(f"Starting Thread #{next_thread}, processing "
-                            f"({file_count_current}/{len(new_files)}): {fullpath}")
-
-                self.active_threads.append(next_thread)
-                x = threading.Thread(target=self.get_thread,
-                                     args=(next_thread, relpath, fullpath,),
-                                     daemon=True)
-                x.start()
-
-                while threading.active_count() > self.config['threads']['get']:
-                    time.sleep(0.2)
+                logger.warning(f"Download failed, file: {file.path}")
+                self.failed_count += 1
+                self.tools.storage.release(reserved)
 
-            if self.interrupted:
-                while threading.active_count() > 1:
-                    time.sleep(1)
-                break
+        thread_session.close()
 
-        while threading.active_count() > 1:
-            time.sleep(1)
+    def encrypt_on_get(self, size):
+        """
+        :return: True if the file is encrypted while downloading (get --encrypt), chunked files are staged
+        """
+        return self.encryption is not None and not self.encryption.use_chunked(size)
 
-        ## Detect deleted files
-        for file in deleted_files:
+    def queue_download(self, scheduler, file_id, relpath, fullpath, size, reserved, base_dir, filename_enc=None):
+        """
+        Queue the download of a file, either as single job or as part of the current rsync batch
+        """
+        logger.info(f"Queueing (queue depth: {scheduler.queue_depth()}): {fullpath}")
+        filesize = size or 0
+        self.queued_bytes += filesize
+        if self.encrypt_on_get(size):
+            scheduler.submit(self.get_encrypt_thread, file_id, relpath, fullpath, filename_enc, reserved)
+            return
+        if not self.batch:
+            scheduler.submit(self.get_thread, file_id, relpath, fullpath, reserved)
+            return
+        # Size is only known if the file list provides it, otherwise only the file count limits a batch
+        if self.current_batch and (len(self.current_batch) >= self.batch_max_files
+                                   or self.current_batch_size + filesize > self.batch_max_size):
+            self.submit_batch(scheduler, base_dir)
+        self.current_batch.append((file_id, relpath, reserved))
+        self.current_batch_size += filesize
+
+    def submit_batch(self, scheduler, base_dir):
+        if self.current_batch:
+            scheduler.submit(self.get_batch_thread, self.current_batch, base_dir)
+        self.current_batch = []
+        self.current_batch_size = 0
+
+    def insert_new_files(self, scheduler, entries, base_dir):
+        """
+        Insert the file entries of new files in one transaction and queue their downloads
+        Entries which already exist (not downloaded by an interrupted run) keep their id
+        :param scheduler: 'get' scheduler
+        :param entries: list of tuples (relative file path, absolut filepath, size, bytes reserved in storage budget)
+        :param base_dir: directory the relative paths are relative to
+        :return: Nothing
+        """
+        if not entries:
+            return
+        time_started = time.time()
+        ids = database.insert_files(self.session, [(self.tools.strip_path(fullpath), relpath)
+                                                   for relpath, fullpath, size, reserved in entries])
+        logger.debug(f"Execution Time: Inserting {len(entries)} files into database: {time.time() - time_started} "
+                     f"seconds")
+        blocked = [entry for entry in entries if entry[0] not in ids]
+        if blocked and self.move_versions([relpath for relpath, fullpath, size, reserved in blocked]):
+            ids.update(database.insert_files(self.session, [(self.tools.strip_path(fullpath), relpath)
+                                                            for relpath, fullpath, size, reserved in blocked]))
+        names = {}
+        if self.encryption is not None:
+            # Committed in one transaction before the encrypted files are created, so 'db repair' finds them after a
+            # crash
+            encrypt_ids = [ids[relpath] for relpath, fullpath, size, reserved in entries
+                           if relpath in ids and self.encrypt_on_get(size)]
+            names = database.assign_filenames_encrypted(self.session, encrypt_ids, self.tools.create_filename_encrypted)
+
+        for i, (relpath, fullpath, size, reserved) in enumerate(entries):
             if self.interrupted:
-                break
-            ## Only look for files in the data path (then you can still specify subfolder instead of syncing all)
-            if data_dir in file:
+                # The remaining entries stay without size and mtime, the next run downloads them (file_pending)
+                self.tools.storage.release(sum(entry[3] for entry in entries[i:]))
+                return
+            file_id = ids.get(relpath)
+            if file_id is None:
+                # Path is still used by an entry flagged as deleted
+                logger.debug(f"File already known as deleted, skipping: {relpath}")
+                self.tools.storage.release(reserved)
+                self.skipped_count += 1
+                continue
+            self.queue_download(scheduler, file_id, relpath, fullpath, size, reserved, base_dir, names.get(file_id))
+
+    def get(self, given_file=None, batch=False, full=False, encrypt=False):
+        """
+        Get files from remote server or add local files into database
+        :param given_file: Filename to read list of files from, otherwise it will be retrieved via find
+        :param batch: Download new files in batches with one rsync call per batch
+        :param full: Force a full scan, even if an incremental scan is possible
+        :param encrypt: Encrypt files while they are downloaded, straight into 'local-enc-dir'
+        :return: Nothing
+        """
+        if self.transport is not None:
+            self.transport.open()
+        self.catalog.start()
+        try:
+            if encrypt:
+                self.encryption = Encryption(self.config, self.engine, self.tapelibrary, self.tools, self.local_files)
+                self.encryption.prepare_keys()
+                os.makedirs(self.config['local-enc-dir'], exist_ok=True)
+                if self.encryption.chunked_threshold is not None:
+                    logger.info(f"Files from {self.tools.convert_size(self.encryption.chunked_threshold)} on are "
+                                f"downloaded unencrypted, 'encrypt' encrypts them in chunks")
+
+            lister = Lister(self.config, self.transport)
+            newer_than = None
+            if given_file is None:
+                newer_than = self.choose_scan(full)
+                scan_started = self.scan_time(lister)
+
+            file_list, data_dir, base_dir = self.get_filelist(lister, given_file, newer_than)
+            source = ((self.tools.strip_base_path(entry.path, base_dir), entry.path, entry.size, entry.mtime)
+                      for entry in file_list)
+            catalog = database.iter_not_deleted_files(self.session)
+            data_dir_relative = os.path.relpath(os.path.abspath(data_dir), os.path.abspath(base_dir))
+
+            diff_mode = self.config.get('catalog-diff', 'merge')
+            if newer_than is not None:
+                # Only a few changed files are listed, look them up. Deleted files can't be detected.
+                diff_mode = 'lookup'
+                events = diff.lookup_diff(source, lambda path: database.get_not_deleted_file_by_path(self.session, path))
+            elif diff_mode == 'memory':
+                # Catalog is kept in memory, downloads start while the file list is retrieved
+                events = diff.set_diff(source, catalog)
+            else:
+                # Bounded memory: file list gets sorted (spilled to disk), then merged with the sorted catalog
+                events = diff.sorted_merge_diff(source, catalog, self.config.get('catalog-diff-run-size', 1000000))
+            logger.debug(f"Using catalog diff mode '{diff_mode}'")
+
+            transfer_config = self.config.get('transfer') or {}
+            self.batch = (batch or transfer_config.get('batch', False)) and not self.local_files
+            if self.batch and self.encryption is not None:
+                logger.info("Batched transfers are only used for files which are not encrypted while downloading")
+            self.batch_max_files = int(transfer_config.get('batch-max-files', 1000))
+            self.batch_max_size = self.tools.back_convert_size(str(transfer_config.get('batch-max-size', '10G')))
+            if self.batch:
+                logger.info(f"Using batched transfers, max {self.batch_max_files} files or "
+                            f"{self.tools.convert_size(self.batch_max_size)} per rsync call")
+            insert_batch_size = int(self.config.get('catalog-insert-batch', 5000))
+            new_files = []
+
+            scheduler = Scheduler('get', self.config['threads']['get'])
+            time_started = time.time()
+            storage_full = False
+            listed_count = 0
+            new_count = 0
+            deleted_files = []
+            for event in events:
+                if event[0] == diff.DELETED:
+                    ## Only look for files in the data path (then you can still specify subfolder instead of syncing all)
+                    if diff.is_below(event[1][0], data_dir_relative):
+                        deleted_files.append(event[1][0])
+                    continue
+
+                listed_count += 1
+                if event[0] == diff.COMMON and self.file_pending(event[2]):
+                    # Inserted by an interrupted run, download it with the existing entry
+                    changed = False
+                elif event[0] == diff.COMMON:
+                    if not self.file_changed(event[1], event[2]):
+                        self.skipped_count += 1
+                        continue
+                    changed = True
+                else:
+                    changed = False
+
+                relpath, fullpath, size, mtime = event[1]
+                new_count += 1
+
+                # Check if max-storage-size from config file is reached, the remote file size is reserved before the
+                # download starts (local files are not staged, only checked).
+                # Keep on listing, the complete list is needed for the delete detection
+                if storage_full:
+                    continue
+                reserved = 0 if self.local_files else (size or 0)
+                if not (self.tools.storage.check(size or 0) if self.local_files else self.tools.storage.reserve(reserved)):
+                    # Files already accepted fit into the budget
+                    self.insert_new_files(scheduler, new_files, base_dir)
+                    new_files = []
+                    self.submit_batch(scheduler, base_dir)
+                    scheduler.join()
+                    storage_full = True
+                    logger.warning("max-storage-size reached, stop downloading!")
+                    continue
+
+                logger.debug(f"Processing {fullpath}")
+
+                if changed:
+                    self.changed_count += 1
+                    self.version_changed_file(relpath)
+
+                # The diff already established the path is new, entries are inserted in bulk
+                new_files.append((relpath, fullpath, size, reserved))
+                if len(new_files) >= insert_batch_size:
+                    self.insert_new_files(scheduler, new_files, base_dir)
+                    new_files = []
+
+                if new_count % 1000 == 0:
+                    self.log_progress(scheduler, listed_count, new_count, time_started)
+
+                if self.interrupted:
+                    scheduler.cancel_pending()
+                    break
+
+            if not self.interrupted:
+                self.insert_new_files(scheduler, new_files, base_dir)
+                self.submit_batch(scheduler, base_dir)
+
+            logger.info(f"Found {listed_count} files. New: {new_count - self.changed_count}. "
+                        f"Changed: {self.changed_count}. Deleted: {len(deleted_files)}. "
+                        f"Waiting for {scheduler.queue_depth()} queued jobs...")
+
+            scheduler.shutdown()
+            self.catalog.flush()
+            self.log_progress(scheduler, listed_count, new_count, time_started)
+
+            ## Detect deleted files
+            for relpath in deleted_files:
+                if self.interrupted:
+                    break
                 ## Set delete flag in database
                 self.deleted_count += 1
-                id = database.set_file_deleted(self.session, file, base_dir)
-                logger.info(f"Set delete flag for file: ID: {id}, filepath: {file}")
-
-        logger.info(f"Processing finished: downloaded: {self.downloaded_count}, skipped (already downloaded): "
-                    f"{self.skipped_count}, failed: {self.failed_count}, deleted: {self.deleted_count}")
+                id = database.set_file_deleted(self.session, relpath)
+                logger.info(f"Set delete flag for file: ID: {id}, filepath: {relpath}")
+
+            # Only move the watermark if all listed files are processed, otherwise they would be missed by the next
+            # incremental scan
+            # Jobs which raised are only counted by the scheduler
+            if given_file is None and not self.interrupted and not storage_full and self.failed_count == 0 \
+                    and scheduler.jobs_failed == 0:
+                # Safety margin for files which are changed while scanning and clock granularity
+                watermark = scan_started - 60
+                database.set_config_value(self.session, f"scan-watermark:{self.scan_source()}", watermark)
+                if newer_than is None:
+                    database.set_config_value(self.session, f"scan-full:{self.scan_source()}", scan_started)
+                logger.debug(f"Scan watermark of {self.scan_source()} set to {datetime.datetime.fromtimestamp(watermark)}")
+
+            logger.info(f"Processing finished: downloaded: {self.downloaded_count}, skipped (already downloaded): "
+                        f"{self.skipped_count}, changed: {self.changed_count}, failed: {self.failed_count}, "
+                        f"deleted: {self.deleted_count}")
+        finally:
+            self.catalog.close()
+            if self.transport is not None:
+                self.transport.close()
 
     table_format_verbose = [
         ('Id',                  lambda i: i.id),
@@ -23,10 +23,13 @@ class Restore:
     def set_interrupted(self):
         self.interrupted = True
 
-    def start(self, files, tape=None, filelist=""):
+    def start(self, files, tape=None, filelist="", byte_range=None):
         ## TODO: Restore file by given name, path or encrypted name
         if files is None:
             files = []
+        if byte_range is not None:
+            self.restore_range(files, tape, byte_range)
+            return
         files = Tools.wildcard_to_sql_many(files)
         if filelist:
             files += self.read_filelist(filelist)
@@ -182,6 +185,7 @@ class Restore:
             self.restore_from_tape(tape, files)
             if self.interrupted:
                 break
+        self.encryption.shutdown_pool()
 
     def restore_from_tape(self, tape, files):
         logger.info(f'Restoring from tape {tape}')
@@ -222,6 +226,48 @@ class Restore:
                 grouped[tape] = [file]
         return grouped
 
+    def parse_range(self, value):
+        """
+        :param value: 'OFFSET:LENGTH', both with optional unit (e.g. 100G:4M)
+        :return: tuple (offset, length) in bytes
+        """
+        offset, sep, length = value.partition(':')
+        if not sep or not offset.strip() or not length.strip():
+            raise ValueError(f"Invalid range '{value}', use OFFSET:LENGTH")
+        return self.tools.back_convert_size(offset.strip()), self.tools.back_convert_size(length.strip())
+
+    # restore a byte range of a single file without a restore job, the tape must be in the library
+    def restore_range(self, files, tape, byte_range):
+        offset, length = byte_range
+        if len(files) != 1 or '*' in files[0]:
+            logger.error("A range can only be restored from exactly one file (no wildcards)")
+            sys.exit(1)
+
+        file = next((f for f in database.get_files_like(self.session, files, tape, written=True)
+                     if f.path == files[0]), None)
+        if file is None:
+            logger.error(f'File {files[0]} not found')
+            sys.exit(1)
+
+        tag_in_tapelib, tags_to_remove_from_library = self.tapelibrary.get_tapes_tags_from_library(self.session)
+        if file.tape.label not in tag_in_tapelib + tags_to_remove_from_library:
+            logger.error(f'Tape {file.tape.label} is not in the library, load it to restore {file.path}')
+            sys.exit(1)
+
+        self.tapelibrary.load(file.tape.label)
+        self.tapelibrary.ltfs()
+        src, dst = self.encryption.resolve_relative(file.filename_encrypted, f"{file.path}.{offset}-{length}",
+                                                    mkdir=True)
+        logger.info(f'Restoring {Tools.convert_size(length)} at offset {offset} of {file.path} into {dst}')
+        written = self.encryption.decrypt_range(src, dst, offset, length)
+        if written is None:
+            logger.error(f'Restoring range of {file.path} failed')
+        elif written < length:
+            logger.warning(f'Range exceeds the end of {file.path}, restored {written} bytes')
+        else:
+            logger.info(f'Restored range of {file.path} successfully')
+        self.tapelibrary.unload()
+
     def restore_single_file(self, file):
         logger.info(f'Restoring {file.path}')
         success = self.encryption.decrypt_relative(file.filename_encrypted, file.path, mkdir=True)
@@ -5,8 +5,13 @@ import os
 import sys
 import time
 import random
-import shutil
+import threading
+import numpy as np
+from tabulate import tabulate
 from tapebackup.lib import database
+from tapebackup.lib import planner
+from tapebackup.lib import RingBuffer, RingBufferAborted, TapeWriter, CatalogWriter, TapeCapacity
+from functions.encryption import Encryption
 logger = logging.getLogger()
 
 
@@ -19,9 +24,23 @@ class Tape:
         self.tools = tools
         self.local_files = local
         self.interrupted = False
+        # Direct write mode (write --direct): in-memory buffer between encryption and tape, minimum encryption rate
+        self.direct_buffer_size = self.tools.back_convert_size(str(config.get('direct-write-buffer', '1G')))
+        self.direct_min_rate = self.tools.back_convert_size(str(config.get('direct-write-min-rate', '80M')))
+        verify_region = config.get('tape-verify-region', '')
+        verify_region = 0 if verify_region is None or str(verify_region).strip() == '' \
+            else self.tools.back_convert_size(str(verify_region))
+        self.writer = TapeWriter(self.tools.back_convert_size(str(config.get('tape-write-buffer', '2G'))),
+                                 verify_region=verify_region)
+        self.catalog = CatalogWriter(engine, config.get('catalog-commit-rows', 1000),
+                                     config.get('catalog-commit-ms', 500) / 1000)
+        # Encryption of the direct write, also stages the files it can't encrypt to tape
+        self.encryption = None
 
     def set_interrupted(self):
         self.interrupted = True
+        if self.encryption is not None:
+            self.encryption.set_interrupted()
 
     def info(self):
         print(f"Loaderinfo from Device {self.config['devices']['tapelib']}:")
@@ -70,6 +89,87 @@ class Tape:
         print("")
         print(f"Full tapes in library (Could be removed) ({len(tapes_to_remove)}): {tapes_to_remove}")
 
+    def plan(self, depth=None):
+        """
+        Print where the files which are not written yet would go and how many tapes are needed to restore every
+        directory (tapes it is already written to plus the planned ones), with and without grouping by directory
+        :param depth: 'tape-locality-depth' override
+        """
+        if depth is None:
+            depth = planner.locality_depth(self.config)
+        if depth is None:
+            # Grouping is disabled for writing, show what grouping by whole directories would change
+            depth = 0
+        files = database.get_files_to_be_written(self.session)
+        if len(files) == 0:
+            print("No files to be written")
+            return
+
+        block_size = self.tools.back_convert_size(str(self.config.get('ltfs-block-size', '512K')))
+        capacity = self.config.get('tape-capacity', '')
+        if capacity is None or str(capacity).strip() == '':
+            tapes, tapes_to_remove = self.tapelibrary.get_tapes_tags_from_library(self.session)
+            capacity = planner.lto_capacity(tapes[0]) if len(tapes) > 0 else None
+            if capacity is None:
+                logger.error("Capacity of the next tape is unknown, please set 'tape-capacity' in the config file")
+                return
+        else:
+            capacity = self.tools.back_convert_size(str(capacity))
+        if "%" in str(self.config['tape-keep-free']):
+            percent = int(self.config['tape-keep-free'][0:self.config['tape-keep-free'].index("%")])
+            capacity -= int(capacity * percent / 100)
+        else:
+            capacity -= self.tools.back_convert_size(str(self.config['tape-keep-free']))
+
+        ## The started tape is written first, its free space is estimated from the files on it
+        started_tape = database.get_started_tape(self.session)
+        labels = []
+        capacities = []
+        if started_tape is not None:
+            used = sum(planner.allocated_sizes(file.filesize_encrypted or 0, block_size)
+                       for file in database.get_files_by_tapelabel(self.session, started_tape[0]))
+            labels.append(started_tape[0])
+            capacities.append(max(0, capacity - int(used)))
+
+        directories = {}
+        written_files = database.get_written_paths_with_tape(self.session)
+        written_keys, written_groups = planner.group_ids((path for path, label in written_files), depth)
+        for (path, label), group in zip(written_files, written_groups.tolist()):
+            directories.setdefault(written_keys[group], set()).add(label)
+
+        keys, groups = planner.group_ids((file.path for file in files), depth)
+        sizes = np.fromiter((file.filesize_encrypted or 0 for file in files), dtype=np.int64, count=len(files))
+        too_big = np.flatnonzero(planner.allocated_sizes(sizes, block_size) > capacity)
+        if len(too_big) > 0:
+            logger.error(f"{len(too_big)} files don't fit on a tape, e.g. {files[int(too_big[0])].path}")
+            return
+        counts = np.bincount(groups, minlength=len(keys))
+        totals = np.bincount(groups, weights=sizes, minlength=len(keys))
+
+        results = {}
+        for name, grouping in (('grouped', groups), ('ungrouped', None)):
+            tape_of, count = planner.simulate(sizes, capacities, capacity, block_size, grouping)
+            tape_labels = labels + [f"new-{i}" for i in range(count - len(labels))]
+            mounts = [set() for _ in keys]
+            for group, tape in set(zip(groups.tolist(), tape_of.tolist())):
+                mounts[group].add(tape_labels[tape])
+            results[name] = (count, mounts)
+
+        table = []
+        for group, planned in enumerate(results['grouped'][1]):
+            directory = keys[group]
+            count, size = int(counts[group]), int(totals[group])
+            written = directories.get(directory, set())
+            table.append([directory or '/', count, self.tools.convert_size(size), len(written),
+                          len(written | planned), len(written | results['ungrouped'][1][group])])
+        table.sort(key=lambda row: (-row[4], row[0]))
+        print(tabulate(table, headers=['Directory', 'Files', 'Size', 'Written to Tapes', 'Expected Mounts',
+                                       'Without Grouping'], tablefmt='grid'))
+        print("")
+        print(f"Usable capacity per tape: {capacity} ({self.tools.convert_size(capacity)}), grouping depth: "
+              f"{'whole directory' if depth == 0 else depth}")
+        print(f"Tapes needed: {results['grouped'][0]} (without grouping: {results['ungrouped'][0]})")
+
     def filecount_from_verify_files_config(self, filelist):
         if "%" in self.config['verify-files']:
             return int(len(filelist) * int(self.config['verify-files'][0:self.config['verify-files'].index("%")]) / 100)
@@ -83,7 +183,8 @@ class Tape:
 
         for file in files:
             logger.info(f"Testing md5sum of file {file.filename}")
-            if self.tools.md5sum(f"{self.config['local-tape-mount-dir']}/{file.filename_encrypted}") != file.md5sum_encrypted:
+            if self.tools.hash_file(f"{self.config['local-tape-mount-dir']}/{file.filename_encrypted}",
+                                    file.hash_algorithm_encrypted, use_mmap=False) != file.md5sum_encrypted:
                 logger.info(f"md5sum of {file.id}:{file.filename} is wrong: exiting!")
                 return False
 
@@ -100,7 +201,7 @@ class Tape:
             logger.info(f"Testing md5sum of file {file.filename}")
 
             self.tapelibrary.seek(file.tapeposition)
-            if self.tools.md5sum_tar(self.config['devices']['tapedrive']) != file.md5sum_encrypted:
+            if self.tools.hash_tar(self.config['devices']['tapedrive'], file.hash_algorithm_encrypted) != file.md5sum_encrypted:
                 logger.info(f"md5sum of {file.id}:{file.filename} is wrong: exiting!")
                 return False
 
@@ -122,27 +223,268 @@ class Tape:
         logger.error("Revert files and force format device finished. Exiting now!")
         sys.exit(1)
 
-    def write_file_ltfs(self, file, free, tape, count, filecount):
-        logger.debug(f"Tape: Free: {free}, Fileid: {file.id}, Filesize: {file.filesize_encrypted}")
+    def write_files_ltfs(self, files, tape, capacity, filecount, delete_after_write=False, leftover=False):
+        """
+        Stream encrypted files from 'local-enc-dir' to LTFS with the double buffered writer, the next files are read
+        while the current one is written. The written flags are committed by the catalog writer.
+        :param leftover: more files are waiting which are not planned for this tape, the tape is full afterwards
+        :return: tuple (number of written files, True if the tape has no space for the next file)
+        """
+        tape_id = database.get_tape_by_label(self.session, tape).id
+        state = {'full': False, 'count': 0, 'failed': 0, 'delete': [], 'flushed': time.time(), 'read_back': set()}
+
+        # Runs in the reader thread, decides which file comes next
+        def jobs():
+            for file in files:
+                if not capacity.fits(file.filesize_encrypted):
+                    state['full'] = True
+                    return
+                capacity.add(file.filesize_encrypted)
+                state['count'] += 1
+                logger.info(f"Reading file for tape ({state['count']}/{filecount}): {file.filename}")
+                yield (f"{self.config['local-enc-dir']}/{file.filename_encrypted}",
+                       f"{self.config['local-tape-mount-dir']}/{file.filename_encrypted}", file)
+                if self.interrupted:
+                    return
+            state['full'] = leftover
+
+        def delete_written():
+            ## Staged files are only deleted after their written flag is committed, otherwise a crash would lose them
+            self.catalog.flush()
+            for file in state['delete']:
+                if os.path.exists(f"{self.config['local-enc-dir']}/{file.filename_encrypted}"):
+                    os.remove(f"{self.config['local-enc-dir']}/{file.filename_encrypted}")
+                    self.tools.storage.release(file.filesize_encrypted)
+            state['delete'] = []
+            state['flushed'] = time.time()
+
+        def on_done(file, size, seconds):
+            capacity.done(file.filesize_encrypted)
+            if self.writer.verify_region > 0:
+                state['read_back'].add(file.id)
+            self.catalog.post(file.id, written_date=datetime.datetime.now(), tape_id=tape_id, written=True,
+                              tapeposition=None)
+            if delete_after_write:
+                state['delete'].append(file)
+                if len(state['delete']) >= self.catalog.max_rows \
+                        or time.time() - state['flushed'] >= self.catalog.max_delay:
+                    delete_written()
+
+        def on_skip(file, error):
+            state['count'] -= 1
+            capacity.remove(file.filesize_encrypted)
+            logger.warning(f"Encrypted file not readable, skipping: {file.filename_encrypted} ({file.filename}): "
+                           f"{error}")
+
+        def checksum(file):
+            return file.hash_algorithm_encrypted or 'md5', file.md5sum_encrypted
+
+        def on_failed(file, reason):
+            ## Not marked as written, the space on tape stays used. The local encrypted file is kept
+            capacity.done(file.filesize_encrypted)
+            state['failed'] += 1
+            logger.error(f"Checksum of {file.filename_encrypted} ({file.filename}) on tape is wrong, not marked as "
+                         f"written: {reason}")
+            try:
+                os.remove(f"{self.config['local-tape-mount-dir']}/{file.filename_encrypted}")
+            except OSError as e:
+                logger.warning(f"Removing {file.filename_encrypted} from tape failed: {e}")
+
+        self.catalog.start()
+        try:
+            count, written = self.writer.write(jobs(), on_done, on_skip, checksum, on_failed)
+        except OSError as error:
+            self.catalog.close()
+            if error.errno == 28:
+                # This means no space left on device
+                self.revert_ltfs_on_error_28(capacity.free, tape)
+            logger.error(f"Unknown OS Error '{error}', exiting!")
+            logger.error(f"You have now stale file entries in database and maybe a broken LTFS, you need to "
+                         f"manually format this tape and set written=0, written_date=NULL and tape=NULL on files "
+                         f"which has this tape '{tape}' assigned")
+            sys.exit(1)
+        delete_written()
+        self.catalog.close()
+
+        if state['failed'] > 0:
+            logger.error(f"{state['failed']} files have a wrong checksum on tape, they are written again on the next "
+                         f"run. If the written bytes were already wrong, check the files in local-enc-dir")
+
+        full = False
+        if state['full']:
+            full = self.tape_is_full_ltfs(tape, capacity.sync(), read_back=state['read_back'])
+        return count, full
+
+    def encrypt_direct(self, ring, encryption, files, capacity, state):
+        """
+        Producer of the direct write, runs in its own thread with its own session: encrypts the files one after another
+        into the ring buffer, the file boundaries are markers. Stops if the tape is full, the encryption is too slow to
+        keep the drive streaming ('direct-write-min-rate') or the run is interrupted.
+        Markers: ('start', dst, id), ('end', dst, id, values, size), ('failed', dst, id, size), ('done',)
+        :param files: list of tuples (id, filename, path, filesize, md5sum_file, hash_algorithm_file)
+        """
+        session = database.create_session(self.engine)
+        algorithm = self.tools.hash_algorithm()
+        written = 0
+        encrypt_time = 0.0
+        try:
+            for id, filename, path, filesize_file, md5sum_file, hash_algorithm_file in files:
+                # Encrypted size is only known afterwards, the overhead of all formats is below 1 KiB
+                size = (filesize_file or 0) + 1024
+                if not capacity.fits(size):
+                    state['full'] = True
+                    break
+                capacity.add(size)
+                state['count'] += 1
+
+                filename_enc = self.tools.create_filename_encrypted()
+                while database.filename_encrypted_already_used(session, filename_enc):
+                    logger.warning(f"Filename ({filename_enc}) encrypted already exists, creating new one!")
+                    filename_enc = self.tools.create_filename_encrypted()
+                src = os.path.abspath(f"{self.config['local-base-dir']}/{path}")
+                dst = f"{self.config['local-tape-mount-dir']}/{filename_enc}"
+                plain_algorithm = (hash_algorithm_file or 'md5') if md5sum_file else None
+
+                logger.info(f"Encrypting file to tape ({state['count']}/{len(files)}): {filename}")
+                time_started = time.time()
+                producer_wait = ring.producer_wait
+                ring.mark(('start', dst, id))
+                try:
+                    with open(src, 'rb', buffering=0) as reader:
+                        plain_md5, filesize, md5, filesize_encrypted = encryption.encrypt_stream(
+                            reader, ring, plain_algorithm, algorithm)
+                except (OSError, ValueError) as e:
+                    if isinstance(e, RingBufferAborted):
+                        raise
+                    logger.warning(f"Encrypt file to tape failed, file: {src} error: {e}")
+                    ring.mark(('failed', dst, id, size))
+                    continue
+                if md5sum_file is not None and plain_md5 != md5sum_file:
+                    logger.warning(f"File changed since it was added (md5sum differs): {src}")
+                now = datetime.datetime.now()
+                values = dict(filename_encrypted=filename_enc, filesize_encrypted=filesize_encrypted,
+                              md5sum_encrypted=md5, hash_algorithm_encrypted=algorithm,
+                              encryption_format=encryption.format, encrypted_date=now, encrypted=True,
+                              written_date=now, tape_id=state['tape_id'], written=True, tapeposition=None)
+                ring.mark(('end', dst, id, values, size))
+
+                # Time the encryption needed, without waiting for the drive
+                written += filesize_encrypted
+                encrypt_time += time.time() - time_started - (ring.producer_wait - producer_wait)
+                # Decide once the buffer can't hide the encryption speed anymore
+                if written >= 2 * self.direct_buffer_size and encrypt_time > 0 \
+                        and written / encrypt_time < self.direct_min_rate:
+                    logger.warning(f"Encryption is too slow to keep the drive streaming "
+                                   f"({self.tools.convert_size(written / encrypt_time)}/s, minimum: "
+                                   f"{self.tools.convert_size(self.direct_min_rate)}/s), the remaining files are "
+                                   f"staged in local-enc-dir and written afterwards")
+                    break
 
-        logger.info(f"Writing file to tape ({count}/{filecount}): {file.filename}")
+                if self.interrupted:
+                    break
+            ring.mark(('done',))
+        except BaseException as e:
+            state['error'] = e
+            ring.abort(f"encryption failed: {e}")
+        finally:
+            session.close()
+
+    def write_direct(self, tape, capacity):
+        """
+        Encrypt local files which are not encrypted yet directly to tape (local mode only), without a staging copy in
+        'local-enc-dir'. One ring buffer and one encryption thread are used for the whole run, so the drive keeps
+        streaming across file boundaries. If the encryption can't keep the drive streaming ('direct-write-min-rate'),
+        the remaining files are encrypted into 'local-enc-dir' (staging) and written to the tape by write() afterwards.
+        :return: tuple (tape ran out of space, result of tape_is_full_ltfs)
+        """
+        encryption = Encryption(self.config, self.engine, self.tapelibrary, self.tools, local=True)
+        self.encryption = encryption
+        encryption.prepare_keys()
+        # Chunked files need the process pool and random access to their ciphertext, they are staged. The thread gets
+        # plain values, not the objects of this session
+        files = [(f.id, f.filename, f.path, f.filesize, f.md5sum_file, f.hash_algorithm_file)
+                 for f in database.get_files_to_be_encrypted(self.session) if not encryption.use_chunked(f.filesize)]
+        logger.info(f"Encrypting {len(files)} files directly to tape, ring buffer: "
+                    f"{self.tools.convert_size(self.direct_buffer_size)}")
+
+        state = {'full': False, 'count': 0, 'error': None,
+                 'tape_id': database.get_tape_by_label(self.session, tape).id}
+        ring = RingBuffer(self.direct_buffer_size)
+        thread = threading.Thread(target=self.encrypt_direct, args=(ring, encryption, files, capacity, state),
+                                  name='encrypt-direct', daemon=True)
+        self.catalog.start()
         time_started = time.time()
+        thread.start()
+        writer = None
+        dst = None
+        count = 0
+        written = 0
         try:
-            shutil.copy2(
-                f"{self.config['local-enc-dir']}/{file.filename_encrypted}",
-                f"{self.config['local-tape-mount-dir']}/"
-            )
+            while True:
+                chunk, length, marker = ring.get()
+                if chunk is not None:
+                    TapeWriter.write_all(writer, memoryview(chunk)[:length])
+                    ring.release(chunk)
+                    written += length
+                    continue
+
+                if marker[0] == 'start':
+                    dst = marker[1]
+                    writer = open(dst, 'wb', buffering=0)
+                elif marker[0] == 'end':
+                    kind, dst, file_id, values, size = marker
+                    writer.close()
+                    writer = None
+                    capacity.done(size)
+                    self.catalog.post(file_id, **values)
+                    count += 1
+                    dst = None
+                elif marker[0] == 'failed':
+                    kind, dst, file_id, size = marker
+                    writer.close()
+                    writer = None
+                    os.remove(dst)
+                    capacity.remove(size)
+                    dst = None
+                else:
+                    break
         except OSError as error:
-            if error.errno == 28:
+            ring.abort(f"writing failed: {error}")
+            thread.join()
+            if writer is not None:
+                writer.close()
+            self.catalog.close()
+            if isinstance(error, RingBufferAborted):
+                error = state['error']
+            if getattr(error, 'errno', None) == 28:
                 # This means no space left on device
-                self.revert_ltfs_on_error_28(free, tape)
-            else:
-                logger.error(f"Unknown OS Error '{error}', exiting!")
-                logger.error(f"You have now stale file entries in database and maybe a broken LTFS, you need to "
-                             f"manually format this tape and set written=0, written_date=NULL and tape=NULL on files "
-                             f"which has this tape '{tape}' assigned")
-        logger.debug(f"Execution Time: Copy file to tape: {time.time() - time_started} seconds")
-        database.update_file_after_write(self.session, file, datetime.datetime.now(), tape)
+                self.revert_ltfs_on_error_28(capacity.free, tape)
+            logger.error(f"Unknown OS Error '{error}', exiting!")
+            logger.error(f"You have now stale file entries in database and maybe a broken LTFS, you need to "
+                         f"manually format this tape and set written=0, written_date=NULL and tape=NULL on files "
+                         f"which has this tape '{tape}' assigned")
+            if dst is not None and os.path.isfile(dst):
+                os.remove(dst)
+            sys.exit(1)
+        thread.join()
+        self.catalog.close()
+        if state['error'] is not None:
+            logger.error(f"Encrypting files to tape failed: {state['error']}")
+            sys.exit(1)
+
+        elapsed = time.time() - time_started
+        logger.info(f"Encrypted {count} files directly to tape, {written} bytes in {elapsed:.1f} seconds "
+                    f"({written / max(elapsed, 0.000001) / 1024 / 1024:.1f} MB/s), waited for encryption: "
+                    f"{ring.consumer_wait:.1f} seconds, encryption waited for tape: {ring.producer_wait:.1f} seconds")
+        if state['full']:
+            return True, self.tape_is_full_ltfs(tape, capacity.sync())
+        if not self.interrupted:
+            # Files the encryption was too slow for and chunked files, write() writes them to this tape afterwards
+            logger.info("Staging the remaining files in local-enc-dir")
+            encryption.encrypt(once=True)
+            # Committed by the catalog writer of the encryption, the loaded objects are outdated
+            self.session.expire_all()
+        return False, False
 
     def write_file_tar(self, filelist, free, tape):
         tape_position = self.tapelibrary.get_current_block()
@@ -178,13 +520,22 @@ class Tape:
         new_tape_position = self.tapelibrary.get_current_block()
         database.update_tape_end_position(self.session, tape, new_tape_position)
 
-    def tape_is_full_ltfs(self, tape, free):
+    def tape_is_full_ltfs(self, tape, free, read_back=()):
+        """
+        :param read_back: ids of the files which were read back while writing ('tape-verify-region'), the random
+                          sample is taken from the other files
+        """
         # For LTO-5 and above with LTFS support
         logger.warning(f"Tape is full ({self.tools.convert_size(free)} left): I am testing now a few media, writing "
                        f"summary into database and unloading tape")
 
         files = database.get_files_by_tapelabel(self.session, tape)
-        if not self.test_backup_pieces_ltfs(files, self.filecount_from_verify_files_config(files)):
+        not_read_back = [file for file in files if file.id not in read_back]
+        if len(not_read_back) < len(files):
+            logger.info(f"{len(files) - len(not_read_back)} files were read back while writing, taking the random "
+                        f"sample from the other {len(not_read_back)} files")
+        if not_read_back and not self.test_backup_pieces_ltfs(
+                not_read_back, self.filecount_from_verify_files_config(not_read_back)):
             logger.error(
                 "md5sum on tape not equal to database. Stopping everything. Need manual check of the tape!")
             logger.error(f"If you do not use this tape anymore, or want to write all data again, you need to manual "
@@ -225,6 +576,7 @@ class Tape:
             if os.path.exists("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted)):
                 logger.info(f"Deleting encrypted file ({count}/{len(to_delete)}): {file.filename_encrypted} ({file.filename})")
                 os.remove("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted))
+                self.tools.storage.release(file.filesize_encrypted)
             count += 1
         logger.debug(f"Execution Time: Deleted encrypted files written to tape: {time.time() - time_started} seconds")
 
@@ -249,8 +601,11 @@ class Tape:
         ## TODO: Write DATABASE and stuff to file, see tape_is_full_ltfs
         #database.mark_tape_as_full(self.session, tape, datetime.datetime.now(), len(files))
 
-    def write(self, delete_after_write=False):
+    def write(self, delete_after_write=False, direct=False):
         full = False
+        if direct and not self.local_files:
+            logger.error("Direct write (encrypting to tape) is only possible for local files (--local)")
+            return
         tapes, tapes_to_remove = self.tapelibrary.get_tapes_tags_from_library(self.session)
         if len(tapes_to_remove) > 0:
             logger.warning(f"These tapes are full, please remove from library: {tapes_to_remove}")
@@ -263,10 +618,7 @@ class Tape:
             logger.info(f"Option delete-after-write is set, will delete encrypted files directly after writing to tape!")
 
         started_tape = database.get_started_tape(self.session)
-        if started_tape not in tapes:
-            next_tape = tapes.pop(0)
-        else:
-            next_tape = started_tape[0]
+        next_tape = planner.choose_tape(started_tape[0] if started_tape is not None else None, tapes)
 
         logger.info(f"Using tape {next_tape} for writing")
         self.tapelibrary.load(next_tape)
@@ -280,49 +632,37 @@ class Tape:
             ## Write used tape into database
             database.write_tape_into_database(self.session, next_tape)
 
-            time_started = time.time()
-            st = os.statvfs(self.config['local-tape-mount-dir'])
+            ## Free space is read once, then tracked by the capacity model
+            capacity = TapeCapacity(self.config, self.tools)
+            capacity.sync()
             logger.info("Tape: Used: {} ({} GB), Free: {} ({} GB), Total: {} ({} GB)".format(
-                (st.f_blocks - st.f_bfree) * st.f_frsize,
-                int((st.f_blocks - st.f_bfree) * st.f_frsize / 1024 / 1024 / 1024),
-                (st.f_bavail * st.f_frsize),
-                int((st.f_bavail * st.f_frsize) / 1024 / 1024 / 1024),
-                (st.f_blocks * st.f_frsize),
-                int((st.f_blocks * st.f_frsize) / 1024 / 1024 / 1024)
+                capacity.used,
+                int(capacity.used / 1024 / 1024 / 1024),
+                capacity.free,
+                int(capacity.free / 1024 / 1024 / 1024),
+                capacity.total,
+                int(capacity.total / 1024 / 1024 / 1024)
             ))
-            logger.debug(f"Execution Time: Getting tape space info: {time.time() - time_started} seconds")
-
-            if "%" in str(self.config['tape-keep-free']):
-                tape_keep_free = int(st.f_blocks * st.f_frsize *
-                                     int(self.config['tape-keep-free'][0:self.config['tape-keep-free'].index("%")]) /
-                                     100)
-            else:
-                tape_keep_free = self.tools.back_convert_size(str(self.config['tape-keep-free']))
+            tape_keep_free = capacity.keep_free
             logger.debug(f"Keep {tape_keep_free} ({self.tools.convert_size(tape_keep_free)}) free on tape given by config file!")
 
-            files = database.get_files_to_be_written(self.session)
-            filecount = self.tools.count_files_fit_on_tape(files, ((st.f_bavail * st.f_frsize) - tape_keep_free))
-            count = 1
-            for file in files:
-                st = os.statvfs(self.config['local-tape-mount-dir'])
-                free = (st.f_bavail * st.f_frsize)
-
-                ## Check if enough space on tape, otherwise unmount and use next tape
-                if file.filesize_encrypted > (free - tape_keep_free):
-                    full = self.tape_is_full_ltfs(next_tape, free)
-                    break
-                else:
-                    self.write_file_ltfs(file, free, next_tape, count, filecount)
-                    count += 1
-
-                # Delete file if --delete-after-write is specified
-                if delete_after_write:
-                    if os.path.exists("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted)):
-                        logger.info(f"Deleting encrypted file: {file.filename_encrypted} ({file.filename})")
-                        os.remove("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted))
+            if direct:
+                tape_full, full = self.write_direct(next_tape, capacity)
+                if tape_full:
+                    if full:
+                        self.write(delete_after_write=delete_after_write, direct=direct)
+                    self.tapelibrary.unmount()
+                    return
 
-                if self.interrupted:
-                    break
+            files = database.get_files_to_be_written(self.session)
+            ## Fill the tape with the biggest files (or directories, 'tape-locality-depth') first and top it off with
+            ## smaller ones, the remaining files wait for the next tape
+            planned = planner.plan_tape(files, capacity.available, capacity.block_size,
+                                        planner.locality_depth(self.config))
+            filecount = len(planned)
+            count, full = self.write_files_ltfs(planned, next_tape, capacity, filecount, delete_after_write,
+                                                leftover=len(planned) < len(files))
+            free = capacity.free
 
         elif lto_version == 4:
             logger.info("LTO-4 Tape found, use tar for backup")
@@ -378,6 +718,7 @@ class Tape:
                     if os.path.exists("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted)):
                         logger.info(f"Deleting encrypted file: {file.filename_encrypted} ({file.filename})")
                         os.remove("{}/{}".format(self.config['local-enc-dir'], file.filename_encrypted))
+                        self.tools.storage.release(file.filesize_encrypted)
 
                 if self.interrupted:
                     break
@@ -386,11 +727,11 @@ class Tape:
                 self.write_file_tar(files_for_next_chunk, free, next_tape)
 
         # Info some stats, especially interesting when written is manual interrupted
-        logger.info(f"Written {count} of {filecount} files. {self.tools.convert_size(st.f_bavail * st.f_frsize)} "
+        logger.info(f"Written {count} of {filecount} files. {self.tools.convert_size(free)} "
                     f"space still avalable on tape.")
 
         if full:
-            self.write(delete_after_write=delete_after_write)
+            self.write(delete_after_write=delete_after_write, direct=direct)
 
         # Unmounting current tape if interrupted or no more data to write
         self.tapelibrary.unmount()
@@ -1,2 +1,10 @@
 from .tapelibrary import Tapelibrary
 from .tools import Tools
+from .storage import StorageBudget
+from .catalog import CatalogWriter
+from .scheduler import Scheduler
+from .transport import SshTransport
+from .listing import Lister, RemoteFile
+from .ringbuffer import RingBuffer, RingBufferAborted
+from .tapewriter import TapeWriter
+from .capacity import TapeCapacity
@@ -0,0 +1,111 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger()
+
+
+class TapeCapacity:
+    """
+    Free space model of the mounted LTFS tape
+    statvfs on LTFS is a FUSE round trip which can stall behind index operations, so it is read once at mount. Then
+    the written files are subtracted, every file takes whole LTFS blocks ('ltfs-block-size'). The model is synced with
+    statvfs again after 'tape-capacity-resync' bytes or when the free space gets close to 'tape-keep-free'
+    ('tape-capacity-margin'), the drift between model and statvfs is logged.
+    Files which are accounted (add) but not completely written yet (done) are subtracted from statvfs on a resync.
+    """
+    def __init__(self, config, tools):
+        self.config = config
+        self.tools = tools
+        self.mount_dir = config['local-tape-mount-dir']
+        self.block_size = tools.back_convert_size(str(config.get('ltfs-block-size', '512K')))
+        self.resync_bytes = tools.back_convert_size(str(config.get('tape-capacity-resync', '50G')))
+        self.margin = tools.back_convert_size(str(config.get('tape-capacity-margin', '5G')))
+        self.total = 0
+        self.keep_free = 0
+        self.free = 0
+        self.written_since_sync = 0
+        self.files_since_sync = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def allocated(self, size):
+        """
+        :return: space a file of this size takes on tape
+        """
+        return max(1, -(-size // self.block_size)) * self.block_size
+
+    def sync(self):
+        """
+        Read the free space with statvfs and log the drift of the model
+        :return: free bytes
+        """
+        time_started = time.time()
+        st = os.statvfs(self.mount_dir)
+        logger.debug(f"Execution Time: Getting tape space info: {time.time() - time_started} seconds")
+        with self.lock:
+            free = st.f_bavail * st.f_frsize - self.pending
+        if self.total and self.files_since_sync:
+            drift = self.free - free
+            logger.info(f"Tape capacity resync after {self.files_since_sync} files "
+                        f"({self.tools.convert_size(self.written_since_sync)}): model {self.free}, statvfs {free}, "
+                        f"drift {drift} bytes ({drift / self.files_since_sync:.0f} per file)")
+        self.total = st.f_blocks * st.f_frsize
+        if "%" in str(self.config['tape-keep-free']):
+            percent = int(self.config['tape-keep-free'][0:self.config['tape-keep-free'].index("%")])
+            self.keep_free = int(self.total * percent / 100)
+        else:
+            self.keep_free = self.tools.back_convert_size(str(self.config['tape-keep-free']))
+        self.free = free
+        self.written_since_sync = 0
+        self.files_since_sync = 0
+        return free
+
+    @property
+    def used(self):
+        return self.total - self.free
+
+    @property
+    def available(self):
+        """
+        :return: bytes which can still be written (free minus 'tape-keep-free')
+        """
+        return self.free - self.keep_free
+
+    def fits(self, size):
+        """
+        :param size: file size
+        :return: True if the file fits on the tape, synced with statvfs if needed
+        """
+        if self.written_since_sync >= self.resync_bytes \
+                or self.available - self.allocated(size) < self.margin:
+            self.sync()
+        return self.allocated(size) <= self.available
+
+    def add(self, size):
+        """
+        Account a file which is written to tape
+        """
+        with self.lock:
+            self.pending += self.allocated(size)
+        self.free -= self.allocated(size)
+        self.written_since_sync += size
+        self.files_since_sync += 1
+
+    def remove(self, size):
+        """
+        Revert add() of a file which wasn't written
+        """
+        with self.lock:
+            self.pending -= self.allocated(size)
+        self.free += self.allocated(size)
+        self.written_since_sync -= size
+        self.files_since_sync -= 1
+
+    def done(self, size):
+        """
+        A file accounted with add() is completely written
+        """
+        with self.lock:
+            self.pending -= self.allocated(size)
@@ -0,0 +1,134 @@
+import logging
+import queue
+import sys
+import threading
+import time
+from tapebackup.lib import database
+
+logger = logging.getLogger()
+
+
+class CatalogWriter:
+    """
+    Single writer thread for file entry updates
+    Workers post updates (file id and column values) instead of committing their own tiny transactions. The writer
+    merges them per file and commits them together (group commit) every 'max_rows' files or 'max_delay' seconds.
+    Updates are not visible in the database until they are committed, use flush() before reading them.
+    """
+    def __init__(self, engine, max_rows=1000, max_delay=0.5):
+        self.engine = engine
+        self.max_rows = max(1, int(max_rows))
+        self.max_delay = max(0.0, float(max_delay))
+        self.queue = queue.Queue()
+        self.flush_requested = threading.Event()
+        self.thread = None
+        self.error = None
+        self.rows = 0
+        self.commits = 0
+        self.commit_time = 0.0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='catalog-writer', daemon=True)
+            self.thread.start()
+
+    def post(self, file_id, **values):
+        """
+        Queue an update of a file entry
+        :param file_id: id of the file entry
+        :param values: column values
+        """
+        self.queue.put((file_id, values))
+
+    def request_flush(self):
+        """
+        Commit pending updates as soon as possible without waiting (safe to call from a signal handler)
+        """
+        self.flush_requested.set()
+
+    def flush(self):
+        """
+        Wait until all updates posted until now are committed
+        """
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        while not done.wait(1):
+            if not self.thread.is_alive():
+                break
+        self.check_error()
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.check_error()
+        if self.commits > 0:
+            logger.debug(f"Catalog writer: {self.rows} updates in {self.commits} commits, "
+                         f"commit time: {self.commit_time} seconds")
+
+    def check_error(self):
+        if self.error is not None:
+            logger.error(f"Writing file updates into database failed: {self.error}")
+            sys.exit(1)
+
+    def write(self, session, pending):
+        time_started = time.time()
+        database.update_files(session, pending.values())
+        self.commits += 1
+        self.commit_time += time.time() - time_started
+        logger.debug(f"Execution Time: Group commit of {len(pending)} file updates: {time.time() - time_started} "
+                     f"seconds")
+
+    def run(self):
+        session = database.create_session(self.engine)
+        pending = {}
+        waiters = []
+        deadline = 0
+        stop = False
+        try:
+            while not stop:
+                item = False
+                try:
+                    # Poll while updates are pending, so a requested flush is not delayed until the deadline
+                    item = self.queue.get(timeout=0.1 if pending else None)
+                except queue.Empty:
+                    pass
+
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                elif item is not False:
+                    file_id, values = item
+                    if not pending:
+                        deadline = time.time() + self.max_delay
+                    pending.setdefault(file_id, {'id': file_id}).update(values)
+                    self.rows += 1
+
+                if stop or waiters or self.flush_requested.is_set() or len(pending) >= self.max_rows \
+                        or (pending and time.time() >= deadline):
+                    self.flush_requested.clear()
+                    if pending:
+                        self.write(session, pending)
+                        pending = {}
+                    for waiter in waiters:
+                        waiter.set()
+                    waiters = []
+        except BaseException as e:
+            # commit() exits on a locked database, report it to the posting threads
+            self.error = e if str(e) else repr(e)
+            for waiter in waiters:
+                waiter.set()
+        finally:
+            session.close()
@@ -0,0 +1,726 @@
+import hashlib
+import hmac
+import logging
+import os
+import struct
+import threading
+import time
+from contextlib import nullcontext
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from tapebackup.lib import hashing
+
+logger = logging.getLogger()
+
+# Format of 'openssl enc -aes-256-cbc -pbkdf2 -iter 100000 -k KEY':
+# 'Salted__' + 8 byte salt + AES-256-CBC ciphertext (PKCS#7 padding),
+# key and iv are derived with PBKDF2-HMAC-SHA256 from the password and the salt
+MAGIC = b'Salted__'
+SALT_SIZE = 8
+PBKDF2_ITERATIONS = 100000
+BLOCK_SIZE = 16
+
+
+def open_source(src):
+    """
+    :param src: filename or binary file object (e.g. stdout of a transfer)
+    :return: context manager of a binary file object
+    """
+    if hasattr(src, 'readinto'):
+        return nullcontext(src)
+    return open(src, 'rb', buffering=0)
+
+
+def read_fully(reader, n):
+    """
+    Read n bytes, unbuffered reads may return less (e.g. on FUSE/LTFS)
+    :return: bytes, only shorter at the end of the file
+    """
+    data = reader.read(n)
+    if len(data) == n or not data:
+        return data
+    parts = [data]
+    remaining = n - len(data)
+    while remaining > 0:
+        data = reader.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return b''.join(parts)
+
+
+def open_target(dst):
+    """
+    :param dst: filename or binary file object with write() (e.g. a RingBuffer)
+    :return: context manager of a binary file object
+    """
+    if hasattr(dst, 'write'):
+        return nullcontext(dst)
+    return open(dst, 'wb')
+
+
+def derive_key_iv(password, salt, iterations=PBKDF2_ITERATIONS):
+    """
+    :return: tuple (key, iv) like openssl enc -pbkdf2
+    """
+    key_iv = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations, 32 + BLOCK_SIZE)
+    return key_iv[:32], key_iv[32:]
+
+
+def encrypt_file(src, dst, password, plain_algorithm=None, cipher_algorithm=None, salt=None,
+                 buffer_size=hashing.BUFFER_SIZE):
+    """
+    Encrypt a file into the openssl format, the digests of plaintext and ciphertext are built in the same pass
+    :param src: plaintext file or binary file object
+    :param dst: encrypted file or binary file object
+    :param password: encryption key from config file ('enc-key')
+    :param plain_algorithm: hash algorithm of the plaintext, None to skip
+    :param cipher_algorithm: hash algorithm of the ciphertext, None to skip
+    :param salt: 8 bytes, random if None (only given for tests, a salt must never be reused)
+    :param buffer_size: bytes per read
+    :return: tuple (plaintext digest, ciphertext digest, size of the encrypted file)
+    """
+    if salt is None:
+        salt = os.urandom(SALT_SIZE)
+    key, iv = derive_key_iv(password, salt)
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    padder = padding.PKCS7(BLOCK_SIZE * 8).padder()
+    plain_hash = hashing.new(plain_algorithm) if plain_algorithm else None
+    cipher_hash = hashing.new(cipher_algorithm) if cipher_algorithm else None
+
+    buffer = hashing.get_buffer(buffer_size)
+    view = memoryview(buffer)
+    size = 0
+    with open_source(src) as reader, open_target(dst) as writer:
+        def write(data):
+            nonlocal size
+            writer.write(data)
+            size += len(data)
+            if cipher_hash is not None:
+                cipher_hash.update(data)
+
+        write(MAGIC + salt)
+        while True:
+            n = reader.readinto(buffer)
+            if not n:
+                break
+            if plain_hash is not None:
+                plain_hash.update(view[:n])
+            write(encryptor.update(padder.update(view[:n])))
+        write(encryptor.update(padder.finalize()) + encryptor.finalize())
+
+    return (plain_hash.hexdigest() if plain_hash else None,
+            cipher_hash.hexdigest() if cipher_hash else None,
+            size)
+
+
+def decrypt_file(src, dst, password, plain_algorithm=None, buffer_size=hashing.BUFFER_SIZE):
+    """
+    Decrypt a file in the openssl format
+    :param src: encrypted file
+    :param dst: plaintext file
+    :param password: encryption key from config file ('enc-key')
+    :param plain_algorithm: hash algorithm of the plaintext, None to skip
+    :param buffer_size: bytes per read
+    :return: plaintext digest or None
+    :raise ValueError: not an encrypted file, wrong key or corrupted data
+    """
+    plain_hash = hashing.new(plain_algorithm) if plain_algorithm else None
+    buffer = hashing.get_buffer(buffer_size)
+    view = memoryview(buffer)
+    with open(src, 'rb', buffering=0) as reader, open(dst, 'wb') as writer:
+        header = reader.read(len(MAGIC) + SALT_SIZE)
+        if len(header) != len(MAGIC) + SALT_SIZE or not header.startswith(MAGIC):
+            raise ValueError("bad magic number")
+        key, iv = derive_key_iv(password, header[len(MAGIC):])
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+        unpadder = padding.PKCS7(BLOCK_SIZE * 8).unpadder()
+
+        def write(data):
+            writer.write(data)
+            if plain_hash is not None:
+                plain_hash.update(data)
+
+        while True:
+            n = reader.readinto(buffer)
+            if not n:
+                break
+            write(unpadder.update(decryptor.update(view[:n])))
+        try:
+            write(unpadder.update(decryptor.finalize()) + unpadder.finalize())
+        except ValueError:
+            raise ValueError("bad decrypt (wrong key or corrupted file)")
+
+    return plain_hash.hexdigest() if plain_hash else None
+
+
+# Format v2 (opt-in, 'encryption-format: 2'): the master key is derived once per run with PBKDF2 from the password
+# and a salt stored in the database, every file gets its own random nonce and subkeys.
+# 'TBKENC02' + salt (16 bytes) + PBKDF2 iterations (4 bytes, big endian) + nonce (16 bytes)
+# + AES-256-CTR ciphertext + HMAC-SHA256 (32 bytes) of header and ciphertext
+V2_MAGIC = b'TBKENC02'
+V2_SALT_SIZE = 16
+V2_NONCE_SIZE = 16
+V2_HEADER_SIZE = len(V2_MAGIC) + V2_SALT_SIZE + 4 + V2_NONCE_SIZE
+V2_TAG_SIZE = 32
+
+
+class MasterKeys:
+    """
+    Master keys of format v2 derived from the password, cached per salt, so PBKDF2 runs once per run
+    """
+    def __init__(self, password):
+        self.password = password
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def get(self, salt, iterations=PBKDF2_ITERATIONS):
+        with self.lock:
+            key = self.keys.get((salt, iterations))
+            if key is None:
+                time_started = time.time()
+                key = hashlib.pbkdf2_hmac('sha256', self.password.encode('utf-8'), salt, iterations, 32)
+                self.keys[(salt, iterations)] = key
+                logger.debug(f"Execution Time: Derive master key: {time.time() - time_started} seconds")
+            return key
+
+
+def derive_subkeys(master_key, nonce):
+    """
+    :return: tuple (encryption key, mac key) of one file
+    """
+    return (hmac.new(master_key, b'enc' + nonce, hashlib.sha256).digest(),
+            hmac.new(master_key, b'mac' + nonce, hashlib.sha256).digest())
+
+
+def file_format(path):
+    """
+    :return: format version of an encrypted file (1: openssl, 2: v2, 3: chunked)
+    :raise ValueError: unknown format
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+    if magic == MAGIC:
+        return 1
+    elif magic == V2_MAGIC:
+        return 2
+    elif magic == V3_MAGIC:
+        return 3
+    raise ValueError("bad magic number")
+
+
+def parse_header_v2(header):
+    """
+    :return: tuple (salt, iterations, nonce)
+    """
+    if len(header) != V2_HEADER_SIZE or not header.startswith(V2_MAGIC):
+        raise ValueError("bad magic number")
+    offset = len(V2_MAGIC)
+    salt = header[offset:offset + V2_SALT_SIZE]
+    iterations, = struct.unpack('>I', header[offset + V2_SALT_SIZE:offset + V2_SALT_SIZE + 4])
+    return salt, iterations, header[-V2_NONCE_SIZE:]
+
+
+def encrypt_file_v2(src, dst, master_keys, salt, plain_algorithm=None, cipher_algorithm=None,
+                    iterations=PBKDF2_ITERATIONS, buffer_size=hashing.BUFFER_SIZE):
+    """
+    Encrypt a file into format v2, the digests of plaintext and ciphertext are built in the same pass
+    :param src: plaintext file or binary file object
+    :param dst: encrypted file or binary file object
+    :param master_keys: MasterKeys
+    :param salt: salt of the master key (stored in database and in every file header)
+    :param plain_algorithm: hash algorithm of the plaintext, None to skip
+    :param cipher_algorithm: hash algorithm of the ciphertext, None to skip
+    :param iterations: PBKDF2 iterations of the master key
+    :param buffer_size: bytes per read
+    :return: tuple (plaintext digest, ciphertext digest, size of the encrypted file)
+    """
+    nonce = os.urandom(V2_NONCE_SIZE)
+    enc_key, mac_key = derive_subkeys(master_keys.get(salt, iterations), nonce)
+    # The key is unique per file, so the counter can start at zero
+    encryptor = Cipher(algorithms.AES(enc_key), modes.CTR(bytes(BLOCK_SIZE))).encryptor()
+    mac = hmac.new(mac_key, digestmod=hashlib.sha256)
+    plain_hash = hashing.new(plain_algorithm) if plain_algorithm else None
+    cipher_hash = hashing.new(cipher_algorithm) if cipher_algorithm else None
+
+    buffer = hashing.get_buffer(buffer_size)
+    view = memoryview(buffer)
+    size = 0
+    with open_source(src) as reader, open_target(dst) as writer:
+        def write(data, authenticated=True):
+            nonlocal size
+            writer.write(data)
+            size += len(data)
+            if authenticated:
+                mac.update(data)
+            if cipher_hash is not None:
+                cipher_hash.update(data)
+
+        write(V2_MAGIC + salt + struct.pack('>I', iterations) + nonce)
+        while True:
+            n = reader.readinto(buffer)
+            if not n:
+                break
+            if plain_hash is not None:
+                plain_hash.update(view[:n])
+            write(encryptor.update(view[:n]))
+        write(encryptor.finalize())
+        write(mac.digest(), authenticated=False)
+
+    return (plain_hash.hexdigest() if plain_hash else None,
+            cipher_hash.hexdigest() if cipher_hash else None,
+            size)
+
+
+def decrypt_file_v2(src, dst, master_keys, plain_algorithm=None, buffer_size=hashing.BUFFER_SIZE):
+    """
+    Decrypt a file in format v2, the plaintext is written before it is authenticated, on error it must be discarded
+    :raise ValueError: not a v2 file, wrong key or corrupted data
+    """
+    plain_hash = hashing.new(plain_algorithm) if plain_algorithm else None
+    buffer = hashing.get_buffer(buffer_size)
+    view = memoryview(buffer)
+    with open(src, 'rb', buffering=0) as reader, open(dst, 'wb') as writer:
+        header = reader.read(V2_HEADER_SIZE)
+        remaining = os.fstat(reader.fileno()).st_size - V2_HEADER_SIZE - V2_TAG_SIZE
+        salt, iterations, nonce = parse_header_v2(header)
+        if remaining < 0:
+            raise ValueError("truncated file")
+        enc_key, mac_key = derive_subkeys(master_keys.get(salt, iterations), nonce)
+        decryptor = Cipher(algorithms.AES(enc_key), modes.CTR(bytes(BLOCK_SIZE))).decryptor()
+        mac = hmac.new(mac_key, header, hashlib.sha256)
+
+        while remaining > 0:
+            n = reader.readinto(view[:min(remaining, buffer_size)])
+            if not n:
+                raise ValueError("truncated file")
+            remaining -= n
+            mac.update(view[:n])
+            data = decryptor.update(view[:n])
+            writer.write(data)
+            if plain_hash is not None:
+                plain_hash.update(data)
+        writer.write(decryptor.finalize())
+        if not hmac.compare_digest(mac.digest(), reader.read(V2_TAG_SIZE)):
+            raise ValueError("bad decrypt (wrong key or corrupted file)")
+
+    return plain_hash.hexdigest() if plain_hash else None
+
+
+# Format v3 (chunked, files from 'encryption-chunked-threshold' on): fixed size chunks sealed independently with
+# AES-256-GCM, so the chunks of one file can be encrypted and decrypted in parallel (process pool).
+# 'TBKENC03' + salt (16 bytes) + PBKDF2 iterations (4 bytes) + nonce (16 bytes) + chunk size (4 bytes)
+# + plaintext size (8 bytes), followed by the chunks (ciphertext + 16 byte tag each, the last chunk may be shorter).
+# The key is derived like v2, the GCM nonce of a chunk is its index, the header is authenticated with every chunk.
+# Chunk i starts at V3_HEADER_SIZE + i * (chunk size + V3_TAG_SIZE), the index is implicit.
+V3_MAGIC = b'TBKENC03'
+V3_HEADER_SIZE = len(V3_MAGIC) + V2_SALT_SIZE + 4 + V2_NONCE_SIZE + 4 + 8
+V3_TAG_SIZE = 16
+V3_CHUNK_SIZE = 4 * 1024 * 1024
+# Chunks per job of the process pool
+V3_CHUNKS_PER_JOB = 16
+
+
+def chunk_count(size, chunk_size):
+    return (size + chunk_size - 1) // chunk_size
+
+
+def chunked_size(size, chunk_size=V3_CHUNK_SIZE):
+    """
+    :return: size of the encrypted file (format v3) of a plaintext with the given size
+    """
+    return V3_HEADER_SIZE + size + chunk_count(size, chunk_size) * V3_TAG_SIZE
+
+
+def parse_header_v3(header):
+    """
+    :return: tuple (salt, iterations, nonce, chunk size, plaintext size)
+    """
+    if len(header) != V3_HEADER_SIZE or not header.startswith(V3_MAGIC):
+        raise ValueError("bad magic number")
+    offset = len(V3_MAGIC)
+    salt = header[offset:offset + V2_SALT_SIZE]
+    offset += V2_SALT_SIZE
+    iterations, = struct.unpack('>I', header[offset:offset + 4])
+    offset += 4
+    nonce = header[offset:offset + V2_NONCE_SIZE]
+    offset += V2_NONCE_SIZE
+    chunk_size, size = struct.unpack('>IQ', header[offset:])
+    if chunk_size == 0:
+        raise ValueError("bad header")
+    return salt, iterations, nonce, chunk_size, size
+
+
+def chunk_nonce(index):
+    return struct.pack('>IQ', 0, index)
+
+
+def seal_chunks(src, dst, key, header, chunk_size, size, first, count):
+    """
+    Encrypt the chunks first..first+count-1 of src into the preallocated dst (runs in a worker process)
+    """
+    aead = AESGCM(key)
+    with open(src, 'rb', buffering=0) as reader, open(dst, 'r+b', buffering=0) as writer:
+        for index in range(first, first + count):
+            offset = index * chunk_size
+            length = min(chunk_size, size - offset)
+            data = os.pread(reader.fileno(), length, offset)
+            if len(data) != length:
+                raise ValueError("file changed while encrypting")
+            os.pwrite(writer.fileno(), aead.encrypt(chunk_nonce(index), data, header),
+                      V3_HEADER_SIZE + index * (chunk_size + V3_TAG_SIZE))
+
+
+def open_chunks(src, dst, key, header, chunk_size, size, first, count):
+    """
+    Decrypt the chunks first..first+count-1 of src into the preallocated dst (runs in a worker process)
+    """
+    aead = AESGCM(key)
+    with open(src, 'rb', buffering=0) as reader, open(dst, 'r+b', buffering=0) as writer:
+        for index in range(first, first + count):
+            offset = index * chunk_size
+            length = min(chunk_size, size - offset) + V3_TAG_SIZE
+            data = os.pread(reader.fileno(), length, V3_HEADER_SIZE + index * (chunk_size + V3_TAG_SIZE))
+            if len(data) != length:
+                raise ValueError("truncated file")
+            try:
+                os.pwrite(writer.fileno(), aead.decrypt(chunk_nonce(index), data, header), offset)
+            except InvalidTag:
+                raise ValueError(f"bad decrypt of chunk {index} (wrong key or corrupted file)")
+
+
+def hash_range(reader, h, length, buffer):
+    """
+    Feed the next length bytes of reader into hash object h
+    """
+    view = memoryview(buffer)
+    while length > 0:
+        n = reader.readinto(view[:min(length, len(buffer))])
+        if not n:
+            raise ValueError("unexpected end of file")
+        h.update(view[:n])
+        length -= n
+
+
+def run_chunk_jobs(function, src, dst, key, header, chunk_size, size, executor, on_done):
+    """
+    Run function over all chunks in jobs of V3_CHUNKS_PER_JOB chunks, in the executor if given
+    :param on_done: called with (first chunk, chunk count) of every finished job in file order
+    """
+    jobs = [(first, min(V3_CHUNKS_PER_JOB, chunk_count(size, chunk_size) - first))
+            for first in range(0, chunk_count(size, chunk_size), V3_CHUNKS_PER_JOB)]
+    if executor is None:
+        for first, count in jobs:
+            function(src, dst, key, header, chunk_size, size, first, count)
+            on_done(first, count)
+        return
+
+    futures = [executor.submit(function, src, dst, key, header, chunk_size, size, first, count)
+               for first, count in jobs]
+    try:
+        for (first, count), future in zip(jobs, futures):
+            future.result()
+            on_done(first, count)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def encrypt_file_chunked(src, dst, master_keys, salt, plain_algorithm=None, cipher_algorithm=None, executor=None,
+                         chunk_size=V3_CHUNK_SIZE, iterations=PBKDF2_ITERATIONS):
+    """
+    Encrypt a file into format v3, the chunks are encrypted in the executor (process pool) if given
+    The digests are built in file order while the workers continue with the next chunks.
+    :param src: plaintext file
+    :param dst: encrypted file
+    :param master_keys: MasterKeys
+    :param salt: salt of the master key
+    :param plain_algorithm: hash algorithm of the plaintext, None to skip
+    :param cipher_algorithm: hash algorithm of the ciphertext, None to skip
+    :param executor: concurrent.futures.ProcessPoolExecutor or None to encrypt in the calling thread
+    :param chunk_size: plaintext bytes per chunk
+    :param iterations: PBKDF2 iterations of the master key
+    :return: tuple (plaintext digest, ciphertext digest, size of the encrypted file)
+    """
+    size = os.path.getsize(src)
+    nonce = os.urandom(V2_NONCE_SIZE)
+    header = V3_MAGIC + salt + struct.pack('>I', iterations) + nonce + struct.pack('>IQ', chunk_size, size)
+    key, _ = derive_subkeys(master_keys.get(salt, iterations), nonce)
+    total = chunked_size(size, chunk_size)
+    with open(dst, 'wb') as writer:
+        writer.write(header)
+        writer.truncate(total)
+
+    plain_hash = hashing.new(plain_algorithm) if plain_algorithm else None
+    cipher_hash = hashing.new(cipher_algorithm) if cipher_algorithm else None
+    buffer = hashing.get_buffer()
+    with open(src, 'rb', buffering=0) as plain, open(dst, 'rb', buffering=0) as cipher:
+        if cipher_hash is not None:
+            hash_range(cipher, cipher_hash, V3_HEADER_SIZE, buffer)
+
+        def on_done(first, count):
+            length = min(count * chunk_size, size - first * chunk_size)
+            if plain_hash is not None:
+                hash_range(plain, plain_hash, length, buffer)
+            if cipher_hash is not None:
+                hash_range(cipher, cipher_hash, length + count * V3_TAG_SIZE, buffer)
+
+        run_chunk_jobs(seal_chunks, src, dst, key, header, chunk_size, size, executor, on_done)
+
+    return (plain_hash.hexdigest() if plain_hash else None,
+            cipher_hash.hexdigest() if cipher_hash else None,
+            total)
+
+
+def decrypt_file_chunked(src, dst, master_keys, plain_algorithm=None, executor=None):
+    """
+    Decrypt a file in format v3, the chunks are decrypted in the executor (process pool) if given
+    Every chunk is authenticated before it is written, on error dst must be discarded.
+    :raise ValueError: not a v3 file, wrong key or corrupted data
+    """
+    with open(src, 'rb') as reader:
+        header = reader.read(V3_HEADER_SIZE)
+        salt, iterations, nonce, chunk_size, size = parse_header_v3(header)
+        if os.fstat(reader.fileno()).st_size != chunked_size(size, chunk_size):
+            raise ValueError("truncated file")
+    key, _ = derive_subkeys(master_keys.get(salt, iterations), nonce)
+    with open(dst, 'wb') as writer:
+        writer.truncate(size)
+
+    plain_hash = hashing.new(plain_algorithm) if plain_algorithm else None
+    buffer = hashing.get_buffer()
+    with open(dst, 'rb', buffering=0) as plain:
+        def on_done(first, count):
+            if plain_hash is not None:
+                hash_range(plain, plain_hash, min(count * chunk_size, size - first * chunk_size), buffer)
+
+        run_chunk_jobs(open_chunks, src, dst, key, header, chunk_size, size, executor, on_done)
+
+    return plain_hash.hexdigest() if plain_hash else None
+
+
+def decrypt_any(src, dst, password, master_keys=None, plain_algorithm=None, executor=None):
+    """
+    Decrypt a file in any supported format (detected by its header)
+    :param master_keys: MasterKeys for format v2 and v3, created from password if None
+    :param executor: process pool for format v3, None to decrypt in the calling thread
+    :return: plaintext digest or None
+    """
+    version = file_format(src)
+    if version == 3:
+        return decrypt_file_chunked(src, dst, master_keys or MasterKeys(password), plain_algorithm, executor)
+    elif version == 2:
+        return decrypt_file_v2(src, dst, master_keys or MasterKeys(password), plain_algorithm)
+    return decrypt_file(src, dst, password, plain_algorithm)
+
+
+# Parallel decryption of format v1 (openssl): a CBC plaintext block only depends on its ciphertext block and the one
+# before, so ranges of the ciphertext can be decrypted independently with the preceding ciphertext block as IV.
+# The ciphertext is read sequentially by the calling thread (tape), the ranges are decrypted by the worker processes.
+PARALLEL_RANGE_SIZE = 16 * 1024 * 1024
+
+
+def decrypt_cbc_range(dst, key, iv, data, offset):
+    """
+    Decrypt a range of the ciphertext (multiple of the block size, without padding removal) into dst at offset
+    (runs in a worker process)
+    """
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+    plaintext = decryptor.update(data) + decryptor.finalize()
+    with open(dst, 'r+b', buffering=0) as writer:
+        os.pwrite(writer.fileno(), plaintext, offset)
+
+
+def decrypt_file_parallel(src, dst, password, plain_algorithm=None, executor=None, range_size=PARALLEL_RANGE_SIZE,
+                          max_pending=None):
+    """
+    Decrypt a file in the openssl format, ranges are decrypted in the executor (process pool) if given and written
+    into the preallocated dst at their offsets
+    :param src: encrypted file
+    :param dst: plaintext file
+    :param password: encryption key from config file ('enc-key')
+    :param plain_algorithm: hash algorithm of the plaintext, None to skip
+    :param executor: concurrent.futures.ProcessPoolExecutor or None to decrypt in the calling thread
+    :param range_size: ciphertext bytes per job (multiple of the block size)
+    :param max_pending: jobs in flight (limits the memory usage), default: 2 per cpu
+    :return: plaintext digest or None
+    :raise ValueError: not an encrypted file, wrong key or corrupted data
+    """
+    range_size -= range_size % BLOCK_SIZE
+    if max_pending is None:
+        max_pending = 2 * (os.cpu_count() or 1)
+    plain_hash = hashing.new(plain_algorithm) if plain_algorithm else None
+    buffer = hashing.get_buffer()
+
+    with open(src, 'rb', buffering=0) as reader:
+        header = read_fully(reader, len(MAGIC) + SALT_SIZE)
+        if len(header) != len(MAGIC) + SALT_SIZE or not header.startswith(MAGIC):
+            raise ValueError("bad magic number")
+        length = os.fstat(reader.fileno()).st_size - len(header)
+        if length <= 0 or length % BLOCK_SIZE != 0:
+            raise ValueError("bad decrypt (wrong key or corrupted file)")
+        key, iv = derive_key_iv(password, header[len(MAGIC):])
+
+        with open(dst, 'wb') as writer:
+            try:
+                os.posix_fallocate(writer.fileno(), 0, length)
+            except (AttributeError, OSError):
+                writer.truncate(length)
+
+        with open(dst, 'r+b', buffering=0) as plain:
+            # The last block (padding) is hashed after the padding is checked
+            hashed = 0
+
+            def on_done(end):
+                nonlocal hashed
+                end = min(end, length - BLOCK_SIZE)
+                if plain_hash is not None and end > hashed:
+                    hash_range(plain, plain_hash, end - hashed, buffer)
+                hashed = max(hashed, end)
+
+            pending = []
+            try:
+                offset = 0
+                while offset < length:
+                    data = read_fully(reader, min(range_size, length - offset))
+                    if len(data) != min(range_size, length - offset):
+                        raise ValueError("truncated file")
+                    if executor is None:
+                        decrypt_cbc_range(dst, key, iv, data, offset)
+                        on_done(offset + len(data))
+                    else:
+                        pending.append((executor.submit(decrypt_cbc_range, dst, key, iv, data, offset),
+                                        offset + len(data)))
+                        while len(pending) > max_pending:
+                            future, end = pending.pop(0)
+                            future.result()
+                            on_done(end)
+                    iv = data[-BLOCK_SIZE:]
+                    offset += len(data)
+                while pending:
+                    future, end = pending.pop(0)
+                    future.result()
+                    on_done(end)
+            except BaseException:
+                for future, _ in pending:
+                    future.cancel()
+                raise
+
+            last = os.pread(plain.fileno(), BLOCK_SIZE, length - BLOCK_SIZE)
+            pad = last[-1]
+            if not 1 <= pad <= BLOCK_SIZE or last[-pad:] != bytes([pad]) * pad:
+                raise ValueError("bad decrypt (wrong key or corrupted file)")
+            if plain_hash is not None:
+                plain_hash.update(last[:BLOCK_SIZE - pad])
+            plain.truncate(length - pad)
+
+    return plain_hash.hexdigest() if plain_hash else None
+
+
+# Byte ranges: only the blocks (v1, v2) or chunks (v3) covering the range are read and decrypted.
+# v1 starts with the ciphertext block before the range as IV, v2 starts the CTR counter at the first block.
+# Ranges of v1 and v2 files can't be authenticated (v2 has one tag over the whole file), v3 chunks are authenticated.
+
+def decrypt_range_v1(reader, writer, offset, end, password, buffer_size):
+    header = reader.read(len(MAGIC) + SALT_SIZE)
+    if len(header) != len(MAGIC) + SALT_SIZE or not header.startswith(MAGIC):
+        raise ValueError("bad magic number")
+    length = os.fstat(reader.fileno()).st_size - len(header)
+    if length <= 0 or length % BLOCK_SIZE != 0:
+        raise ValueError("bad decrypt (wrong key or corrupted file)")
+    key, iv = derive_key_iv(password, header[len(MAGIC):])
+    end = min(end, length)
+    if offset >= end:
+        # Range starts behind the ciphertext, there is no block to take the IV from
+        return 0
+    position = offset - offset % BLOCK_SIZE
+    if position > 0:
+        reader.seek(len(header) + position - BLOCK_SIZE)
+        iv = reader.read(BLOCK_SIZE)
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+
+    written = 0
+    while position < end:
+        n = min(buffer_size - buffer_size % BLOCK_SIZE, -(-end // BLOCK_SIZE) * BLOCK_SIZE - position)
+        data = reader.read(n)
+        if len(data) != n:
+            raise ValueError("truncated file")
+        plaintext = decryptor.update(data)
+        if position + n == length:
+            pad = plaintext[-1]
+            if not 1 <= pad <= BLOCK_SIZE or plaintext[-pad:] != bytes([pad]) * pad:
+                raise ValueError("bad decrypt (wrong key or corrupted file)")
+            plaintext = plaintext[:-pad]
+        written += writer.write(plaintext[max(offset - position, 0):end - position])
+        position += n
+    return written
+
+
+def decrypt_range_v2(reader, writer, offset, end, master_keys, buffer_size):
+    salt, iterations, nonce = parse_header_v2(reader.read(V2_HEADER_SIZE))
+    end = min(end, os.fstat(reader.fileno()).st_size - V2_HEADER_SIZE - V2_TAG_SIZE)
+    enc_key, _ = derive_subkeys(master_keys.get(salt, iterations), nonce)
+    position = offset - offset % BLOCK_SIZE
+    counter = (position // BLOCK_SIZE).to_bytes(BLOCK_SIZE, 'big')
+    decryptor = Cipher(algorithms.AES(enc_key), modes.CTR(counter)).decryptor()
+    reader.seek(V2_HEADER_SIZE + position)
+
+    written = 0
+    while position < end:
+        data = reader.read(min(buffer_size, end - position))
+        if not data:
+            raise ValueError("truncated file")
+        written += writer.write(decryptor.update(data)[max(offset - position, 0):])
+        position += len(data)
+    return written
+
+
+def decrypt_range_v3(reader, writer, offset, end, master_keys):
+    header = reader.read(V3_HEADER_SIZE)
+    salt, iterations, nonce, chunk_size, size = parse_header_v3(header)
+    end = min(end, size)
+    key, _ = derive_subkeys(master_keys.get(salt, iterations), nonce)
+    aead = AESGCM(key)
+
+    written = 0
+    for index in range(offset // chunk_size, -(-end // chunk_size)):
+        position = index * chunk_size
+        reader.seek(V3_HEADER_SIZE + index * (chunk_size + V3_TAG_SIZE))
+        data = reader.read(min(chunk_size, size - position) + V3_TAG_SIZE)
+        try:
+            plaintext = aead.decrypt(chunk_nonce(index), data, header)
+        except InvalidTag:
+            raise ValueError(f"bad decrypt of chunk {index} (wrong key or corrupted file)")
+        written += writer.write(plaintext[max(offset - position, 0):end - position])
+    return written
+
+
+def decrypt_range(src, writer, offset, length, password, master_keys=None, buffer_size=hashing.BUFFER_SIZE):
+    """
+    Decrypt a byte range of the plaintext of a file in any supported format, only the needed part is read
+    :param src: encrypted file (seekable, e.g. on LTFS)
+    :param writer: binary file object for the plaintext range
+    :param offset: first byte of the plaintext
+    :param length: number of bytes
+    :param password: encryption key from config file ('enc-key')
+    :param master_keys: MasterKeys for format v2 and v3, created from password if None
+    :param buffer_size: bytes per read
+    :return: number of bytes written, less than length if the range exceeds the end of the file
+    :raise ValueError: not an encrypted file, wrong key or corrupted data (only detected for parts of the range)
+    """
+    if offset < 0 or length < 0:
+        raise ValueError("offset and length must not be negative")
+    if length == 0:
+        return 0
+    version = file_format(src)
+    with open(src, 'rb') as reader:
+        if version == 3:
+            return decrypt_range_v3(reader, writer, offset, offset + length, master_keys or MasterKeys(password))
+        elif version == 2:
+            return decrypt_range_v2(reader, writer, offset, offset + length, master_keys or MasterKeys(password),
+                                    buffer_size)
+        return decrypt_range_v1(reader, writer, offset, offset + length, password, buffer_size)
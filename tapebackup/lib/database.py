@@ -1,24 +1,72 @@
 import datetime
 import logging
 import os
+import random
+import re
 import sqlite3
 import sys
 import time
-from sqlalchemy import create_engine, func, or_, and_
+from sqlalchemy import create_engine, event, func, or_, and_, inspect, text
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.serializer import dumps
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql.functions import concat
 from tapebackup.lib import Config, File, Tape, RestoreJob, RestoreJobFileMap
 
+# Suffix of old versions of changed files, see version_file
+VERSION_SUFFIX = re.compile(r'\.~\d+~$')
+
 logger = logging.getLogger()
 
+# Set on every new connection. WAL lets readers run while one writer commits (e.g. get and write at the same time),
+# busy_timeout makes SQLite wait for locks itself instead of failing immediately
+sqlite_pragmas = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 30000),
+    ('cache_size', -65536),
+    ('mmap_size', 268435456),
+    ('temp_store', 'MEMORY'),
+]
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in sqlite_pragmas:
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
 
-def connect(db_path):
-    engine = create_engine(f"sqlite:///{db_path}")
+def connect(db_path, pool_size=16):
+    """
+    Create the database engine, connections are pooled and shared by the sessions of all threads
+    :param db_path: path of the SQLite database file
+    :param pool_size: connections kept open, more are opened temporarily if needed
+    :return: engine
+    """
+    engine = create_engine(f"sqlite:///{db_path}", poolclass=QueuePool, pool_size=pool_size, max_overflow=pool_size,
+                           connect_args={'check_same_thread': False})
+    event.listen(engine, 'connect', set_sqlite_pragmas)
     return engine
 
 
+def copy_database(db_path, target_path):
+    """
+    Copy a database file with the SQLite backup API. In WAL mode committed pages can still be in the '-wal' file, a
+    plain file copy of the database would miss them.
+    :param db_path: path of the SQLite database file
+    :param target_path: path of the copy, overwritten if it exists
+    """
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
 def create_tables(engine):
     Config.__table__.create(bind=engine, checkfirst=True)
     File.__table__.create(bind=engine, checkfirst=True)
@@ -48,6 +96,86 @@ def db_model_version_need_update(engine, session, db_version):
         return True
 
 
+def create_missing_indexes(engine):
+    """
+    Create all indexes of the models which don't exist in the database yet and update the planner statistics
+    """
+    inspector = inspect(engine)
+    for table in (File.__table__, RestoreJobFileMap.__table__):
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                time_started = time.time()
+                index.create(bind=engine)
+                logger.info(f"Created index {index.name}: {time.time() - time_started} seconds")
+    with engine.begin() as connection:
+        connection.execute(text("ANALYZE"))
+
+
+def add_missing_column(engine, column):
+    """
+    Add a column of the models to an existing table, existing rows get the default value
+    """
+    table = column.table
+    if column.name in {c['name'] for c in inspect(engine).get_columns(table.name)}:
+        return
+    definition = f"{column.name} {column.type.compile(engine.dialect)}"
+    if column.default is not None:
+        definition += f" DEFAULT '{column.default.arg}'"
+    with engine.begin() as connection:
+        connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+    logger.info(f"Added column {table.name}.{column.name}")
+
+
+def upgrade_to_2(engine):
+    # Indexes for md5sum, duplicate, tape and state flag lookups
+    create_missing_indexes(engine)
+
+
+def upgrade_to_3(engine):
+    # Hash algorithm of the stored digests, all existing digests are md5
+    add_missing_column(engine, File.__table__.c.hash_algorithm_file)
+    add_missing_column(engine, File.__table__.c.hash_algorithm_encrypted)
+
+
+def upgrade_to_4(engine):
+    # Format version of the encrypted files, all existing files are openssl enc (v1)
+    add_missing_column(engine, File.__table__.c.encryption_format)
+
+
+# Model version -> function upgrading the schema from the previous version
+upgrades = {
+    2: upgrade_to_2,
+    3: upgrade_to_3,
+    4: upgrade_to_4,
+}
+
+
+def upgrade(engine, db_version):
+    """
+    Upgrade the database schema step by step to the given model version
+    :param engine: database engine
+    :param db_version: model version of the program
+    :return: True if the database is at db_version afterwards
+    """
+    session = create_session(engine)
+    version = int(get_config_value(session, 'version'))
+    if version > db_version:
+        logger.error(f"Database version {version} is newer than this program ({db_version}), please update")
+        session.close()
+        return False
+
+    for next_version in range(version + 1, db_version + 1):
+        logger.info(f"Upgrading database from version {next_version - 1} to {next_version}")
+        time_started = time.time()
+        upgrades[next_version](engine)
+        insert_or_update_db_version(session, next_version)
+        logger.debug(f"Execution Time: Upgrade to version {next_version}: {time.time() - time_started} seconds")
+
+    session.close()
+    return True
+
+
 def init(db_path, db_version):
     engine = connect(db_path)
     session = create_session(engine)
@@ -74,6 +202,23 @@ def insert_or_update_db_version(session, db_version):
     commit(session)
 
 
+def get_config_value(session, name):
+    entry = session.query(Config).filter(Config.name == name).first()
+    if entry is None:
+        return None
+    return entry.value
+
+
+def set_config_value(session, name, value):
+    entry = session.query(Config).filter(Config.name == name).first()
+    if entry is None:
+        entry = Config(name=name)
+        session.add(entry)
+
+    entry.value = str(value)
+    commit(session)
+
+
 def file_exists_by_path(session, relative_path):
     """
     Check if filename known in database
@@ -98,33 +243,95 @@ def insert_file(session, filename, relative_path):
     return file
 
 
-def get_file_by_md5(session, md5):
-    return session.query(File).filter(File.md5sum_file == md5).first()
+def insert_files(session, files, chunk_size=500):
+    """
+    Create many new file entries in one transaction (executemany)
+    Paths which are already used (entries flagged as deleted) are ignored.
+    :param session: orm session
+    :param files: list of tuples (file name, relative file path)
+    :param chunk_size: paths per id query (SQLite limits the number of variables)
+    :return: dict relative file path -> inserted file id
+    """
+    values = [{'filename': filename, 'path': relative_path} for filename, relative_path in files]
+    commit(session, execute=lambda: session.execute(File.__table__.insert().prefix_with('OR IGNORE'), values))
+    ids = {}
+    paths = [relative_path for filename, relative_path in files]
+    for i in range(0, len(paths), chunk_size):
+        rows = session.query(File.id, File.path).filter(File.path.in_(paths[i:i + chunk_size]),
+                                                        File.deleted.is_(False))
+        ids.update({path: id for id, path in rows})
+    commit(session)
+    return ids
+
+
+def get_file_by_id(session, id):
+    return session.query(File).filter(File.id == id).first()
+
+
+def get_file_by_md5(session, md5, algorithm='md5'):
+    """
+    :param md5: digest of the file content
+    :param algorithm: hash algorithm of the digest
+    :return: file object with the same content or None
+    """
+    return session.query(File).filter(File.md5sum_file == md5, File.hash_algorithm_file == algorithm).first()
+
 
+def pending_changes(session):
+    """
+    :return: tuple (new objects, list of tuples (changed object, changed values), deleted objects) of the session
+    """
+    changed = []
+    for obj in session.dirty:
+        values = {attr.key: attr.value for attr in inspect(obj).attrs if attr.history.has_changes()}
+        if values:
+            changed.append((obj, values))
+    return list(session.new), changed, list(session.deleted)
 
-def commit(session):
+
+def apply_changes(session, changes):
+    """
+    Apply changes recorded by pending_changes again, e.g. after a rollback
+    """
+    new, changed, deleted = changes
+    for obj, values in changed:
+        for key, value in values.items():
+            setattr(obj, key, value)
+    session.add_all(new)
+    for obj in deleted:
+        session.delete(obj)
+
+
+def commit(session, max_tries=10, max_delay=10, execute=None):
+    """
+    Commit with retries, SQLite already waited 'busy_timeout' for the lock. Retries back off exponentially
+    (0.1s, 0.2s, 0.4s, ... up to max_delay, with jitter, so waiting threads don't retry at the same time)
+    A failed try rolls the transaction back, the changed objects of the session are recorded before and applied again
+    for the next try.
+    :param execute: function running statements of the transaction which are not tracked by the session (e.g. bulk
+                    updates), called before every try
+    """
+    changes = pending_changes(session)
     try_count = 0
     while True:
         try_count += 1
         try:
+            if execute is not None:
+                execute()
             session.commit()
             break
-        except OperationalError as error:
-            if try_count > 10:
-                logger.error(f"Database locked, giving up. ({try_count}/10). Error: {error}")
+        except (OperationalError, sqlite3.OperationalError) as error:
+            if try_count >= max_tries:
+                logger.error(f"Database locked, giving up. ({try_count}/{max_tries}). Error: {error}")
                 logger.error(f"Please run ./main.py db repair to remove stale entries!")
                 sys.exit(1)
             else:
-                logger.warning(f"Database locked, waiting 5 seconds for next retry ({try_count}/10). Error: {error}")
-                time.sleep(5)
-        except sqlite3.OperationalError:
-            if try_count > 10:
-                logger.error(f"Database locked, giving up. ({try_count}/10). Error: {error}")
-                logger.error(f"Please run ./main.py db repair to remove stale entries!")
-                sys.exit(1)
-            else:
-                logger.warning(f"Database locked, waiting 5 seconds for next retry ({try_count}/10). Error: {error}")
-                time.sleep(5)
+                delay = min(0.1 * 2 ** (try_count - 1), max_delay) * random.uniform(0.5, 1)
+                logger.warning(f"Database locked, waiting {delay:.2f} seconds for next retry "
+                               f"({try_count}/{max_tries}). Error: {error}")
+                time.sleep(delay)
+                session.rollback()
+                apply_changes(session, changes)
 
 
 def update_file_after_download(session, file, filesize, mtime, downloaded_date, md5):
@@ -147,6 +354,29 @@ def update_file_after_download(session, file, filesize, mtime, downloaded_date,
     commit(session)
 
 
+def get_or_create_config_value(session, name, create):
+    """
+    :param create: function returning the value if it doesn't exist yet
+    :return: stored value
+    """
+    value = get_config_value(session, name)
+    if value is None:
+        value = create()
+        set_config_value(session, name, value)
+    return value
+
+
+def update_files(session, mappings):
+    """
+    Update many file entries in one transaction
+    :param session: orm session
+    :param mappings: iterable of dicts with 'id' and the column values to set
+    :return:
+    """
+    mappings = list(mappings)
+    commit(session, execute=lambda: session.bulk_update_mappings(File, mappings))
+
+
 def update_duplicate_file_after_download(session, file, duplicate_file, mtime, downloaded_date):
     """
     Add an alternative file if file already exists(by md5sum)
@@ -235,22 +465,110 @@ def update_broken_db_encrypt_entry(session, file):
 
 
 def get_files_to_be_written(session):
+    # Path order, the tape planner keeps directories together in this order
     return session.query(File).filter(
         File.downloaded.is_(True),
         File.encrypted.is_(True),
         File.written.is_(False)
-    ).all()
+    ).order_by(File.path).all()
+
+
+def iter_not_deleted_files(session, chunk_size=10000):
+    """
+    Stream all not deleted files ordered by path, read in chunks (keyset pagination), so no read lock is held
+    between chunks and only one chunk is in memory
+    :param session: orm session
+    :param chunk_size: rows per query
+    :return: generator of tuples (path, filesize, mtime)
+    """
+    last_path = None
+    while True:
+        query = session.query(File.path, File.filesize, File.mtime).filter(File.deleted.is_(False))
+        if last_path is not None:
+            query = query.filter(File.path > last_path)
+        rows = query.order_by(File.path).limit(chunk_size).all()
+        if not rows:
+            break
+        for row in rows:
+            yield tuple(row)
+        last_path = rows[-1][0]
 
 
-def get_not_deleted_files(session, base_path):
-    return_data = []
-    for tut in session.query(File.path).filter(File.deleted.is_(False)).all():
-        return_data.append(f"{base_path}/{tut[0]}")
-    return return_data
+def get_not_deleted_file_by_path(session, relative_path):
+    """
+    :param session: orm session
+    :param relative_path: relative file path
+    :return: tuple (path, filesize, mtime) or None, same format as iter_not_deleted_files
+    """
+    row = session.query(File.path, File.filesize, File.mtime).filter(
+        File.path == relative_path,
+        File.deleted.is_(False)
+    ).first()
+    if row is None:
+        return None
+    return tuple(row)
+
+
+def file_is_referenced(session, file):
+    """
+    Check if other rows depend on a file (duplicates of it or restore jobs)
+    """
+    if session.query(File.id).filter(File.duplicate_id == file.id).first() is not None:
+        return True
+    return session.query(RestoreJobFileMap.id).filter(RestoreJobFileMap.file_id == file.id).first() is not None
 
 
-def set_file_deleted(session, filepath, base_path):
-    file = session.query(File).filter(File.path == filepath.replace(base_path, '').strip("/")).first()
+def version_file(session, file, keep_downloaded=True):
+    """
+    Keep a file entry as old version: the path is renamed like GNU backups ('path.~N~'), so the path is free for the
+    new version, and the entry is flagged as deleted
+    :param session: orm session
+    :param file: file object
+    :param keep_downloaded: False if the content of the old version is not available anymore (won't get encrypted)
+    :return: new path of the old version
+    """
+    file.path = next_version_path(session, file.path)
+    file.deleted = True
+    if not keep_downloaded:
+        file.downloaded = False
+    commit(session)
+    return file.path
+
+
+def next_version_path(session, relative_path, taken=()):
+    """
+    :param relative_path: path of the file
+    :param taken: paths which are about to be used
+    :return: first unused path of an old version ('path.~N~')
+    """
+    version = 1
+    while f"{relative_path}.~{version}~" in taken \
+            or session.query(File.id).filter(File.path == f"{relative_path}.~{version}~").first() is not None:
+        version += 1
+    return f"{relative_path}.~{version}~"
+
+
+def get_version_by_path(session, relative_path):
+    """
+    A file in the source can have the name of an old version
+    :return: tuple (file object of the old version which uses this path, path of its file) or (None, None)
+    """
+    match = VERSION_SUFFIX.search(relative_path)
+    if match is None:
+        return None, None
+    file = session.query(File).filter(File.path == relative_path, File.deleted.is_(True)).first()
+    if file is None:
+        return None, None
+    return file, relative_path[:match.start()]
+
+
+def rename_file(session, file, relative_path):
+    file.path = relative_path
+    commit(session)
+
+
+def set_file_deleted(session, relative_path):
+    file = session.query(File).filter(File.path == relative_path).first()
     file.deleted = True
     commit(session)
     return file.id
@@ -287,6 +605,35 @@ def filename_encrypted_already_used(session, filename_encrypted):
         return False
 
 
+def assign_filenames_encrypted(session, file_ids, create_filename, chunk_size=500):
+    """
+    Choose the encrypted filenames of many files and commit them in one transaction before the files are encrypted,
+    so 'db repair' finds the encrypted files after a crash. Files which already have one (interrupted run) keep it.
+    :param session: orm session
+    :param file_ids: ids of the file entries
+    :param create_filename: function returning a new random filename
+    :param chunk_size: ids per query (SQLite limits the number of variables)
+    :return: dict file id -> filename_encrypted
+    """
+    names = {}
+    for i in range(0, len(file_ids), chunk_size):
+        names.update(session.query(File.id, File.filename_encrypted).filter(File.id.in_(file_ids[i:i + chunk_size])))
+    used = set()
+    mappings = []
+    for file_id in file_ids:
+        if names.get(file_id) is not None:
+            continue
+        filename_enc = create_filename()
+        while filename_enc in used or filename_encrypted_already_used(session, filename_enc):
+            logger.warning(f"Filename ({filename_enc}) encrypted already exists, creating new one!")
+            filename_enc = create_filename()
+        used.add(filename_enc)
+        names[file_id] = filename_enc
+        mappings.append({'id': file_id, 'filename_encrypted': filename_enc})
+    update_files(session, mappings)
+    return names
+
+
 def update_filename_enc(session, id, filename_enc):
     file = session.query(File).filter(File.id == id).first()
     file.filename_encrypted = filename_enc
@@ -321,6 +668,12 @@ def get_files_by_tapelabel(session, label):
     return session.query(File).join(Tape).filter(Tape.label == label).all()
 
 
+def get_written_paths_with_tape(session):
+    return session.query(File.path, Tape.label).join(Tape, File.tape_id == Tape.id).filter(
+        File.written.is_(True)
+    ).all()
+
+
 def get_started_tape(session):
     return session.query(Tape.label).filter(Tape.full.is_(False)).first()
 
@@ -357,6 +710,10 @@ def mark_tape_as_full(session, label, dt, count):
     commit(session)
 
 
+def get_tape_by_label(session, label):
+    return session.query(Tape).filter(Tape.label == label).first()
+
+
 def get_full_tape(session, label):
     return session.query(Tape).filter(Tape.label == label, Tape.full.is_(True)).first()
 
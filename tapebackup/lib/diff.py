@@ -0,0 +1,180 @@
+import heapq
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+logger = logging.getLogger()
+
+NEW = 'new'
+DELETED = 'deleted'
+COMMON = 'common'
+
+
+class ExternalSorter:
+    """
+    Sort an arbitrary number of tuples with bounded memory
+    Up to 'run_size' items are kept in memory, every full run is sorted and spilled into a temporary file.
+    sorted() merges all runs (heapq.merge), only one chunk per run is in memory.
+    """
+    chunk_size = 10000
+
+    def __init__(self, run_size=1000000, tmp_dir=None):
+        self.run_size = max(1, int(run_size))
+        self.tmp_dir = tmp_dir
+        self.items = []
+        self.runs = []
+        self.count = 0
+
+    def add(self, item):
+        self.items.append(item)
+        self.count += 1
+        if len(self.items) >= self.run_size:
+            self.spill()
+
+    def spill(self):
+        time_started = time.time()
+        self.items.sort()
+        run = tempfile.TemporaryFile(prefix='tapebackup-sort-', dir=self.tmp_dir)
+        for i in range(0, len(self.items), self.chunk_size):
+            pickle.dump(self.items[i:i + self.chunk_size], run, protocol=pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self.runs.append(run)
+        logger.debug(f"Spilled sort run #{len(self.runs)} with {len(self.items)} items to disk: "
+                     f"{time.time() - time_started} seconds")
+        self.items = []
+
+    @staticmethod
+    def read_run(run):
+        try:
+            while True:
+                yield from pickle.load(run)
+        except EOFError:
+            pass
+        finally:
+            run.close()
+
+    def sorted(self):
+        """
+        :return: generator of all added items in sorted order
+        """
+        self.items.sort()
+        if not self.runs:
+            items, self.items = self.items, []
+            yield from items
+            return
+        if self.items:
+            self.spill()
+        runs, self.runs = self.runs, []
+        yield from heapq.merge(*(self.read_run(run) for run in runs))
+
+
+def unique_keys(items):
+    """
+    Skip items with the same key as the previous item (e.g. a path listed twice)
+    :param items: sorted iterable of tuples, first element is the key
+    """
+    last = None
+    for item in items:
+        if last is not None and item[0] == last:
+            continue
+        last = item[0]
+        yield item
+
+
+def merge_diff(source, catalog):
+    """
+    Merge join of two sorted streams, repeated keys are only used once
+    :param source: sorted iterable of tuples, first element is the key (relative path)
+    :param catalog: sorted iterable of tuples, first element is the key (relative path)
+    :return: generator of (NEW, source item), (DELETED, catalog item) and (COMMON, source item, catalog item)
+    """
+    source = unique_keys(source)
+    catalog = unique_keys(catalog)
+    s = next(source, None)
+    c = next(catalog, None)
+    while s is not None and c is not None:
+        if s[0] < c[0]:
+            yield NEW, s
+            s = next(source, None)
+        elif s[0] > c[0]:
+            yield DELETED, c
+            c = next(catalog, None)
+        else:
+            yield COMMON, s, c
+            s = next(source, None)
+            c = next(catalog, None)
+    while s is not None:
+        yield NEW, s
+        s = next(source, None)
+    while c is not None:
+        yield DELETED, c
+        c = next(catalog, None)
+
+
+def set_diff(source, catalog):
+    """
+    Diff with the catalog in memory, new entries are yielded while the source is still read
+    :param source: iterable of tuples, first element is the key (relative path)
+    :param catalog: iterable of tuples, first element is the key (relative path)
+    :return: generator of (NEW, source item), (DELETED, catalog item) and (COMMON, source item, catalog item)
+    """
+    catalog = {c[0]: c for c in catalog}
+    seen = set()
+    for s in source:
+        if s[0] in seen:
+            continue
+        seen.add(s[0])
+        c = catalog.pop(s[0], None)
+        if c is None:
+            yield NEW, s
+        else:
+            yield COMMON, s, c
+    for c in catalog.values():
+        yield DELETED, c
+
+
+def lookup_diff(source, lookup):
+    """
+    Diff for small (incremental) source lists: every source entry is looked up in the catalog.
+    No DELETED entries are produced, as the source is not complete.
+    :param source: iterable of tuples, first element is the key (relative path)
+    :param lookup: function key -> catalog item or None
+    :return: generator of (NEW, source item) and (COMMON, source item, catalog item)
+    """
+    seen = set()
+    for s in source:
+        if s[0] in seen:
+            continue
+        seen.add(s[0])
+        c = lookup(s[0])
+        if c is None:
+            yield NEW, s
+        else:
+            yield COMMON, s, c
+
+
+def sorted_merge_diff(source, catalog, run_size=1000000, tmp_dir=None):
+    """
+    Diff with bounded memory: the source is sorted with an external sort, the catalog must be sorted already
+    :param source: iterable of tuples, first element is the key (relative path)
+    :param catalog: sorted iterable of tuples, first element is the key (relative path)
+    :return: generator, see merge_diff
+    """
+    sorter = ExternalSorter(run_size, tmp_dir)
+    time_started = time.time()
+    for s in source:
+        sorter.add(s)
+    logger.debug(f"Execution Time: Collecting {sorter.count} entries for sorting: {time.time() - time_started} "
+                 f"seconds, {len(sorter.runs)} runs spilled to disk")
+    yield from merge_diff(sorter.sorted(), catalog)
+
+
+def is_below(relative_path, relative_dir):
+    """
+    Check if a relative path is inside a relative directory ('.' matches everything)
+    """
+    if relative_dir in ('', '.'):
+        return True
+    return relative_path == relative_dir or relative_path.startswith(relative_dir.rstrip(os.sep) + os.sep)
@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import mmap
+import os
+import threading
+
+logger = logging.getLogger()
+
+# Digests are stored with the algorithm name, entries without an algorithm are md5
+DEFAULT_ALGORITHM = 'md5'
+ALGORITHMS = ('md5', 'sha256', 'blake3', 'xxh3')
+BUFFER_SIZE = 8 * 1024 * 1024
+
+buffers = threading.local()
+
+
+def new(algorithm=DEFAULT_ALGORITHM):
+    """
+    Create a hash object (update()/hexdigest()), blake3 and xxh3 need the optional packages 'blake3' and 'xxhash'
+    :param algorithm: one of ALGORITHMS
+    :return: hash object
+    """
+    if algorithm in ('md5', 'sha256'):
+        return hashlib.new(algorithm)
+    elif algorithm == 'blake3':
+        from blake3 import blake3
+        # Multithreaded hashing of large updates
+        return blake3(max_threads=blake3.AUTO)
+    elif algorithm == 'xxh3':
+        import xxhash
+        return xxhash.xxh3_128()
+    raise ValueError(f"Unknown hash algorithm '{algorithm}', use one of {', '.join(ALGORITHMS)}")
+
+
+def available(algorithm):
+    try:
+        new(algorithm)
+        return True
+    except ImportError:
+        return False
+
+
+def get_buffer(buffer_size=BUFFER_SIZE):
+    """
+    :return: reusable buffer of the current thread
+    """
+    buffer = getattr(buffers, 'buffer', None)
+    if buffer is None or len(buffer) != buffer_size:
+        buffer = bytearray(buffer_size)
+        buffers.buffer = buffer
+    return buffer
+
+
+def hash_reader(reader, algorithm=DEFAULT_ALGORITHM, buffer_size=BUFFER_SIZE):
+    """
+    Hash a binary stream, read with readinto() into a reusable buffer (no allocation per chunk)
+    :param reader: binary file object
+    :param algorithm: one of ALGORITHMS
+    :param buffer_size: bytes per read
+    :return: hex digest
+    """
+    h = new(algorithm)
+    if not hasattr(reader, 'readinto'):
+        for chunk in iter(lambda: reader.read(buffer_size), b''):
+            h.update(chunk)
+        return h.hexdigest()
+
+    buffer = get_buffer(buffer_size)
+    view = memoryview(buffer)
+    while True:
+        n = reader.readinto(buffer)
+        if not n:
+            break
+        h.update(view[:n])
+    return h.hexdigest()
+
+
+def hash_file(path, algorithm=DEFAULT_ALGORITHM, use_mmap=False, buffer_size=BUFFER_SIZE):
+    """
+    Hash a file
+    :param path: filename
+    :param algorithm: one of ALGORITHMS
+    :param use_mmap: map the file instead of reading it (local disks only, not for tape or network filesystems)
+    :param buffer_size: bytes per read or per update of a mapped file
+    :return: hex digest
+    """
+    with open(path, mode='rb', buffering=0) as f:
+        if use_mmap:
+            size = os.fstat(f.fileno()).st_size
+            if size > 0:
+                h = new(algorithm)
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if hasattr(m, 'madvise'):
+                        m.madvise(mmap.MADV_SEQUENTIAL)
+                    view = memoryview(m)
+                    try:
+                        for offset in range(0, size, buffer_size):
+                            h.update(view[offset:offset + buffer_size])
+                    finally:
+                        view.release()
+                return h.hexdigest()
+        return hash_reader(f, algorithm, buffer_size)
@@ -0,0 +1,197 @@
+import logging
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger()
+
+RemoteFile = namedtuple('RemoteFile', ['path', 'size', 'mtime'])
+
+
+class Lister:
+    """
+    Streaming file listing of remote (via ssh transport) or local directories
+    Every entry is a RemoteFile(path, size, mtime), mtime as unix timestamp. Size and mtime are None if unknown.
+    Remote listings run one 'find' per top level subdirectory concurrently and yield entries while 'find' is running.
+    """
+    def __init__(self, config, transport=None, workers=None):
+        self.config = config
+        self.transport = transport
+        if workers is None:
+            workers = self.config['threads'].get('list', 4)
+        self.workers = max(1, int(workers))
+        self.count = 0
+
+    @staticmethod
+    def find_command(directory, maxdepth=None, newer_than=None):
+        """
+        :param directory: absolut path on remote server
+        :param maxdepth: passed to find -maxdepth
+        :param newer_than: unix timestamp, only files with a newer ctime (created, modified, renamed) are printed
+        :return: shell command, prints NUL terminated records: type, size, mtime, path
+        """
+        command = f"find {shlex.quote(directory)} -mindepth 1"
+        if maxdepth is not None:
+            command += f" -maxdepth {int(maxdepth)}"
+        if newer_than is not None:
+            # Directories are always needed for the fan out
+            command += f" \\( -type d -o -newerct @{int(newer_than)} \\)"
+        return command + " -printf '%y\\t%s\\t%T@\\t%p\\0'"
+
+    def run_find(self, command, stop, processes):
+        """
+        Run find on the remote server and yield parsed records
+        :param command: remote shell command
+        :param stop: threading.Event, stop reading if set
+        :param processes: set of running processes, killed by the caller on stop
+        :return: generator of tuples (type, RemoteFile)
+        """
+        process = subprocess.Popen(self.transport.command(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   preexec_fn=os.setpgrp)
+        processes.add(process)
+        rest = b''
+        try:
+            for chunk in iter(lambda: process.stdout.read1(1048576), b''):
+                records = (rest + chunk).split(b'\0')
+                rest = records.pop()
+                for record in records:
+                    ftype, size, mtime, path = record.decode('utf-8', errors='surrogateescape').split('\t', 3)
+                    yield ftype, RemoteFile(path, int(size), int(float(mtime)))
+                if stop.is_set():
+                    process.kill()
+                    break
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read().decode('utf-8', errors='replace')
+            process.stderr.close()
+            rc = process.wait()
+            processes.discard(process)
+        if rc != 0 and not stop.is_set():
+            raise RuntimeError(f"'{command}' failed with return code {rc}: {stderr.strip()}")
+
+    def remote_time(self):
+        """
+        :return: current unix time of the remote server
+        """
+        self.transport.ensure()
+        output = subprocess.run(self.transport.command('date +%s'), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if output.returncode != 0:
+            logger.error(f"Failed to get time of remote server, error: {output.stderr}")
+            sys.exit(1)
+        return int(output.stdout.decode('utf-8').strip())
+
+    def remote(self, directory, newer_than=None):
+        """
+        List all files below a remote directory, fanned out over top level subdirectories
+        :param directory: absolut path on remote server
+        :param newer_than: unix timestamp, only list files changed after it (incremental scan)
+        :return: generator of RemoteFile
+        """
+        time_started = time.time()
+        self.count = 0
+        stop = threading.Event()
+        processes = set()
+        records = queue.Queue(maxsize=100000)
+        subdirectories = []
+        running = 0
+        done = object()
+
+        logger.info(f"Retrieving file list from server {self.config['remote-server']} directory {directory}")
+        self.transport.ensure()
+        try:
+            for ftype, entry in self.run_find(self.find_command(directory, 1, newer_than), stop, processes):
+                if ftype == 'd':
+                    subdirectories.append(entry.path)
+                elif ftype == 'f':
+                    self.count += 1
+                    yield entry
+
+            def producer(subdirectory):
+                try:
+                    for ftype, entry in self.run_find(self.find_command(subdirectory, newer_than=newer_than), stop, processes):
+                        if ftype == 'f':
+                            records.put(entry)
+                        if stop.is_set():
+                            break
+                except Exception as e:
+                    records.put(e)
+                finally:
+                    records.put(done)
+
+            logger.debug(f"Listing {len(subdirectories)} subdirectories with {self.workers} workers")
+            pending = list(subdirectories)
+            running = 0
+            while pending or running > 0:
+                while pending and running < self.workers:
+                    threading.Thread(target=producer, args=(pending.pop(0),), daemon=True).start()
+                    running += 1
+                entry = records.get()
+                if entry is done:
+                    running -= 1
+                elif isinstance(entry, Exception):
+                    raise entry
+                else:
+                    self.count += 1
+                    if self.count % 100000 == 0:
+                        logger.info(f"Entries found until now: {self.count}")
+                    yield entry
+        except RuntimeError as e:
+            logger.error(f"Failed to retrieve filelist from remote server, error: {e}")
+            sys.exit(1)
+        finally:
+            stop.set()
+            for process in list(processes):
+                if process.poll() is None:
+                    process.kill()
+            # Unblock producers waiting on a full queue
+            while running > 0:
+                try:
+                    if records.get(timeout=1) is done:
+                        running -= 1
+                except queue.Empty:
+                    pass
+            logger.debug(f"Execution Time: Building filelist: {time.time() - time_started} seconds")
+
+        logger.info(f"Got file list from server {self.config['remote-server']} directory '{directory}'")
+        logger.info(f"Entries found: {self.count}")
+
+    def local(self, directory, newer_than=None):
+        """
+        List all files below a local directory
+        :param directory: local path
+        :param newer_than: unix timestamp, only list files changed after it (incremental scan)
+        :return: generator of RemoteFile
+        """
+        time_started = time.time()
+        self.count = 0
+        for root, dirs, files in os.walk(directory):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    st = os.stat(path)
+                except OSError as e:
+                    logger.warning(f"Can't stat file {path}: {e.strerror}")
+                    continue
+                if newer_than is not None and st.st_ctime <= newer_than:
+                    continue
+                self.count += 1
+                yield RemoteFile(path, st.st_size, int(st.st_mtime))
+        logger.debug(f"Execution Time: Building filelist: {time.time() - time_started} seconds")
+
+    @staticmethod
+    def from_file(file):
+        """
+        Read a list of absolut paths (one per line), size and mtime are unknown
+        :param file: filename
+        :return: generator of RemoteFile
+        """
+        with open(file) as f:
+            for line in f:
+                line = line.strip()
+                if line != "":
+                    yield RemoteFile(line, None, None)
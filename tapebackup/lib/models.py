@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, UniqueConstraint, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, UniqueConstraint, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 Base = declarative_base()
@@ -31,6 +31,11 @@ class File(Base):
     filesize_encrypted = Column(Integer)
     md5sum_file = Column(String)
     md5sum_encrypted = Column(String)
+    # Algorithm of md5sum_file/md5sum_encrypted (see lib/hashing.py), the columns keep their historical names
+    hash_algorithm_file = Column(String, default='md5')
+    hash_algorithm_encrypted = Column(String, default='md5')
+    # Format of the encrypted file: 1 openssl enc (aes-256-cbc, pbkdf2 per file), 2 and 3 (chunked) see lib/crypto.py
+    encryption_format = Column(Integer, default=1)
     tape_id = Column(Integer, ForeignKey('tape.id'))
     downloaded_date = Column(DateTime)
     encrypted_date = Column(DateTime)
@@ -47,6 +52,15 @@ class File(Base):
     tape = relationship("Tape", back_populates="files")
     restoreJobFileMap = relationship("RestoreJobFileMap", back_populates="file")
 
+    # Indexes for the hot queries, existing databases get them with './main.py db upgrade' (model version 2)
+    __table_args__ = (
+        Index('ix_file_md5sum_file', 'md5sum_file'),
+        Index('ix_file_duplicate_id', 'duplicate_id'),
+        Index('ix_file_tape_id', 'tape_id'),
+        Index('ix_file_deleted_path', 'deleted', 'path'),
+        Index('ix_file_downloaded_encrypted_written', 'downloaded', 'encrypted', 'written'),
+    )
+
     def __repr__(self):
         return f'File object: {self.path}'
 
@@ -91,7 +105,10 @@ class RestoreJobFileMap(Base):
     file = relationship("File", back_populates="restoreJobFileMap")
     restore_job = relationship("RestoreJob")
 
-    __table_args__ = (UniqueConstraint('file_id', 'restore_job_id'),)
+    __table_args__ = (
+        UniqueConstraint('file_id', 'restore_job_id'),
+        Index('ix_restore_job_file_map_restore_job_id_restored', 'restore_job_id', 'restored'),
+    )
 
     def __repr__(self):
         return f'Restore job file map object: {self.id}'
@@ -0,0 +1,209 @@
+import logging
+import time
+import numpy as np
+
+logger = logging.getLogger()
+
+# Native capacity of the LTO generations, used for planning reports if 'tape-capacity' isn't set
+LTO_CAPACITY = {5: 1500 * 1000 ** 3, 6: 2500 * 1000 ** 3, 7: 6000 * 1000 ** 3, 8: 12000 * 1000 ** 3,
+                9: 18000 * 1000 ** 3}
+
+
+def allocated_sizes(sizes, block_size):
+    """
+    :param sizes: numpy array of file sizes
+    :param block_size: LTFS block size, every file takes whole blocks
+    :return: numpy array of the space the files take on tape
+    """
+    return np.maximum(1, -(-sizes // block_size)) * block_size
+
+
+def first_fit_decreasing(sizes, capacity):
+    """
+    Select the files for one tape: the biggest files first, the remaining space is topped off with the biggest files
+    which still fit (first fit decreasing for one bin)
+    Instead of one loop step per file, every round takes the longest run of sorted files which fits (prefix sums and
+    binary search), then skips the files which are bigger than the remaining space. Only a few rounds are needed.
+    :param sizes: numpy array of sizes on tape
+    :param capacity: usable bytes on the tape
+    :return: numpy array of the selected indexes, biggest file first
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    order = np.argsort(-sizes, kind='stable')
+    sorted_sizes = sizes[order]
+    # Ascending keys for binary search over the descending sizes
+    negated = -sorted_sizes
+    prefix = np.concatenate(([0], np.cumsum(sorted_sizes)))
+    selected = np.zeros(len(sizes), dtype=bool)
+
+    remaining = int(capacity)
+    start = 0
+    while start < len(sorted_sizes) and remaining > 0:
+        # First file which fits into the remaining space
+        start = max(start, int(np.searchsorted(negated, -remaining, side='left')))
+        if start >= len(sorted_sizes):
+            break
+        # Longest run from there which fits
+        end = int(np.searchsorted(prefix, prefix[start] + remaining, side='right')) - 1
+        selected[start:end] = True
+        remaining -= int(prefix[end] - prefix[start])
+        start = end
+    return order[selected]
+
+
+def group_ids(paths, depth):
+    """
+    Group paths by their first 'depth' directories (0: the whole directory), paths directly in a shallower directory
+    are grouped by their directory
+    Consecutive paths below the same full depth directory are assigned without splitting them again, so paths in path
+    order (see database.get_files_to_be_written) are grouped quickly.
+    :param paths: iterable of relative paths
+    :param depth: count of leading directories which form the group, 0 for the whole directory
+    :return: tuple (list of group keys, numpy array of the group index of every path)
+    """
+    index = {}
+    ids = []
+    prefix = None
+    group = -1
+    for path in paths:
+        if prefix is not None and path.startswith(prefix):
+            ids.append(group)
+            continue
+        path = path.strip('/')
+        parts = path.split('/', depth) if depth > 0 else ()
+        if len(parts) > depth:
+            key = '/'.join(parts[:depth])
+            # Every path below this directory belongs to the same group
+            prefix = key + '/'
+        else:
+            key = path.rpartition('/')[0]
+            prefix = None
+        group = index.setdefault(key, len(index))
+        ids.append(group)
+    return list(index), np.array(ids, dtype=np.int64)
+
+
+def select_grouped(allocated, groups, capacity):
+    """
+    Select the files for one tape while keeping directories together
+        1. whole directories, biggest first (first fit decreasing over the directory sizes)
+        2. the start of the biggest remaining directory (in path order), it is continued on the next tape
+        3. the remaining space is topped off with single files like plan_tape without grouping
+    Every directory which doesn't fit on the tape is bigger than the space left after step 1, so step 2 fills most of
+    it and step 3 only adds a few small files.
+    :param allocated: numpy array of the sizes on tape, in path order
+    :param groups: numpy array of the group index of every file
+    :param capacity: usable bytes on the tape
+    :return: numpy array of the selected indexes (ascending, so in path order)
+    """
+    totals = np.bincount(groups, weights=allocated).astype(np.int64)
+    whole = np.zeros(len(totals), dtype=bool)
+    whole[first_fit_decreasing(totals, capacity)] = True
+    selected = whole[groups]
+    remaining = int(capacity) - int(totals[whole].sum())
+
+    rest = np.flatnonzero(~whole & (totals > 0))
+    if len(rest) > 0 and remaining > 0:
+        split = rest[np.argmax(totals[rest])]
+        members = np.flatnonzero(groups == split)
+        prefix = np.cumsum(allocated[members])
+        end = int(np.searchsorted(prefix, remaining, side='right'))
+        selected[members[:end]] = True
+        if end > 0:
+            remaining -= int(prefix[end - 1])
+
+    if remaining > 0:
+        others = np.flatnonzero(~selected)
+        selected[others[first_fit_decreasing(allocated[others], remaining)]] = True
+    return np.flatnonzero(selected)
+
+
+def plan_tape(files, capacity, block_size, depth=None):
+    """
+    Plan the files written to one tape
+    :param files: list of file objects (path, filesize_encrypted) in path order
+    :param capacity: usable bytes on the tape (free minus tape-keep-free)
+    :param block_size: LTFS block size
+    :param depth: group by directory ('tape-locality-depth'), None to fill the tape without grouping
+    :return: list of the planned files in write order
+    """
+    time_started = time.time()
+    sizes = np.fromiter((file.filesize_encrypted or 0 for file in files), dtype=np.int64, count=len(files))
+    allocated = allocated_sizes(sizes, block_size)
+    if depth is None:
+        selected = first_fit_decreasing(allocated, capacity)
+    else:
+        keys, groups = group_ids((file.path for file in files), depth)
+        # Directories are written in one piece and in path order, so a restore reads them with few seeks
+        selected = select_grouped(allocated, groups, capacity)
+        logger.info(f"Tape plan: {len(np.unique(groups[selected]))} of {len(keys)} directories")
+    planned = int(allocated[selected].sum())
+    logger.info(f"Tape plan: {len(selected)} of {len(files)} files, {planned} of {capacity} bytes "
+                f"({planned / max(capacity, 1) * 100:.2f}% of the usable space)")
+    logger.debug(f"Execution Time: Planning tape: {time.time() - time_started} seconds")
+    return [files[i] for i in selected]
+
+
+def simulate(sizes, capacities, capacity, block_size, groups=None):
+    """
+    Plan all files onto tapes like repeated write runs would do
+    :param sizes: numpy array of the file sizes (filesize_encrypted) in path order
+    :param capacities: usable bytes of the tapes which are written first (e.g. the started tape)
+    :param capacity: usable bytes of a fresh tape
+    :param groups: numpy array of the group index of every file (group_ids), None without grouping
+    :return: tuple (numpy array of the tape number of every file, count of tapes)
+    :raise ValueError: a file is bigger than a fresh tape
+    """
+    allocated = allocated_sizes(sizes, block_size)
+    tape_of = np.full(len(sizes), -1, dtype=np.int64)
+    pending = np.arange(len(sizes))
+    capacities = list(capacities)
+    tape = 0
+    while len(pending) > 0:
+        fresh = not capacities
+        usable = capacity if fresh else capacities.pop(0)
+        if groups is None:
+            selected = first_fit_decreasing(allocated[pending], usable)
+        else:
+            selected = select_grouped(allocated[pending], groups[pending], usable)
+        if len(selected) == 0 and fresh:
+            raise ValueError(f"File #{pending[np.argmax(allocated[pending])]} doesn't fit on a tape")
+        tape_of[pending[selected]] = tape
+        pending = np.delete(pending, selected)
+        tape += 1
+    return tape_of, tape
+
+
+def locality_depth(config):
+    """
+    :return: 'tape-locality-depth' from the config, None if grouping is disabled
+    """
+    depth = config.get('tape-locality-depth', '')
+    if depth is None or str(depth).strip() == '':
+        return None
+    return int(depth)
+
+
+def lto_capacity(label):
+    """
+    :param label: tape label with the LTO generation at the end (e.g. Y00001L5)
+    :return: native capacity of the tape or None if unknown
+    """
+    if len(label) >= 2 and label[-2] == 'L' and label[-1].isdigit():
+        return LTO_CAPACITY.get(int(label[-1]))
+    return None
+
+
+def choose_tape(started_tape, tapes):
+    """
+    Continue the started (not full) tape if it is in the library, otherwise take a fresh one
+    :param started_tape: label of the started tape or None
+    :param tapes: labels of the usable tapes in the library (the chosen one is removed)
+    :return: label of the tape to write
+    """
+    if started_tape is not None and started_tape in tapes:
+        tapes.remove(started_tape)
+        return started_tape
+    if started_tape is not None:
+        logger.warning(f"Started tape {started_tape} is not in the library, using a fresh tape")
+    return tapes.pop(0)
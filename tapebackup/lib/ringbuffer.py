@@ -0,0 +1,117 @@
+import logging
+import queue
+import time
+
+logger = logging.getLogger()
+
+
+class RingBufferAborted(OSError):
+    pass
+
+
+class RingBuffer:
+    """
+    Bounded in-memory buffer between one producer and one consumer thread (e.g. encryption and tape writer)
+    The memory is preallocated as chunks which circulate between the two sides, nothing is allocated per chunk.
+    The producer either fills chunks itself (acquire/commit, e.g. readinto) or writes data (write/flush). Markers
+    (e.g. end of a file) are delivered to the consumer in order with the data.
+    The wait times tell which side is the bottleneck: the producer waits for free chunks if the consumer is slower,
+    the consumer waits for filled chunks if the producer is slower.
+    """
+    def __init__(self, size, chunk_size=8 * 1024 * 1024):
+        self.chunk_size = chunk_size
+        self.chunks = max(2, size // chunk_size)
+        self.free = queue.Queue()
+        self.filled = queue.Queue()
+        for _ in range(self.chunks):
+            self.free.put(bytearray(chunk_size))
+        self.current = None
+        self.current_length = 0
+        self.aborted = None
+        self.producer_wait = 0.0
+        self.consumer_wait = 0.0
+        self.bytes = 0
+
+    @property
+    def size(self):
+        return self.chunks * self.chunk_size
+
+    def wait(self, q):
+        while True:
+            if self.aborted is not None:
+                raise RingBufferAborted(f"ring buffer aborted: {self.aborted}")
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                pass
+
+    def acquire(self):
+        """
+        :return: free chunk (bytearray of chunk_size), blocks while all chunks are filled
+        """
+        time_started = time.time()
+        chunk = self.wait(self.free)
+        self.producer_wait += time.time() - time_started
+        return chunk
+
+    def commit(self, chunk, length):
+        """
+        Hand a chunk filled with length bytes to the consumer
+        """
+        self.bytes += length
+        self.filled.put((chunk, length, None))
+
+    def write(self, data):
+        """
+        Copy data into chunks, full chunks are handed to the consumer (file object interface)
+        :return: number of bytes written
+        """
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            if self.current is None:
+                self.current = self.acquire()
+                self.current_length = 0
+            n = min(len(view) - written, self.chunk_size - self.current_length)
+            self.current[self.current_length:self.current_length + n] = view[written:written + n]
+            self.current_length += n
+            written += n
+            if self.current_length == self.chunk_size:
+                self.flush()
+        return written
+
+    def flush(self):
+        """
+        Hand the partially filled chunk of write() to the consumer
+        """
+        if self.current is not None:
+            self.commit(self.current, self.current_length)
+            self.current = None
+
+    def mark(self, item):
+        """
+        Deliver item to the consumer after all data written until now (e.g. end of a file)
+        """
+        self.flush()
+        self.filled.put((None, 0, item))
+
+    def get(self):
+        """
+        :return: tuple (chunk, length, None) or (None, 0, marker), blocks while nothing is filled
+        """
+        time_started = time.time()
+        entry = self.wait(self.filled)
+        self.consumer_wait += time.time() - time_started
+        return entry
+
+    def release(self, chunk):
+        """
+        Return a chunk to the producer after it is consumed
+        """
+        self.free.put(chunk)
+
+    def abort(self, reason):
+        """
+        Stop both sides, blocked and later calls raise RingBufferAborted
+        """
+        self.aborted = reason
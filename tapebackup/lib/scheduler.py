@@ -0,0 +1,142 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger()
+
+
+class Scheduler:
+    """
+    Bounded worker pool for one pipeline stage (get, encrypt, ...)
+    Jobs are put into a bounded queue, submit() blocks while the queue is full. Every job returns a future.
+    The number of workers is the concurrency limit of the stage, independent of other threads in the process.
+    """
+    def __init__(self, stage, workers, queue_size=None):
+        self.stage = stage
+        self.workers = max(1, int(workers))
+        if queue_size is None:
+            queue_size = self.workers * 2
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.time_started = time.time()
+        self.busy_time = [0.0] * self.workers
+        self.jobs_done = [0] * self.workers
+        self.jobs_failed = 0
+        self.max_queue_depth = 0
+        self.threads = []
+        for nr in range(self.workers):
+            thread = threading.Thread(target=self.worker, args=(nr,), name=f"{stage}-{nr}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def worker(self, nr):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+
+            future, fn, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                self.queue.task_done()
+                continue
+
+            time_started = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                logger.exception(f"Worker #{nr} of stage '{self.stage}' failed: {e}")
+                with self.lock:
+                    self.jobs_failed += 1
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                with self.lock:
+                    self.busy_time[nr] += time.time() - time_started
+                    self.jobs_done[nr] += 1
+                self.queue.task_done()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue a job, blocks while the queue is full
+        :param fn: callable to run in a worker
+        :return: future of the job
+        """
+        future = Future()
+        self.queue.put((future, fn, args, kwargs))
+        depth = self.queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        return future
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def cancel_pending(self):
+        """
+        Remove all jobs which are not started yet from the queue, running jobs will finish
+        :return: count of cancelled jobs
+        """
+        count = 0
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job[0].cancel()
+                count += 1
+            self.queue.task_done()
+        if count > 0:
+            logger.info(f"Cancelled {count} queued jobs of stage '{self.stage}'")
+        return count
+
+    def join(self):
+        """
+        Wait until all queued jobs are finished
+        """
+        self.queue.join()
+
+    def shutdown(self, cancel=False):
+        """
+        Stop all workers, waits for running jobs
+        :param cancel: Cancel queued jobs instead of processing them
+        """
+        if cancel:
+            self.cancel_pending()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.log_stats()
+
+    def stats(self):
+        """
+        Utilisation of every worker (busy time / runtime) and queue depth
+        :return: dictionary with stats
+        """
+        elapsed = max(time.time() - self.time_started, 0.000001)
+        with self.lock:
+            return {
+                'stage': self.stage,
+                'elapsed': elapsed,
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'jobs_done': sum(self.jobs_done),
+                'jobs_failed': self.jobs_failed,
+                'workers': [
+                    {'worker': nr, 'jobs': self.jobs_done[nr], 'utilisation': self.busy_time[nr] / elapsed}
+                    for nr in range(self.workers)
+                ]
+            }
+
+    def log_stats(self, level=logging.INFO):
+        stats = self.stats()
+        utilisation = ", ".join(f"#{w['worker']}: {w['utilisation'] * 100:.1f}% ({w['jobs']} jobs)"
+                                for w in stats['workers'])
+        logger.log(level, f"Stage '{stats['stage']}': {stats['jobs_done']} jobs done, {stats['jobs_failed']} failed, "
+                          f"queue depth: {stats['queue_depth']} (max {stats['max_queue_depth']}), "
+                          f"worker utilisation: {utilisation}")
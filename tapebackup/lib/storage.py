@@ -0,0 +1,96 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger()
+
+
+class StorageBudget:
+    """
+    Storage usage of the local working directories (local-data-dir, local-enc-dir, local-verify-dir) compared with
+    'max_storage_usage'
+    The directories are walked once (seed), afterwards the usage is tracked by the operations which add or remove
+    files. All methods are thread safe. Other processes (e.g. encrypt while get is running) are only noticed with a
+    resync every 'max_storage_usage-resync' seconds.
+    """
+    def __init__(self, config, tools):
+        self.config = config
+        self.tools = tools
+        self.limit = None
+        if config.get('max_storage_usage') not in ('', None):
+            self.limit = tools.back_convert_size(str(config['max_storage_usage']))
+        self.resync_interval = int(config.get('max_storage_usage-resync') or 0)
+        self.used = None
+        self.last_sync = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.limit is not None
+
+    def directories(self):
+        return [self.config[d] for d in ('local-data-dir', 'local-enc-dir', 'local-verify-dir')
+                if self.config.get(d) and os.path.isdir(self.config[d])]
+
+    def seed(self):
+        """
+        Walk all directories once and set the current usage (also used to resync)
+        """
+        if not self.enabled:
+            return
+        time_started = time.time()
+        used = sum(self.tools.folder_size(directory) for directory in self.directories())
+        with self.lock:
+            if self.used is not None:
+                logger.debug(f"Storage usage resync, drift: {self.tools.convert_size(abs(used - self.used))}")
+            self.used = used
+            self.last_sync = time.time()
+        logger.info(f"Storage usage: {self.tools.convert_size(used)} of {self.tools.convert_size(self.limit)}")
+        logger.debug(f"Execution Time: Calculate storage usage: {time.time() - time_started} seconds")
+
+    def sync_if_needed(self):
+        if self.used is None or (self.resync_interval > 0 and time.time() - self.last_sync >= self.resync_interval):
+            self.seed()
+
+    def check(self, size=0):
+        """
+        :param size: size of a file which will be added, 0 if unknown
+        :return: True if the file fits into the budget (always True if no 'max_storage_usage' is configured)
+        """
+        if not self.enabled:
+            return True
+        self.sync_if_needed()
+        with self.lock:
+            return self.used + size < self.limit
+
+    def reserve(self, size=0):
+        """
+        Check and account a file before it is downloaded, correct it afterwards with add()/release()
+        :param size: expected size in bytes, 0 if unknown
+        :return: True if reserved, False if the budget is exhausted
+        """
+        if not self.enabled:
+            return True
+        self.sync_if_needed()
+        with self.lock:
+            if self.used + size >= self.limit:
+                return False
+            self.used += size
+            return True
+
+    def add(self, size):
+        """
+        Account bytes written into one of the directories (ignored until seeded)
+        """
+        with self.lock:
+            if self.used is not None:
+                self.used += size or 0
+
+    def release(self, size):
+        """
+        Account bytes removed from one of the directories (ignored until seeded)
+        """
+        with self.lock:
+            if self.used is not None:
+                self.used = max(self.used - (size or 0), 0)
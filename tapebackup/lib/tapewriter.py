@@ -0,0 +1,183 @@
+import logging
+import os
+import threading
+import time
+from tapebackup.lib import hashing
+from tapebackup.lib.ringbuffer import RingBuffer, RingBufferAborted
+
+logger = logging.getLogger()
+
+
+class TapeWriter:
+    """
+    Double buffered writer which keeps the drive streaming
+    A reader thread prefetches the upcoming files into a large ring buffer, the calling thread drains it into the
+    destination files with large writes (multiple of the LTFS block size). Logging, file lookups and catalog updates
+    are kept out of the write loop (callbacks must be cheap, e.g. CatalogWriter.post).
+    The reader thread hashes every chunk after reading it into the buffer, these are the bytes handed to the tape.
+    With a verify region the written files are read back from tape after every 'verify_region' bytes, while the
+    drive is still positioned close to them. Meanwhile the reader keeps filling the buffer.
+    """
+    def __init__(self, buffer_size, chunk_size=hashing.BUFFER_SIZE, verify_region=0):
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.verify_region = verify_region
+        self.error = None
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.verified_bytes = 0
+        self.verify_seconds = 0.0
+
+    def read(self, ring, jobs, on_skip, checksum):
+        try:
+            for src, dst, item in jobs:
+                try:
+                    reader = open(src, 'rb', buffering=0)
+                except OSError as e:
+                    on_skip(item, e)
+                    continue
+                algorithm, expected = checksum(item) if checksum is not None else (None, None)
+                h = hashing.new(algorithm) if algorithm is not None else None
+                with reader:
+                    ring.mark(('start', dst, item, None))
+                    while True:
+                        chunk = ring.acquire()
+                        n = reader.readinto(chunk)
+                        if not n:
+                            ring.release(chunk)
+                            break
+                        if h is not None:
+                            h.update(memoryview(chunk)[:n])
+                        ring.commit(chunk, n)
+                ring.mark(('end', dst, item, (algorithm, expected, h.hexdigest() if h is not None else None)))
+            ring.mark(('done', None, None, None))
+        except BaseException as e:
+            self.error = e
+            ring.abort(f"reading failed: {e}")
+
+    @staticmethod
+    def write_all(writer, view):
+        while len(view) > 0:
+            n = writer.write(view)
+            view = view[n:]
+
+    def verify(self, region, on_done, on_failed):
+        """
+        Read back the files of a completed region and compare them with the digests of the written bytes
+        """
+        time_started = time.time()
+        size_total = 0
+        for dst, item, algorithm, digest, size, seconds in region:
+            try:
+                with open(dst, 'rb', buffering=0) as reader:
+                    # Drop the written pages from the page cache, the file must come from tape
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(reader.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                    read_back = hashing.hash_reader(reader, algorithm)
+            except OSError as e:
+                on_failed(item, f"reading back failed: {e}")
+                continue
+            size_total += size
+            if read_back != digest:
+                on_failed(item, f"read back {algorithm} {read_back}, written {digest}")
+            else:
+                on_done(item, size, seconds)
+        seconds = time.time() - time_started
+        self.verified_bytes += size_total
+        self.verify_seconds += seconds
+        logger.info(f"Read back {len(region)} files, {size_total} bytes in {seconds:.1f} seconds "
+                    f"({size_total / max(seconds, 0.000001) / 1024 / 1024:.1f} MB/s)")
+        region.clear()
+
+    def write(self, jobs, on_done, on_skip, checksum=None, on_failed=None):
+        """
+        Copy files, the jobs are consumed by the reader thread (can be a generator which decides about the next file)
+        :param jobs: iterable of tuples (source file, destination file, item)
+        :param on_done: called with (item, bytes, seconds) after a file is completely written (and read back)
+        :param on_skip: called with (item, OSError) if a source file can't be opened, the file is skipped
+        :param checksum: returns (algorithm, expected digest or None) of an item, the written bytes are hashed and
+                         compared. None to write without hashing (and without read back)
+        :param on_failed: called with (item, reason) instead of on_done if the digest of the written bytes or of the
+                          read back file is wrong, the file stays on the destination
+        :return: tuple (number of files, bytes)
+        :raise OSError: writing failed (e.g. errno 28, no space left on device), the current file is incomplete.
+                        Written files which wait for the read back are neither done nor failed
+        """
+        self.error = None
+        ring = RingBuffer(self.buffer_size, self.chunk_size)
+        thread = threading.Thread(target=self.read, args=(ring, jobs, on_skip, checksum), name='tape-reader',
+                                  daemon=True)
+        time_started = time.time()
+        thread.start()
+        writer = None
+        file_started = time_started
+        size = 0
+        files = 0
+        written = 0
+        failed = 0
+        region = []
+        region_size = 0
+        try:
+            while True:
+                chunk, length, marker = ring.get()
+                if chunk is not None:
+                    self.write_all(writer, memoryview(chunk)[:length])
+                    ring.release(chunk)
+                    size += length
+                    continue
+
+                kind, dst, item, digests = marker
+                if kind == 'start':
+                    writer = open(dst, 'wb', buffering=0)
+                    file_started = time.time()
+                    size = 0
+                elif kind == 'end':
+                    writer.close()
+                    writer = None
+                    seconds = time.time() - file_started
+                    files += 1
+                    written += size
+                    logger.debug(f"Written {dst}: {size} bytes in {seconds:.3f} seconds "
+                                 f"({size / max(seconds, 0.000001) / 1024 / 1024:.1f} MB/s)")
+                    algorithm, expected, digest = digests
+                    if expected is not None and digest != expected:
+                        failed += 1
+                        on_failed(item, f"written {algorithm} {digest}, expected {expected}")
+                    elif digest is not None and self.verify_region > 0:
+                        region.append((dst, item, algorithm, digest, size, seconds))
+                        region_size += size
+                        if region_size >= self.verify_region:
+                            self.verify(region, on_done, on_failed)
+                            region_size = 0
+                    else:
+                        on_done(item, size, seconds)
+                else:
+                    if region:
+                        self.verify(region, on_done, on_failed)
+                    break
+        except BaseException as e:
+            ring.abort(f"writing failed: {e}")
+            if isinstance(e, RingBufferAborted):
+                # Reading failed, report the cause
+                thread.join()
+                raise self.error
+            raise
+        finally:
+            if writer is not None:
+                writer.close()
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+        seconds = time.time() - time_started
+        self.files += files
+        self.bytes += written
+        self.seconds += seconds
+        logger.info(f"Written {files} files, {written} bytes in {seconds:.1f} seconds "
+                    f"({written / max(seconds, 0.000001) / 1024 / 1024:.1f} MB/s), waited for reading: "
+                    f"{ring.consumer_wait:.1f} seconds, reading waited for tape: {ring.producer_wait:.1f} seconds")
+        if failed > 0:
+            logger.error(f"{failed} files were written with a wrong checksum")
+        return files, written
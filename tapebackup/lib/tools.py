@@ -1,6 +1,5 @@
 import errno
 import logging
-import hashlib
 import os
 import re
 import math
@@ -8,10 +7,11 @@ import string
 import secrets
 import tarfile
 import xattr
-from functools import partial
 from datetime import datetime
 from tabulate import tabulate
 from pathlib import Path
+from tapebackup.lib.storage import StorageBudget
+from tapebackup.lib import hashing
 
 logger = logging.getLogger()
 
@@ -20,24 +20,42 @@ class Tools:
         self.config = config
         #self.database = database
         self.alphabet = string.ascii_letters + string.digits
+        self.storage = StorageBudget(config, self)
 
     @staticmethod
     def _md5sum(reader):
-        d = hashlib.md5()
-        for buf in iter(partial(reader.read, 4096), b''):
-            d.update(buf)
-        return d.hexdigest()
+        return hashing.hash_reader(reader, 'md5')
 
     @classmethod
     def md5sum(cls, filename):
-        with open(filename, mode='rb') as f:
-            return cls._md5sum(f)
+        return hashing.hash_file(filename, 'md5')
 
     @classmethod
     def md5sum_tar(cls, archive):
+        return cls.hash_tar(archive, 'md5')
+
+    def hash_algorithm(self):
+        """
+        :return: algorithm for new digests ('hash-algorithm' in config file)
+        """
+        return self.config.get('hash-algorithm') or hashing.DEFAULT_ALGORITHM
+
+    def hash_file(self, filename, algorithm=None, use_mmap=None):
+        """
+        :param filename: file to hash
+        :param algorithm: algorithm of the stored digest, None for 'hash-algorithm' of the config file
+        :param use_mmap: None for 'hash-mmap' of the config file (only used for local working directories)
+        :return: hex digest
+        """
+        if use_mmap is None:
+            use_mmap = self.config.get('hash-mmap', False)
+        return hashing.hash_file(filename, algorithm or self.hash_algorithm(), use_mmap)
+
+    @staticmethod
+    def hash_tar(archive, algorithm=None):
         with tarfile.open(archive, mode='r|') as t:
             f = t.extractfile(t.next())
-            return cls._md5sum(f)
+            return hashing.hash_reader(f, algorithm or hashing.DEFAULT_ALGORITHM)
 
     def strip_base_path(self, fullpath, partpath):
         return os.path.relpath(fullpath, partpath)
@@ -94,22 +112,12 @@ class Tools:
         return total
 
     def calculate_over_max_storage_usage(self, new_file_size):
-        if self.config['max_storage_usage'] == '' or self.config['max_storage_usage'] is None:
-            return False
-        current_size = self.folder_size(self.config['local-data-dir']) \
-                       + self.folder_size(self.config['local-enc-dir']) \
-                       + self.folder_size(self.config['local-verify-dir'])
-
-        if new_file_size == -1:
-            if current_size >= self.back_convert_size(self.config['max_storage_usage']):
-                return True
-            else:
-                return False
-        else:
-            if (current_size + new_file_size) >= self.back_convert_size(self.config['max_storage_usage']):
-                return True
-            else:
-                return False
+        """
+        Check the tracked storage usage (see StorageBudget), the directories are only walked once
+        :param new_file_size: size of a new file, -1 if unknown
+        :return: True if max_storage_usage is reached
+        """
+        return not self.storage.check(max(new_file_size, 0))
 
     @staticmethod
     def datetime_from_db(field):
@@ -0,0 +1,176 @@
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger()
+
+
+class SshTransport:
+    """
+    Persistent ssh connection to 'remote-server' (OpenSSH ControlMaster)
+    The master connection is opened once per run, all ssh and rsync calls are multiplexed over it. If the master
+    is gone, clients fall back to a direct connection and the master gets re-established with the next check.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.server = config['remote-server']
+        self.port = str(config['remote-port'])
+        self.multiplex = config.get('remote-ssh-multiplex', True)
+        self.check_interval = int(config.get('remote-ssh-check-interval', 30))
+        self.control_dir = None
+        self.control_path = None
+        self.master = None
+        # Set while one caller waits for a new master, other callers use direct connections meanwhile
+        self.starting = False
+        self.last_check = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def ssh_options(self):
+        options = ['-p', self.port]
+        if self.multiplex and self.control_path is not None:
+            options += ['-o', f'ControlPath={self.control_path}', '-o', 'ControlMaster=no']
+        return options
+
+    def command(self, remote_command):
+        """
+        Build a command to execute on the remote server
+        :param remote_command: shell command executed by the remote shell
+        :return: argument list for subprocess
+        """
+        return ['ssh', *self.ssh_options(), self.server, remote_command]
+
+    def rsync_shell(self):
+        """
+        :return: remote shell for rsync ('-e' option)
+        """
+        return shlex.join(['ssh', *self.ssh_options()])
+
+    def remote_path(self, path):
+        return f"{self.server}:{path}"
+
+    def open(self):
+        if not self.multiplex:
+            return True
+        with self.lock:
+            master = self.start_master()
+        return self.wait_master(master)
+
+    def start_master(self):
+        """
+        Start the master connection, the caller holds the lock and waits for it with wait_master (without the lock)
+        :return: process of the master connection
+        """
+        if self.control_dir is None:
+            self.control_dir = tempfile.mkdtemp(prefix='tapebackup-ssh-')
+            self.control_path = os.path.join(self.control_dir, 'master')
+
+        self.last_check = time.time()
+        logger.debug(f"Opening ssh master connection to {self.server}:{self.port}")
+        command = ['ssh', '-p', self.port, '-N', '-o', 'ControlMaster=yes', '-o', f'ControlPath={self.control_path}',
+                   '-o', 'ServerAliveInterval=30', '-o', 'ServerAliveCountMax=3', self.server]
+        # stderr goes to a file, a pipe which is never read could fill up and block the master
+        with open(self.log_path(), 'wb') as log:
+            self.master = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=log,
+                                           preexec_fn=os.setpgrp)
+        self.starting = True
+        return self.master
+
+    def wait_master(self, master):
+        """
+        Wait until the control socket accepts clients
+        :param master: process returned by start_master
+        :return: True if the master connection is usable
+        """
+        time_started = time.time()
+        while time.time() - time_started < 30:
+            if self.master is not master:
+                # Stopped by close()
+                return self.master_failed(master)
+            if master.poll() is not None:
+                logger.warning(f"Opening ssh master connection failed, using direct connections: {self.read_log()}")
+                return self.master_failed(master)
+            if self.check_master():
+                logger.debug(f"Execution Time: Open ssh master connection: {time.time() - time_started} seconds")
+                with self.lock:
+                    self.starting = False
+                    return self.master is master
+            time.sleep(0.1)
+
+        logger.warning("Opening ssh master connection timed out, using direct connections")
+        return self.master_failed(master)
+
+    def master_failed(self, master):
+        with self.lock:
+            self.starting = False
+            # close() may already have stopped it
+            if self.master is master:
+                self.stop_master()
+        return False
+
+    def log_path(self):
+        return os.path.join(self.control_dir, 'master.log')
+
+    def read_log(self):
+        try:
+            with open(self.log_path(), 'rb') as log:
+                return log.read().decode('utf-8', errors='replace').strip()
+        except (OSError, TypeError):
+            return ''
+
+    def check_master(self):
+        if not os.path.exists(self.control_path):
+            return False
+        command = ['ssh', '-p', self.port, '-o', f'ControlPath={self.control_path}', '-O', 'check', self.server]
+        return subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+    def ensure(self, force=False):
+        """
+        Health check of the master connection (at most every 'remote-ssh-check-interval' seconds), re-establish
+        it if it dropped
+        :param force: Check now, e.g. after a failed remote call
+        :return: True if the master connection is usable
+        """
+        if not self.multiplex:
+            return True
+        with self.lock:
+            if self.starting:
+                return False
+            if not force and time.time() - self.last_check < self.check_interval:
+                return self.master is not None
+            self.last_check = time.time()
+            if self.master is not None and self.master.poll() is None and self.check_master():
+                return True
+            logger.warning(f"ssh master connection to {self.server} dropped, re-establishing")
+            self.stop_master()
+            master = self.start_master()
+        return self.wait_master(master)
+
+    def stop_master(self):
+        if self.control_path is not None and os.path.exists(self.control_path):
+            command = ['ssh', '-p', self.port, '-o', f'ControlPath={self.control_path}', '-O', 'exit', self.server]
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if self.master is not None:
+            if self.master.poll() is None:
+                self.master.terminate()
+            self.master.wait()
+            self.master = None
+
+    def close(self):
+        with self.lock:
+            self.stop_master()
+            if self.control_dir is not None:
+                shutil.rmtree(self.control_dir, ignore_errors=True)
+                self.control_dir = None
+                self.control_path = None
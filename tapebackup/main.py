@@ -13,7 +13,7 @@ from lib import Tapelibrary, Tools
 
 pname = "Tapebackup"
 pversion = '0.2'
-db_model_version = 1
+db_model_version = 4
 logger_format = '[%(levelname)-7s] (%(asctime)s) %(filename)s::%(lineno)d %(message)s'
 log_dir = 'logs'
 debug = False
@@ -61,6 +61,9 @@ def signal_handler(signalo, frame):
     else:
         interrupted = True
         current_class.set_interrupted()
+        # Commit queued database updates now, the current operation may take a while
+        if getattr(current_class, 'catalog', None) is not None:
+            current_class.catalog.request_flush()
         print(' I will stop after current Operation!')
 
 signal.signal(signal.SIGINT, signal_handler)
@@ -165,11 +168,16 @@ if __name__ == "__main__":
     subparsers = parser.add_subparsers(title='Commands', dest='command')
     subparser_get = subparsers.add_parser('get', help='Get Files from remote Server')
     subparser_get.add_argument('-f', '--file', type=str, help='Take filelist from file (one file per line -> full path), instead of building filelist itself')
+    subparser_get.add_argument('-b', '--batch', action='store_true', help='Download files in batches, one rsync call per batch [Default: Read from config file]')
+    subparser_get.add_argument('--full', action='store_true', help='Force a full scan of the source directory, even if an incremental scan is possible')
+    subparser_get.add_argument('-e', '--encrypt', action='store_true', help='Encrypt files while downloading them into local-enc-dir, the plaintext is not stored locally')
     subparser_encrypt = subparsers.add_parser('encrypt',
                                               help='Enrypt files and build directory for one tape media size')
     subparser_write = subparsers.add_parser('write', help='Write directory into')
     subparser_write.add_argument("-d", "--delete-after-write", action="store_true",
                                         help="Delete encrypted file directly after writing to tape to save space [Default: Deleting files after a tape is full and verified]")
+    subparser_write.add_argument("--direct", action="store_true",
+                                        help="[Only with --local] Encrypt files which are not encrypted yet directly to tape, without a copy in local-enc-dir (staged if the encryption is too slow)")
 
     subparser_verify = subparsers.add_parser('verify', help='Verify Files (random or given filename) on Tape')
     subparser_verify_group = subparser_verify.add_mutually_exclusive_group(required=True)
@@ -185,6 +193,9 @@ if __name__ == "__main__":
     subparser_restore_start = subparser_restore_sub.add_parser('start', help='Start restore operation (-f must be given)')
     subparser_restore_start.add_argument('-t', '--tape', type=str, help='Only restore from this tape')
     subparser_restore_start.add_argument('-l', '--filelist', type=str, help='Read paths from file list to restore')
+    subparser_restore_start.add_argument('-r', '--range', type=str, dest='byte_range', metavar='OFFSET:LENGTH',
+                                         help='Only restore this byte range of a single file (e.g. 100G:4M), '
+                                              'written to restore-dir as PATH.OFFSET-LENGTH')
     subparser_restore_start.add_argument('files', nargs='*', help='Select files by absolute path or with wildcard')
     subparser_restore_continue = subparser_restore_sub.add_parser('continue', help='Restore job will be continued')
     subparser_restore_continue.add_argument('jobid', nargs='?', help='Display status of specific restore job')
@@ -215,16 +226,27 @@ if __name__ == "__main__":
     subsubparser_db.add_parser('backup', help='Backup SQLite DB to given GIT repo')
     subsubparser_db.add_parser('status', help='Show SQLite Information')
     subsubparser_db.add_parser('migrate', help='Migrate database from schema pre version 0.3')
+    subsubparser_db.add_parser('upgrade', help='Upgrade database schema to the current model version')
 
     subparser_tape = subparsers.add_parser('tape', help='Tapelibrary operations')
     subsubparser_tape = subparser_tape.add_subparsers(title='Subcommands', dest='command_sub')
     subsubparser_tape.add_parser('info', help='Get Informations about Tapes and Devices')
     subsubparser_tape.add_parser('status', help='Get Informations about Tapes (offline/online and to be removed)')
+    subparser_tape_plan = subsubparser_tape.add_parser('plan', help='Show expected tape mounts per directory for the files to be written')
+    subparser_tape_plan.add_argument("-d", "--depth", type=int, help="Group by this count of leading directories, 0 for whole directories [Default: Read from config file]")
 
     subparser_config = subparsers.add_parser('config', help='Configuration operations')
     subsubparser_config = subparser_config.add_subparsers(title='Subcommands', dest='command_sub')
     subsubparser_config.add_parser('create_key', help='Create 128 Byte encryption key')
 
+    subparser_benchmark = subparsers.add_parser('benchmark', help='Benchmarks of internal operations')
+    subsubparser_benchmark = subparser_benchmark.add_subparsers(title='Subcommands', dest='command_sub')
+    subparser_benchmark_diff = subsubparser_benchmark.add_parser('diff', help='Compare time and peak memory of catalog diff implementations')
+    subparser_benchmark_diff.add_argument("-n", "--count", type=int, default=1000000, help="Count of files in synthetic catalog [Default: 1000000]")
+    subparser_benchmark_hash = subsubparser_benchmark.add_parser('hash', help='Compare throughput of hash algorithms')
+    subparser_benchmark_hash.add_argument("-s", "--size", type=str, default="4G", help="Size of the test file [Default: 4G]")
+    subparser_benchmark_hash.add_argument("-d", "--directory", type=str, help="Directory of the test file [Default: local-data-dir]")
+
     subparser_debug = subparsers.add_parser('debug', help='Print debug information')
     subparser_develop = subparsers.add_parser('develop', help='Generic function for developing new stuff')
 
@@ -267,6 +289,8 @@ if __name__ == "__main__":
         if args.command == "db":
             if args.command_sub != "migrate" and args.command_sub != "upgrade":
                 sys.exit(1)
+            if args.command_sub == "upgrade":
+                db_engine = database.connect(cfg['database'])
         else:
             sys.exit(1)
 
@@ -285,7 +309,7 @@ if __name__ == "__main__":
 
         from functions.files import Files
         current_class = Files(cfg, db_engine, tapelibrary, tools, args.local)
-        current_class.get(args.file)
+        current_class.get(args.file, batch=args.batch, full=args.full, encrypt=args.encrypt)
 
     elif args.command == "encrypt":
         logger.info("Starting encrypt operation, logging into logs/encrypt.log")
@@ -302,8 +326,8 @@ if __name__ == "__main__":
         logger.info("########## NEW SESSION ##########")
 
         from functions.tape import Tape
-        current_class = Tape(cfg, db_engine, tapelibrary, tools)
-        current_class.write(delete_after_write=args.delete_after_write)
+        current_class = Tape(cfg, db_engine, tapelibrary, tools, args.local)
+        current_class.write(delete_after_write=args.delete_after_write, direct=args.direct)
 
     elif args.command == "verify":
         logger.info("Starting verify operation, logging into logs/verify.log")
@@ -331,7 +355,14 @@ if __name__ == "__main__":
                 subparser_restore_start.print_help()
                 sys.exit(1)
             else:
-                current_class.start(args.files, tape=args.tape, filelist=args.filelist)
+                byte_range = None
+                if args.byte_range is not None:
+                    try:
+                        byte_range = current_class.parse_range(args.byte_range)
+                    except (ValueError, KeyError):
+                        logger.error(f"Invalid range '{args.byte_range}', use OFFSET:LENGTH (e.g. 100G:4M)")
+                        sys.exit(1)
+                current_class.start(args.files, tape=args.tape, filelist=args.filelist, byte_range=byte_range)
         elif args.command_sub == "continue":
             current_class.cont()
         elif args.command_sub == "abort":
@@ -385,6 +416,8 @@ if __name__ == "__main__":
             current_class.info()
         elif args.command_sub == "status":
             current_class.status()
+        elif args.command_sub == "plan":
+            current_class.plan(args.depth)
         elif args.command_sub is None:
             subparser_tape.print_help()
 
@@ -406,9 +439,25 @@ if __name__ == "__main__":
             current_class.backup()
         elif args.command_sub == "migrate":
             current_class.migrate(db_model_version)
+        elif args.command_sub == "upgrade":
+            current_class.upgrade(db_model_version)
         elif args.command_sub is None:
             subparser_db.print_help()
 
+    elif args.command == "benchmark":
+        logger.info("Starting benchmark operation, logging into logs/benchmark.log")
+        change_logger_filehandler('benchmark.log')
+        logger.info("########## NEW SESSION ##########")
+
+        from functions.benchmark import Benchmark
+        current_class = Benchmark(cfg, db_engine, tapelibrary, tools)
+        if args.command_sub == "diff":
+            current_class.diff(args.count)
+        elif args.command_sub == "hash":
+            current_class.hash(tools.back_convert_size(args.size), args.directory)
+        elif args.command_sub is None:
+            subparser_benchmark.print_help()
+
     elif args.command == "config":
         if args.command_sub == "create_key":
             create_key()